@@ -12,9 +12,9 @@ height = 512
 brick = Material(diffuse = (2.55, 1.27, 0.8), spec = 16,matType = OPAQUE)
 stone = Material(diffuse = (0.4, 0.4, 0.4), spec = 8,matType = OPAQUE)
 
-earth = Material(texture = Texture("earthDay.bmp"))
-# marble = Material(diffuse = (0.8,0.8,0.8), texture = Texture("marble.bmp"), spec = 32, matType= REFLECTIVE)
-marble = Material(spec = 64, texture = Texture("marble.bmp"), matType= REFLECTIVE)
+earth = Material(texture = loadTexture("earthDay.bmp"))
+# marble = Material(diffuse = (0.8,0.8,0.8), texture = loadTexture("marble.bmp"), spec = 32, matType= REFLECTIVE)
+marble = Material(spec = 64, texture = loadTexture("marble.bmp"), matType= REFLECTIVE)
 
 mirror = Material(diffuse = (0.9, 0.9, 0.9), spec = 64, matType = REFLECTIVE)
 glass = Material(diffuse = (0.9, 0.9, 0.9), spec = 64, ior=1.5, matType = TRANSPARENT)
@@ -23,7 +23,7 @@ pinkglass = Material(diffuse = (1.55, 0.92, 1.03), spec = 64, ior=1.5, matType =
 
 rtx = Raytracer(width, height)
 
-rtx.envMap = Texture("parkingLot.bmp")
+rtx.envMap = loadTexture("parkingLot.bmp")
 
 rtx.lights.append( AmbientLight(intensity = 0.1 ))
 rtx.lights.append(PointLight((0,5,5), constant = 1.0, linear = 0.1, quad = 0.05, color = (1,1,1)))
@@ -39,6 +39,7 @@ rtx.scene.append(AABB(position=(2,0,-8),size=(2,2,2), material=marble))
 rtx.scene.append(AABB(position=(-1,0,-8),size=(2,2,2), material=stone))
 
 
-rtx.glRender()
+if __name__ == '__main__':
+    rtx.glRender()
 
-rtx.glFinish("output.bmp")
\ No newline at end of file
+    rtx.glFinish("output.bmp")
\ No newline at end of file
@@ -0,0 +1,229 @@
+import numpy as np
+
+from gl import colors
+from figures import Material, OPAQUE
+from lights import POINT_LIGHT, DIR_LIGHT
+from bvh import BOUNDS_PADDING, slabTestMany, inverseDirections
+from matesRS import Vec3
+
+# Raytracer attributes other than the camera that every pixel depends on
+GLOBAL_ATTRIBUTES = ('envMap', 'envCubeMap', 'clearColor', 'textureFilter', 'minRayWeight', 'russianRoulette')
+
+# Attributes that change while rendering, or are derived from the others,
+# so they do not make an object or light count as changed
+UNTRACKED_ATTRIBUTES = ('lastOccluder', 'bvh', 'inverse', 'normalMatrix')
+
+# Arrays with more numbers than this, like the triangles of a mesh, are
+# compared by identity instead of content, so a frame does not copy the
+# whole geometry of the scene. Like the BVH made from them, they are
+# replaced, not edited in place.
+ARRAY_STATE_SIZE = 64
+
+
+class ArrayState(object):
+    # Stands for a large array in a state; equal to the state of the same
+    # array only. Keeps the array alive so its id is not reused.
+    def __init__(self, array):
+        self.array = array
+
+    def __eq__(self, other):
+        return isinstance(other, ArrayState) and self.array is other.array
+
+
+def getState(value, memo = None):
+    # Copy of value to compare with a later one. Materials and the figures
+    # an object is made of are copied attribute by attribute, small arrays
+    # by content, anything else, like a texture, is compared as is. Those
+    # shared by many objects, like the figure of instances, are copied once
+    # per memo.
+    if isinstance(value, np.ndarray):
+        if value.size > ARRAY_STATE_SIZE:
+            return ArrayState(value)
+        return (value.shape, value.dtype.str, value.tobytes())
+
+    if isinstance(value, (list, tuple, Vec3)):
+        return tuple(getState(item, memo) for item in value)
+
+    if isinstance(value, Material) or hasattr(value, 'ray_intersect') or hasattr(value, 'lightType'):
+        if memo is not None and id(value) in memo:
+            return memo[id(value)]
+
+        state = (type(value), {name: getState(item, memo) for name, item in vars(value).items()
+                               if name not in UNTRACKED_ATTRIBUTES})
+        if memo is not None:
+            memo[id(value)] = state
+        return state
+
+    return value
+
+
+def getBounds(obj):
+    bounds = obj.getBounds() if hasattr(obj, 'getBounds') else None
+    if bounds is None:
+        return None
+
+    return (np.array(bounds[0], dtype = float) - BOUNDS_PADDING,
+            np.array(bounds[1], dtype = float) + BOUNDS_PADDING)
+
+
+class Animation(object):
+    # Renders the frames of a changing scene, tracing again only the
+    # pixels a change may reach and keeping the rest of the framebuffer.
+    # Every frame remembers, for each ray it traced, its pixel, its
+    # segment and the object it hit. A changed object dirties the pixels
+    # whose rays hit it, or whose rays or shadow rays cross its bounds
+    # before or after the change. A change to the lights dirties every
+    # pixel that sees an object, and one to the camera, the window, the
+    # global settings or an object without bounds, the whole frame.
+
+    def __init__(self, raytracer):
+        self.raytracer = raytracer
+
+        self.settings = None
+        self.pixels = None
+        self.objects = {}
+        self.lights = None
+
+        # Whether each pixel was traced by the last render, in the order of
+        # getViewportSamples
+        self.dirty = None
+
+    def getSettings(self):
+        rtx = self.raytracer
+        return (rtx.getCamera(), tuple(getattr(rtx, name) for name in GLOBAL_ATTRIBUTES))
+
+    def render(self):
+        rtx = self.raytracer
+
+        t, r = rtx.getProjection()
+        xs, ys = rtx.getViewportSamples()
+        x, y, directions = rtx.getRayDirections(xs, ys, t, r)
+
+        settings = self.getSettings()
+        memo = {}
+        objects = {id(obj): (obj, getState(obj, memo), getBounds(obj)) for obj in rtx.scene}
+        lights = [getState(light, memo) for light in rtx.lights]
+
+        # Objects added, removed or edited since the last frame
+        changed = [key for key in self.objects.keys() | objects.keys()
+                   if key not in self.objects or key not in objects or self.objects[key][1] != objects[key][1]]
+
+        # Edits in place the raytracer was not told about
+        if any(key in self.objects and key in objects for key in changed):
+            rtx.scene.changed()
+        if lights != self.lights:
+            rtx.lights.changed()
+
+        if settings != self.settings or rtx.pixels is not self.pixels:
+            dirty = np.ones(len(directions), dtype = bool)
+        else:
+            dirty = self.getDirty(objects, lights, changed)
+
+        samples = np.nonzero(dirty)[0]
+        record = []
+
+        if len(samples):
+            rayColors = rtx.cast_rays(rtx.camPosition, directions[samples], record = record)
+            rtx.pixels[y[samples], x[samples]] = colors(rayColors)
+
+        self.update(record, samples, dirty)
+
+        self.settings = settings
+        self.pixels = rtx.pixels
+        self.objects = objects
+        self.lights = lights
+        self.dirty = dirty
+
+    def getDirty(self, objects, lights, changed):
+        # Pixels of the last frame that may look different now
+        dirty = np.zeros(len(self.dirty), dtype = bool)
+
+        if lights != self.lights:
+            dirty[self.rayPixels[self.rayObjects != -1]] = True
+
+        boxes = []
+        hits = []
+
+        for key in changed:
+            before = self.objects.get(key)
+            after = objects.get(key)
+
+            for entry in (before, after):
+                if entry is not None:
+                    if entry[2] is None:
+                        return np.ones(len(dirty), dtype = bool)
+                    boxes.append(entry[2])
+
+            if before is not None:
+                hits.append(key)
+
+        if hits:
+            dirty[self.rayPixels[np.isin(self.rayObjects, hits)]] = True
+
+        for boundsMin, boundsMax in boxes:
+            dirty[self.rayPixels[slabTestMany(self.rayOrigs, self.rayInvDirs, boundsMin, boundsMax, self.rayEnds)]] = True
+            dirty[self.shadowPixels[slabTestMany(self.shadowOrigs, self.shadowInvDirs, boundsMin, boundsMax, self.shadowEnds)]] = True
+
+        return dirty
+
+    def update(self, record, samples, dirty):
+        # Replaces the rays of the pixels traced again with the new ones,
+        # and works out the shadow rays of every opaque hit
+        rtx = self.raytracer
+
+        ids = np.array([id(obj) for obj in rtx.scene] + [-1], dtype = np.int64)
+        opaque = np.array([obj.material.matType == OPAQUE for obj in rtx.scene] + [False])
+
+        pixels = [samples[roots] for roots, origs, dirs, intersects in record]
+        origs = [origs for roots, origs, dirs, intersects in record]
+        dirs = [dirs for roots, origs, dirs, intersects in record]
+        ends = [intersects.distance for roots, origs, dirs, intersects in record]
+        objects = [ids[intersects.sceneObj] for roots, origs, dirs, intersects in record]
+        points = [intersects.point[opaque[intersects.sceneObj]] for roots, origs, dirs, intersects in record]
+        pointPixels = [samples[roots][opaque[intersects.sceneObj]] for roots, origs, dirs, intersects in record]
+
+        if self.settings is not None and not np.all(dirty):
+            kept = ~dirty[self.rayPixels]
+            pixels.append(self.rayPixels[kept])
+            origs.append(self.rayOrigs[kept])
+            dirs.append(self.rayDirs[kept])
+            ends.append(self.rayEnds[kept])
+            objects.append(self.rayObjects[kept])
+
+            kept = ~dirty[self.pointPixels]
+            points.append(self.points[kept])
+            pointPixels.append(self.pointPixels[kept])
+
+        self.rayPixels = np.concatenate(pixels + [np.zeros(0, dtype = int)])
+        self.rayOrigs = np.concatenate(origs + [np.zeros((0, 3))])
+        self.rayDirs = np.concatenate(dirs + [np.zeros((0, 3))])
+        self.rayInvDirs = inverseDirections(self.rayDirs)
+        self.rayEnds = np.concatenate(ends + [np.zeros(0)])
+        self.rayObjects = np.concatenate(objects + [np.zeros(0, dtype = np.int64)])
+        self.points = np.concatenate(points + [np.zeros((0, 3))])
+        self.pointPixels = np.concatenate(pointPixels + [np.zeros(0, dtype = int)])
+
+        # Shadow rays go from the point to a point light, or away from the
+        # point against the direction of a directional light
+        shadowPixels = []
+        shadowOrigs = []
+        shadowDirs = []
+        shadowEnds = []
+
+        for light in rtx.lights:
+            if light.lightType == POINT_LIGHT:
+                shadowDirs.append(np.subtract(light.point, self.points))
+                shadowEnds.append(np.ones(len(self.points)))
+            elif light.lightType == DIR_LIGHT:
+                shadowDirs.append(np.broadcast_to(np.array(light.direction) * -1, self.points.shape))
+                shadowEnds.append(np.full(len(self.points), np.inf))
+            else:
+                continue
+
+            shadowPixels.append(self.pointPixels)
+            shadowOrigs.append(self.points)
+
+        self.shadowPixels = np.concatenate(shadowPixels + [np.zeros(0, dtype = int)])
+        self.shadowOrigs = np.concatenate(shadowOrigs + [np.zeros((0, 3))])
+        self.shadowInvDirs = inverseDirections(np.concatenate(shadowDirs + [np.zeros((0, 3))]))
+        self.shadowEnds = np.concatenate(shadowEnds + [np.zeros(0)])
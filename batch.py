@@ -0,0 +1,109 @@
+import sys
+import json
+import time
+import runpy
+import argparse
+from collections import namedtuple
+
+from gl import Raytracer, V3
+
+# One view of the scene to render. Fields left as None keep the value the
+# raytracer already has. A target turns the camera to look at it.
+Job = namedtuple('Job', ['output', 'camPosition', 'fov', 'width', 'height', 'target'], defaults = (None, None, None, None, None))
+
+RENDER_MODES = ('scalar', 'wavefront', 'parallel')
+
+
+def loadJobs(filename):
+    # JSON list of objects with the fields of Job
+    with open(filename) as file:
+        return [Job(**job) for job in json.load(file)]
+
+
+def loadScene(filename):
+    # Runs a scene script and returns the Raytracer it builds, named rtx
+    # or the only one there is. Scripts that render on their own should
+    # only do so when run as __main__.
+    variables = runpy.run_path(filename, run_name = '__scene__')
+
+    if isinstance(variables.get('rtx'), Raytracer):
+        return variables['rtx']
+
+    raytracers = [value for value in variables.values() if isinstance(value, Raytracer)]
+    if len(raytracers) != 1:
+        raise ValueError("{} should build one Raytracer, named rtx".format(filename))
+
+    return raytracers[0]
+
+
+def renderJobs(rtx, jobs, mode = 'wavefront', workers = None, log = None):
+    # Renders every job with the same raytracer, so the textures, the BVH
+    # and the light data built for the first one are reused by the rest.
+    # Parallel renders share one pool of workers, unless there are stats
+    # to keep, which are sized to the window the pool started with.
+    # Returns the seconds each job took.
+    pool = None
+    if mode == 'parallel' and rtx.stats is None:
+        pool = rtx.startTileWorkers(workers)
+
+    seconds = []
+    try:
+        for job in jobs:
+            start = time.perf_counter()
+
+            width = rtx.width if job.width is None else job.width
+            height = rtx.height if job.height is None else job.height
+            if (width, height) != (rtx.width, rtx.height):
+                rtx.glResize(width, height)
+            else:
+                rtx.glClear()
+
+            if job.camPosition is not None:
+                rtx.camPosition = V3(*job.camPosition)
+            if job.target is not None:
+                rtx.lookAt(rtx.camPosition, job.target)
+            if job.fov is not None:
+                rtx.fov = job.fov
+
+            if mode == 'scalar':
+                rtx.glRender()
+            elif mode == 'wavefront':
+                rtx.glRenderWavefront()
+            else:
+                rtx.glRenderParallel(workers, pool = pool)
+
+            rtx.glFinish(job.output)
+
+            seconds.append(time.perf_counter() - start)
+            if log is not None:
+                log("{:40} {:6.3f} s".format(job.output, seconds[-1]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return seconds
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "Renders many views of one scene")
+    parser.add_argument('scene', help = "script that builds the scene as a Raytracer")
+    parser.add_argument('jobs', help = "JSON list of jobs, with output and optionally camPosition, target, fov, width and height")
+    parser.add_argument('--mode', default = 'wavefront', choices = RENDER_MODES)
+    parser.add_argument('--workers', type = int, help = "processes of the parallel mode")
+    args = parser.parse_args(args)
+
+    jobs = loadJobs(args.jobs)
+
+    start = time.perf_counter()
+    rtx = loadScene(args.scene)
+    print("{:40} {:6.3f} s".format("scene", time.perf_counter() - start))
+
+    seconds = renderJobs(rtx, jobs, args.mode, args.workers, print)
+    print("{:40} {:6.3f} s".format("{} jobs".format(len(jobs)), sum(seconds)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
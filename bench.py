@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import tempfile
+import argparse
+import numpy as np
+
+from gl import Raytracer, RenderStats
+from texture import Texture, loadTexture
+from figures import *
+from lights import *
+from obj import Obj
+from matesRS import Vec3, createObjectMatrix
+
+# Benchmarks run at least this long, in seconds, so short ones are timed
+# over enough calls
+MIN_TIME = 0.2
+
+# Scene benchmarks render at this size unless told otherwise
+SCENE_SIZE = 64
+
+# Scene benchmarks keep the best of this many renders
+SCENE_REPEAT = 1
+
+# A run is a regression when it is this much slower than the baseline
+TOLERANCE = 0.1
+
+TEXTURE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "marble.bmp")
+
+CUBE_OBJ = """v -1 -1 -1
+v 1 -1 -1
+v 1 1 -1
+v -1 1 -1
+v -1 -1 1
+v 1 -1 1
+v 1 1 1
+v -1 1 1
+f 1 2 3 4
+f 5 8 7 6
+f 1 5 6 2
+f 2 6 7 3
+f 3 7 8 4
+f 5 1 4 8
+"""
+
+
+def timeCall(function, minTime = MIN_TIME):
+    # Seconds per call of function, the best of 3 runs of at least minTime
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(1, int(number * minTime / 0.2))
+    return min(timer.repeat(3, number)) / number
+
+
+def micro(name, function, minTime = MIN_TIME):
+    seconds = timeCall(function, minTime)
+    return {'name': name,
+            'kind': 'micro',
+            'seconds': seconds,
+            'callsPerSecond': 1 / seconds}
+
+
+# Materials shared by the scenes
+
+brick = Material(diffuse = (0.8, 0.4, 0.3), spec = 16)
+stone = Material(diffuse = (0.4, 0.4, 0.4), spec = 8)
+mirror = Material(diffuse = (0.9, 0.9, 0.9), spec = 64, matType = REFLECTIVE)
+glass = Material(diffuse = (0.9, 0.9, 0.9), spec = 64, ior = 1.5, matType = TRANSPARENT)
+
+
+def lightScene(rtx):
+    rtx.lights.append(AmbientLight(intensity = 0.1))
+    rtx.lights.append(PointLight((0,5,5)))
+    rtx.lights.append(DirectionalLight(direction = (-1,-1,-1), intensity = 0.5))
+
+
+def planesScene(width, height):
+    rtx = Raytracer(width, height)
+    lightScene(rtx)
+
+    rtx.scene.append(Plane(position = (0,-10,0), normal = (0,1,0), material = brick))
+    rtx.scene.append(Plane(position = (0,10,0), normal = (0,-1,0), material = brick))
+    rtx.scene.append(Plane(position = (-10,0,0), normal = (1,0,0), material = stone))
+    rtx.scene.append(Plane(position = (10,0,0), normal = (-1,0,0), material = stone))
+    rtx.scene.append(Plane(position = (0,0,-40), normal = (0,0,1), material = stone))
+    return rtx
+
+
+def boxesScene(width, height):
+    rtx = planesScene(width, height)
+
+    for x in range(-3, 4):
+        for y in range(-2, 3):
+            material = mirror if (x + y) % 3 == 0 else stone
+            rtx.scene.append(AABB(position = (x * 2.5, y * 2.5, -15), size = (1.5,1.5,1.5), material = material))
+    return rtx
+
+
+def glassScene(width, height):
+    rtx = planesScene(width, height)
+    rng = np.random.default_rng(1)
+
+    for i in range(20):
+        center = (rng.uniform(-5,5), rng.uniform(-4,4), rng.uniform(-14,-6))
+        rtx.scene.append(Sphere(center, rng.uniform(0.5,1.5), glass))
+    return rtx
+
+
+def spheresScene(width, height):
+    rtx = Raytracer(width, height)
+    lightScene(rtx)
+    rng = np.random.default_rng(2)
+
+    rtx.scene.append(Plane(position = (0,-6,0), normal = (0,1,0), material = brick))
+    for i in range(1000):
+        center = (rng.uniform(-8,8), rng.uniform(-6,6), rng.uniform(-40,-8))
+        material = (brick, stone, mirror)[i % 3]
+        rtx.scene.append(Sphere(center, rng.uniform(0.1,0.6), material))
+    return rtx
+
+
+def texturedScene(width, height):
+    rtx = planesScene(width, height)
+    marble = Material(spec = 32, texture = loadTexture(TEXTURE_FILE))
+
+    rtx.scene.append(AABB(position = (2,0,-8), size = (2,2,2), material = marble))
+    rtx.scene.append(AABB(position = (-2,0,-8), size = (2,2,2), material = marble))
+    rtx.scene.append(Disk(position = (0,-3,-10), radius = 3, normal = (0,1,0.2), material = marble))
+    return rtx
+
+
+def instancesScene(width, height):
+    # Forest of one shared box, seen from above by a look-at camera
+    rtx = Raytracer(width, height)
+    lightScene(rtx)
+    rng = np.random.default_rng(3)
+
+    rtx.scene.append(Plane(position = (0,-1,0), normal = (0,1,0), material = stone))
+
+    tree = AABB(position = (0,0,0), size = (1,1,1), material = brick)
+    for i in range(400):
+        position = (rng.uniform(-12,12), rng.uniform(-1,0), rng.uniform(-40,-5))
+        rotate = (0, rng.uniform(0,90), rng.uniform(-10,10))
+        scale = (rng.uniform(0.3,0.6), rng.uniform(1,3), rng.uniform(0.3,0.6))
+        rtx.scene.append(Instance(tree, createObjectMatrix(position, rotate, scale)))
+
+    rtx.lookAt((0,8,4), (0,0,-20))
+    return rtx
+
+
+SCENES = {'planes': planesScene,
+          'boxes': boxesScene,
+          'glass': glassScene,
+          'spheres': spheresScene,
+          'textured': texturedScene,
+          'instances': instancesScene}
+
+RENDER_MODES = {'scalar': lambda rtx: rtx.glRender(),
+                'wavefront': lambda rtx: rtx.glRenderWavefront(),
+                'parallel': lambda rtx: rtx.glRenderParallel()}
+
+
+def vectorBenchmarks(minTime = MIN_TIME):
+    # The vector math of the per ray code, on Vec3 against the numpy calls
+    # it replaced
+    results = []
+
+    a = np.array([0.1, 0.2, -5.0])
+    b = np.array([0.05, -0.02, -1.0])
+    va = Vec3(*a)
+    vb = Vec3(*b)
+
+    def numpyReflect(normal, direction):
+        reflect = np.subtract(2 * np.dot(normal, direction) * normal, direction)
+        return reflect / np.linalg.norm(reflect)
+
+    for name, numpyCall, vec3Call in (('dot', lambda: np.dot(a, b), lambda: va.dot(vb)),
+                                      ('cross', lambda: np.cross(a, b), lambda: va.cross(vb)),
+                                      ('add', lambda: np.add(a, b), lambda: va + vb),
+                                      ('normalize', lambda: a / np.linalg.norm(a), lambda: va.normalized()),
+                                      ('along', lambda: np.add(a, 2.5 * b), lambda: va.along(vb, 2.5)),
+                                      ('reflect', lambda: numpyReflect(b, a), lambda: va.reflect(vb))):
+        results.append(micro('numpy.' + name, numpyCall, minTime))
+        results.append(micro('Vec3.' + name, vec3Call, minTime))
+
+    return results
+
+
+def microBenchmarks(minTime = MIN_TIME):
+    results = vectorBenchmarks(minTime)
+
+    # Rays as the renderer passes them to the per ray code
+    orig = Vec3(0.1, 0.2, 0.0)
+    dir = Vec3(0.05, -0.02, -1.0).normalized()
+
+    tmp = tempfile.TemporaryDirectory()
+    objFile = os.path.join(tmp.name, "cube.obj")
+    bmpFile = os.path.join(tmp.name, "out.bmp")
+
+    with open(objFile, "w") as file:
+        file.write(CUBE_OBJ)
+
+    primitives = {'Sphere': Sphere((0,0,-5), 1, stone),
+                  'Plane': Plane(position = (0,0,-10), normal = (0,0,1), material = stone),
+                  'Disk': Disk(position = (0,0,-5), radius = 2, normal = (0,0,1), material = stone),
+                  'AABB': AABB(position = (0,0,-5), size = (2,2,2), material = stone),
+                  'Mesh': Mesh(Obj(objFile), stone, position = (0,0,-5)),
+                  'Instance': Instance(AABB(position = (0,0,0), size = (1,1,1), material = stone),
+                                       createObjectMatrix((0,0,-5), (0,45,0), (2,2,2)))}
+
+    for name, primitive in primitives.items():
+        results.append(micro(name + '.ray_intersect', lambda: primitive.ray_intersect(orig, dir), minTime))
+
+    rtx = Raytracer(8, 8)
+    rtx.scene.append(primitives['Sphere'])
+    intersect = primitives['Sphere'].ray_intersect(orig, dir)
+
+    for light in (DirectionalLight(direction = (-1,-1,-1)), PointLight((0,5,5))):
+        name = type(light).__name__
+        results.append(micro(name + '.shade', lambda: light.shade(intersect, rtx), minTime))
+        results.append(micro(name + '.getDiffuseColor', lambda: light.getDiffuseColor(intersect, rtx), minTime))
+        results.append(micro(name + '.getSpecColor', lambda: light.getSpecColor(intersect, rtx), minTime))
+        results.append(micro(name + '.getShadowIntensity', lambda: light.getShadowIntensity(intersect, rtx), minTime))
+
+    normal = Vec3(0.0, 0.0, 1.0)
+    results.append(micro('reflectVector', lambda: reflectVector(normal, -dir), minTime))
+    results.append(micro('refractVector', lambda: refractVector(normal, dir, 1.5), minTime))
+    results.append(micro('fresnel', lambda: fresnel(normal, dir, 1.5), minTime))
+
+    results.append(micro('Texture', lambda: Texture(TEXTURE_FILE), minTime))
+
+    rtx = Raytracer(512, 512)
+    rtx.glClear()
+    results.append(micro('glFinish', lambda: rtx.glFinish(bmpFile), minTime))
+
+    tmp.cleanup()
+
+    return results
+
+
+def sceneBenchmarks(size = SCENE_SIZE, modes = ('scalar',), scenes = None, repeat = SCENE_REPEAT):
+    results = []
+
+    for name in scenes or SCENES:
+        for mode in modes:
+            seconds = float('inf')
+
+            for i in range(repeat):
+                rtx = SCENES[name](size, size)
+
+                start = time.perf_counter()
+                RENDER_MODES[mode](rtx)
+                seconds = min(seconds, time.perf_counter() - start)
+
+            # Every ray traced, bounces and shadow rays too, counted on a
+            # render of its own so stats do not slow down the timed ones
+            rtx = SCENES[name](size, size)
+            rtx.stats = RenderStats(size, size)
+            RENDER_MODES[mode](rtx)
+            rays = int(sum(rtx.stats.rays.values()))
+
+            results.append({'name': '{}.{}.{}'.format(name, mode, size),
+                            'kind': 'scene',
+                            'seconds': seconds,
+                            'rays': rays,
+                            'raysPerSecond': rays / seconds})
+
+    return results
+
+
+def compare(results, baseline, tolerance = TOLERANCE):
+    # Benchmarks that take more than (1 + tolerance) times as long as in
+    # the baseline, as (name, baseline seconds, seconds)
+    before = {result['name']: result['seconds'] for result in baseline['benchmarks']}
+
+    return [(result['name'], before[result['name']], result['seconds'])
+            for result in results['benchmarks']
+            if result['name'] in before and result['seconds'] > before[result['name']] * (1 + tolerance)]
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "Raytracer benchmarks")
+    parser.add_argument('--size', type = int, default = SCENE_SIZE, help = "width and height of the scene renders")
+    parser.add_argument('--modes', nargs = '+', default = ['scalar'], choices = list(RENDER_MODES))
+    parser.add_argument('--scenes', nargs = '+', choices = list(SCENES))
+    parser.add_argument('--repeat', type = int, default = SCENE_REPEAT, help = "renders per scene, the best one counts")
+    parser.add_argument('--min-time', type = float, default = MIN_TIME, help = "seconds each micro-benchmark runs for")
+    parser.add_argument('--no-micro', action = 'store_true')
+    parser.add_argument('--no-scenes', action = 'store_true')
+    parser.add_argument('--json', help = "file to write the results to")
+    parser.add_argument('--compare', help = "results of an earlier run; exits with 1 on regressions")
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE)
+    args = parser.parse_args(args)
+
+    benchmarks = []
+    if not args.no_micro:
+        benchmarks += microBenchmarks(args.min_time)
+    if not args.no_scenes:
+        benchmarks += sceneBenchmarks(args.size, args.modes, args.scenes, args.repeat)
+
+    results = {'python': platform.python_version(),
+               'numpy': np.__version__,
+               'machine': platform.machine(),
+               'cpus': os.cpu_count(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'benchmarks': benchmarks}
+
+    for result in benchmarks:
+        if result['kind'] == 'micro':
+            print("{:36} {:12.2f} us".format(result['name'], result['seconds'] * 1e6))
+        else:
+            print("{:36} {:12.3f} s {:12.0f} rays/s".format(result['name'], result['seconds'], result['raysPerSecond']))
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        for name, before, after in regressions:
+            print("REGRESSION {}: {:.6f} s -> {:.6f} s".format(name, before, after))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
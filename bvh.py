@@ -0,0 +1,326 @@
+import numpy as np
+
+# Most primitives a leaf may hold before the builder tries to split it
+LEAF_SIZE = 4
+
+# Relative cost of a box test against a primitive test, for the SAH
+TRAVERSAL_COST = 0.5
+
+# Boxes grow by this much so hits on the very edge of a primitive are
+# never culled by rounding
+BOUNDS_PADDING = 1e-4
+
+# A refitted tree is worth keeping while the area of all its boxes stays
+# under this many times what it was when built
+REFIT_GROWTH = 2
+
+
+def surfaceArea(boundsMin, boundsMax):
+    size = np.maximum(np.subtract(boundsMax, boundsMin), 0)
+    return 2 * (size[..., 0] * size[..., 1] + size[..., 1] * size[..., 2] + size[..., 2] * size[..., 0])
+
+
+def slabIntersect(orig, invDir, boundsMin, boundsMax):
+    # Distances where the ray enters and leaves the box, with the axes of
+    # the faces it crosses there, or None if the ray misses the box.
+    # invDir holds 1 / dir, with inf for the axes the ray does not move
+    # along.
+    tNear = -float('inf')
+    tFar = float('inf')
+    nearAxis = farAxis = -1
+
+    for i in range(3):
+        if invDir[i] == float('inf'):
+            if orig[i] < boundsMin[i] or orig[i] > boundsMax[i]:
+                return None
+            continue
+
+        t1 = (boundsMin[i] - orig[i]) * invDir[i]
+        t2 = (boundsMax[i] - orig[i]) * invDir[i]
+
+        if t1 > t2:
+            t1, t2 = t2, t1
+
+        if t1 > tNear:
+            tNear = t1
+            nearAxis = i
+        if t2 < tFar:
+            tFar = t2
+            farAxis = i
+
+        if tNear > tFar:
+            return None
+
+    return tNear, tFar, nearAxis, farAxis
+
+
+def slabSpansMany(origs, invDirs, boundsMin, boundsMax):
+    # Distances where the rays enter and leave the slab of each axis of the
+    # boxes. Rays and boxes broadcast against each other over every axis
+    # but the last, so (rays, 1, 3) rays against (boxes, 3) boxes give
+    # (rays, boxes, 3) spans.
+    with np.errstate(invalid = 'ignore'):
+        t1 = (boundsMin - origs) * invDirs
+        t2 = (boundsMax - origs) * invDirs
+
+    # A NaN comes only from a ray that does not move along an axis and
+    # starts on one of its slab planes, which does not limit the interval
+    tMin = np.fmin(t1, t2)
+    tMax = np.fmax(t1, t2)
+    tMin[np.isnan(tMin)] = -np.inf
+    tMax[np.isnan(tMax)] = np.inf
+
+    return tMin, tMax
+
+
+def slabIntersectMany(origs, invDirs, boundsMin, boundsMax):
+    # Batched slabIntersect, broadcasting as slabSpansMany does. Misses
+    # come back with tNear > tFar.
+    tMin, tMax = slabSpansMany(origs, invDirs, boundsMin, boundsMax)
+
+    nearAxis = np.argmax(tMin, axis = -1)
+    farAxis = np.argmin(tMax, axis = -1)
+    tNear = np.take_along_axis(tMin, nearAxis[..., None], axis = -1)[..., 0]
+    tFar = np.take_along_axis(tMax, farAxis[..., None], axis = -1)[..., 0]
+
+    return tNear, tFar, nearAxis, farAxis
+
+
+def slabTest(orig, invDir, boundsMin, boundsMax, tMax):
+    # Whether the ray goes through the box somewhere between 0 and tMax
+    hit = slabIntersect(orig, invDir, boundsMin, boundsMax)
+    return hit is not None and hit[1] >= 0 and hit[0] <= tMax
+
+
+def slabTestMany(origs, invDirs, boundsMin, boundsMax, tMax):
+    # Without the axes, which take most of the time of slabIntersectMany
+    enter, leave = slabSpansMany(origs, invDirs, boundsMin, boundsMax)
+    tNear = enter.max(axis = -1)
+    tFar = leave.min(axis = -1)
+    return (tNear <= tFar) & (tFar >= 0) & (tNear <= tMax)
+
+
+def inverseDirection(dir):
+    return [1 / d if d != 0 else float('inf') for d in dir]
+
+
+def inverseDirections(dirs):
+    with np.errstate(divide = 'ignore'):
+        invDirs = 1 / dirs
+    invDirs[dirs == 0] = np.inf
+    return invDirs
+
+
+class BVH(object):
+    # Bounding volume hierarchy over a set of boxes, built with the surface
+    # area heuristic. It only finds the leaves a ray may hit; testing the
+    # primitives in them is left to whoever owns the primitives.
+
+    def __init__(self, boundsMin, boundsMax, leafSize = LEAF_SIZE):
+        boundsMin = np.asarray(boundsMin, dtype = float).reshape(-1, 3) - BOUNDS_PADDING
+        boundsMax = np.asarray(boundsMax, dtype = float).reshape(-1, 3) + BOUNDS_PADDING
+
+        self.leafSize = leafSize
+
+        self.nodeMin = []
+        self.nodeMax = []
+        self.nodeLeft = []
+        self.nodeRight = []
+        self.nodeAxis = []
+        self.nodeStart = []
+        self.nodeCount = []
+
+        # Primitive indices, leaf by leaf
+        self.order = []
+
+        if len(boundsMin):
+            centroids = (boundsMin + boundsMax) / 2
+            self.build(np.arange(len(boundsMin)), boundsMin, boundsMax, centroids)
+
+        self.nodeMin = np.array(self.nodeMin).reshape(-1, 3)
+        self.nodeMax = np.array(self.nodeMax).reshape(-1, 3)
+        self.order = np.array(self.order, dtype = int)
+        self.area = surfaceArea(self.nodeMin, self.nodeMax).sum()
+
+        # Plain list copies for the per-ray traversal, where NumPy calls on
+        # 3-element arrays cost more than the math
+        self.nodeMinList = self.nodeMin.tolist()
+        self.nodeMaxList = self.nodeMax.tolist()
+        self.orderList = self.order.tolist()
+
+    def refit(self, boundsMin, boundsMax):
+        # Moves the boxes of the nodes to new bounds of the same primitives,
+        # keeping the tree. Children always come after their parent, so
+        # going backwards every child is done before its parent needs it.
+        # Returns False if the tree got too loose to keep, when it should
+        # be built again.
+        boundsMin = np.asarray(boundsMin, dtype = float).reshape(-1, 3) - BOUNDS_PADDING
+        boundsMax = np.asarray(boundsMax, dtype = float).reshape(-1, 3) + BOUNDS_PADDING
+
+        for node in range(len(self.nodeMin) - 1, -1, -1):
+            left = self.nodeLeft[node]
+            if left < 0:
+                start = self.nodeStart[node]
+                prims = self.order[start:start + self.nodeCount[node]]
+                self.nodeMin[node] = boundsMin[prims].min(axis = 0)
+                self.nodeMax[node] = boundsMax[prims].max(axis = 0)
+            else:
+                right = self.nodeRight[node]
+                self.nodeMin[node] = np.minimum(self.nodeMin[left], self.nodeMin[right])
+                self.nodeMax[node] = np.maximum(self.nodeMax[left], self.nodeMax[right])
+
+        self.nodeMinList = self.nodeMin.tolist()
+        self.nodeMaxList = self.nodeMax.tolist()
+
+        return surfaceArea(self.nodeMin, self.nodeMax).sum() <= self.area * REFIT_GROWTH
+
+    def addNode(self, boundsMin, boundsMax):
+        self.nodeMin.append(boundsMin)
+        self.nodeMax.append(boundsMax)
+        self.nodeLeft.append(-1)
+        self.nodeRight.append(-1)
+        self.nodeAxis.append(0)
+        self.nodeStart.append(0)
+        self.nodeCount.append(0)
+        return len(self.nodeMin) - 1
+
+    def build(self, prims, boundsMin, boundsMax, centroids):
+        nodeMin = boundsMin[prims].min(axis = 0)
+        nodeMax = boundsMax[prims].max(axis = 0)
+        node = self.addNode(nodeMin, nodeMax)
+
+        split = self.findSplit(prims, boundsMin, boundsMax, centroids, nodeMin, nodeMax)
+
+        if split is None:
+            self.nodeStart[node] = len(self.order)
+            self.nodeCount[node] = len(prims)
+            self.order.extend(prims.tolist())
+            return node
+
+        axis, left, right = split
+        self.nodeAxis[node] = axis
+        self.nodeLeft[node] = self.build(left, boundsMin, boundsMax, centroids)
+        self.nodeRight[node] = self.build(right, boundsMin, boundsMax, centroids)
+
+        return node
+
+    def findSplit(self, prims, boundsMin, boundsMax, centroids, nodeMin, nodeMax):
+        count = len(prims)
+        if count <= 1:
+            return None
+
+        bestCost = np.inf
+        best = None
+
+        for axis in range(3):
+            sortedPrims = prims[np.argsort(centroids[prims, axis], kind = 'stable')]
+
+            # Areas of the boxes around the first i and the last count - i
+            # primitives, for every i in 1..count-1
+            leftArea = surfaceArea(np.minimum.accumulate(boundsMin[sortedPrims]),
+                                   np.maximum.accumulate(boundsMax[sortedPrims]))[:-1]
+            rightArea = surfaceArea(np.minimum.accumulate(boundsMin[sortedPrims[::-1]]),
+                                    np.maximum.accumulate(boundsMax[sortedPrims[::-1]]))[::-1][1:]
+
+            leftCount = np.arange(1, count)
+            cost = leftArea * leftCount + rightArea * (count - leftCount)
+
+            i = int(np.argmin(cost))
+            if cost[i] < bestCost:
+                bestCost = cost[i]
+                best = (axis, sortedPrims[:i + 1], sortedPrims[i + 1:])
+
+        area = surfaceArea(nodeMin, nodeMax)
+        if area > 0:
+            bestCost = TRAVERSAL_COST + bestCost / area
+        else:
+            bestCost = TRAVERSAL_COST + count
+
+        if count <= self.leafSize and bestCost >= count:
+            return None
+
+        return best
+
+    def traverse(self, orig, dir, tMax, visitLeaf):
+        # Calls visitLeaf(prims, tMax) for every leaf the ray may hit before
+        # tMax, nearest child first. visitLeaf returns the new tMax.
+        if not self.orderList:
+            return tMax
+
+        orig = [float(o) for o in orig]
+        dir = [float(d) for d in dir]
+        invDir = inverseDirection(dir)
+        stack = [0]
+
+        while stack:
+            node = stack.pop()
+
+            if not slabTest(orig, invDir, self.nodeMinList[node], self.nodeMaxList[node], tMax):
+                continue
+
+            left = self.nodeLeft[node]
+            if left < 0:
+                start = self.nodeStart[node]
+                tMax = visitLeaf(self.orderList[start:start + self.nodeCount[node]], tMax)
+            elif dir[self.nodeAxis[node]] > 0:
+                stack.append(self.nodeRight[node])
+                stack.append(left)
+            else:
+                stack.append(left)
+                stack.append(self.nodeRight[node])
+
+        return tMax
+
+    def traverseAny(self, orig, dir, tMax, visitLeaf):
+        # Like traverse, but stops at the first leaf for which
+        # visitLeaf(prims) returns something other than None, and returns it
+        if not self.orderList:
+            return None
+
+        orig = [float(o) for o in orig]
+        dir = [float(d) for d in dir]
+        invDir = inverseDirection(dir)
+        stack = [0]
+
+        while stack:
+            node = stack.pop()
+
+            if not slabTest(orig, invDir, self.nodeMinList[node], self.nodeMaxList[node], tMax):
+                continue
+
+            left = self.nodeLeft[node]
+            if left < 0:
+                start = self.nodeStart[node]
+                hit = visitLeaf(self.orderList[start:start + self.nodeCount[node]])
+                if hit is not None:
+                    return hit
+            else:
+                stack.append(self.nodeRight[node])
+                stack.append(left)
+
+        return None
+
+    def traverseMany(self, origs, dirs, tMax, visitLeaf):
+        # Batched traverse: every node is tested against the rays that
+        # reached it. visitLeaf(prims, rays) updates tMax[rays] in place.
+        if not self.orderList:
+            return
+
+        invDirs = inverseDirections(dirs)
+        stack = [(0, np.arange(len(dirs)))]
+
+        while stack:
+            node, rays = stack.pop()
+
+            inside = slabTestMany(origs[rays], invDirs[rays], self.nodeMin[node], self.nodeMax[node], tMax[rays])
+            rays = rays[inside]
+            if len(rays) == 0:
+                continue
+
+            left = self.nodeLeft[node]
+            if left < 0:
+                start = self.nodeStart[node]
+                visitLeaf(self.orderList[start:start + self.nodeCount[node]], rays)
+            else:
+                stack.append((self.nodeRight[node], rays))
+                stack.append((left, rays))
@@ -0,0 +1,224 @@
+import numpy as np
+from figures import *
+from bvh import slabSpansMany, slabIntersectMany, inverseDirections
+
+# Kinds of object a CompiledScene keeps arrays for. Any other object, like
+# a Mesh, is left to its own ray_intersect_many.
+SPHERE = 0
+PLANE = 1
+DISK = 2
+BOX = 3
+OBJECT = 4
+
+KINDS = {Sphere: SPHERE, Plane: PLANE, Disk: DISK, AABB: BOX}
+
+
+class CompiledScene(object):
+    # A scene as contiguous arrays, one set per kind of object, plus a
+    # table of its materials, for the batched intersection and shading
+    # code. Objects are referred to by their index in the scene, which
+    # kinds and slots map to the kind of object and its row in the arrays
+    # of that kind. The geometry is built again whenever the scene
+    # changes; the materials, which are cheap to gather and often edited
+    # in place, with updateMaterials before every batch of rays.
+
+    def __init__(self, scene):
+        count = len(scene)
+
+        self.kinds = np.full(count, OBJECT)
+        self.slots = np.zeros(count, dtype = int)
+
+        # Texcoords per unit of surface, or NaN where there is none
+        self.texScales = np.full(count, np.nan)
+
+        spheres = []
+        planes = []
+        disks = []
+        boxes = []
+
+        for i, obj in enumerate(scene):
+            texScale = obj.getTexScale() if hasattr(obj, 'getTexScale') else None
+            if texScale is not None:
+                self.texScales[i] = texScale
+
+            kind = KINDS.get(type(obj), OBJECT)
+            self.kinds[i] = kind
+
+            group = {SPHERE: spheres, PLANE: planes, DISK: disks, BOX: boxes}.get(kind)
+            if group is not None:
+                self.slots[i] = len(group)
+                group.append(obj)
+
+        self.updateMaterials(scene)
+
+        self.sphereCenters = np.array([s.center for s in spheres], dtype = float).reshape(-1, 3)
+        self.sphereRadii = np.array([s.radius for s in spheres], dtype = float)
+
+        self.planePositions = np.array([p.position for p in planes], dtype = float).reshape(-1, 3)
+        self.planeNormals = np.array([p.normal for p in planes], dtype = float).reshape(-1, 3)
+
+        self.diskPositions = np.array([d.plane.position for d in disks], dtype = float).reshape(-1, 3)
+        self.diskNormals = np.array([d.plane.normal for d in disks], dtype = float).reshape(-1, 3)
+        self.diskRadii = np.array([d.radius for d in disks], dtype = float)
+
+        self.boxFaceMin = np.array([b.faceMin for b in boxes], dtype = float).reshape(-1, 3)
+        self.boxFaceMax = np.array([b.faceMax for b in boxes], dtype = float).reshape(-1, 3)
+        self.boxBoundsMin = np.array([b.boundsMin for b in boxes], dtype = float).reshape(-1, 3)
+        self.boxSizes = np.array([b.size for b in boxes], dtype = float).reshape(-1, 3)
+
+    def updateMaterials(self, scene):
+        # Material table, and the row of every object in it
+        materials = []
+        materialRows = {}
+        self.materials = np.zeros(len(scene), dtype = int)
+
+        for i, obj in enumerate(scene):
+            material = obj.material
+            if id(material) not in materialRows:
+                materialRows[id(material)] = len(materials)
+                materials.append(material)
+            self.materials[i] = materialRows[id(material)]
+
+        self.diffuses = np.array([m.diffuse for m in materials], dtype = float).reshape(-1, 3)
+        self.specs = np.array([m.spec for m in materials], dtype = float)
+        self.iors = np.array([m.ior for m in materials], dtype = float)
+        self.matTypes = np.array([m.matType for m in materials], dtype = int)
+        self.textures = [m.texture for m in materials]
+
+        # Objects with a texture, which are looked up one object at a time
+        self.textured = [i for i, obj in enumerate(scene) if obj.material.texture]
+
+    def distances(self, objs, origs, dirs):
+        # Distance along every ray to every one of the objects at the scene
+        # indices objs, none of them an OBJECT, as a (rays, objs) array
+        # with inf where a ray misses
+        t = np.empty((len(dirs), len(objs)))
+
+        kinds = self.kinds[objs]
+        slots = self.slots[objs]
+
+        for kind, kernel in ((SPHERE, self.sphereDistances),
+                             (PLANE, self.planeDistances),
+                             (DISK, self.diskDistances),
+                             (BOX, self.boxDistances)):
+            columns = np.nonzero(kinds == kind)[0]
+            if len(columns):
+                t[:, columns] = kernel(slots[columns], origs, dirs)
+
+        return t
+
+    def sphereDistances(self, slots, origs, dirs):
+        # Same steps as Sphere.ray_intersect_many, for all the spheres at once
+        centers = self.sphereCenters[slots]
+        radii = self.sphereRadii[slots]
+
+        with np.errstate(invalid = 'ignore'):
+            L = centers - origs[:, None]
+            tca = np.sum(L * dirs[:, None], axis = 2)
+            d = (np.sum(L * L, axis = 2) - tca ** 2) ** 0.5
+
+            thc = (radii ** 2 - d ** 2) ** 0.5
+
+            t0 = tca - thc
+            t1 = tca + thc
+            t0 = np.where(t0 < 0, t1, t0)
+
+            t0[~(t0 >= 0) | (d > radii)] = np.inf
+
+        return t0
+
+    def planeT(self, position, normal, origs, dirs):
+        # Distance to one plane, as Plane.ray_intersect_many finds it
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            denom = np.dot(dirs, normal)
+            num = np.dot(np.subtract(position, origs), normal)
+            t = num / denom
+
+            t[(np.abs(denom) <= 0.0001) | ~(t > 0)] = np.inf
+
+        return t
+
+    def planeDistances(self, slots, origs, dirs):
+        # Plane by plane, as one matrix product would round the dot
+        # products differently from the single object code
+        t = np.empty((len(dirs), len(slots)))
+        for column, slot in enumerate(slots):
+            t[:, column] = self.planeT(self.planePositions[slot], self.planeNormals[slot], origs, dirs)
+
+        return t
+
+    def diskDistances(self, slots, origs, dirs):
+        t = np.empty((len(dirs), len(slots)))
+        for column, slot in enumerate(slots):
+            position = self.diskPositions[slot]
+            planeT = self.planeT(position, self.diskNormals[slot], origs, dirs)
+
+            with np.errstate(invalid = 'ignore'):
+                points = origs + planeT[:, None] * dirs
+
+            contact = np.linalg.norm(np.subtract(points, position), axis = 1)
+            t[:, column] = np.where(contact > self.diskRadii[slot], np.inf, planeT)
+
+        return t
+
+    def boxDistances(self, slots, origs, dirs):
+        enter, leave = slabSpansMany(origs[:, None], inverseDirections(dirs)[:, None],
+                                     self.boxFaceMin[slots], self.boxFaceMax[slots])
+        tNear = enter.max(axis = 2)
+        tFar = leave.min(axis = 2)
+
+        t = np.where(~(tNear > 0), tFar, tNear)
+        t[(tNear > tFar) | ~(t > 0)] = np.inf
+
+        return t
+
+    def surface(self, objs, origs, dirs, t):
+        # Points, normals and texcoords where each ray hits the object at
+        # its scene index in objs, none of them an OBJECT, t along it
+        with np.errstate(invalid = 'ignore'):
+            points = origs + t[:, None] * dirs
+
+        normals = np.zeros(points.shape)
+        texcoords = np.full((len(dirs), 2), np.nan)
+
+        kinds = self.kinds[objs]
+        slots = self.slots[objs]
+
+        rays = np.nonzero(kinds == SPHERE)[0]
+        if len(rays):
+            sphereNormals = np.subtract(points[rays], self.sphereCenters[slots[rays]])
+            sphereNormals = sphereNormals / np.linalg.norm(sphereNormals, axis = 1)[:, None]
+            normals[rays] = sphereNormals
+
+            with np.errstate(invalid = 'ignore'):
+                texcoords[rays, 0] = 1 - ((np.arctan2(sphereNormals[:, 2], sphereNormals[:, 0]) / (2 * np.pi)) + 0.5)
+                texcoords[rays, 1] = np.arccos(-sphereNormals[:, 1]) / np.pi
+
+        rays = np.nonzero(kinds == PLANE)[0]
+        normals[rays] = self.planeNormals[slots[rays]]
+
+        rays = np.nonzero(kinds == DISK)[0]
+        normals[rays] = self.diskNormals[slots[rays]]
+
+        rays = np.nonzero(kinds == BOX)[0]
+        if len(rays):
+            boxes = slots[rays]
+            boxDirs = dirs[rays]
+            tNear, tFar, nearAxis, farAxis = slabIntersectMany(origs[rays], inverseDirections(boxDirs),
+                                                               self.boxFaceMin[boxes], self.boxFaceMax[boxes])
+
+            leaving = ~(tNear > 0)
+            axis = np.where(leaving, farAxis, nearAxis)
+
+            rows = np.arange(len(rays))
+            boxNormals = np.zeros((len(rays), 3))
+            boxNormals[rows, axis] = np.where((boxDirs[rows, axis] > 0) == leaving, 1, -1)
+            normals[rays] = boxNormals
+
+            faceAxes = np.array(FACE_AXES)[axis]
+            boundsMin = self.boxBoundsMin[boxes]
+            sizes = self.boxSizes[boxes]
+            texcoords[rays] = ((points[rays][rows[:, None], faceAxes] - boundsMin[rows[:, None], faceAxes]) /
+                               sizes[rows[:, None], faceAxes])
+
+        return points, normals, texcoords
@@ -1,4 +1,7 @@
 import numpy as np
+from math import sqrt, atan2, acos, pi
+from matesRS import Vec3, vec3, inversa, transposeMatrix, transformPoint, transformDirection
+from bvh import BVH, slabIntersect, slabIntersectMany, inverseDirection, inverseDirections
 
 WHITE = (1,1,1)
 BLACK = (0,0,0)
@@ -7,6 +10,9 @@ OPAQUE = 0
 REFLECTIVE = 1
 TRANSPARENT = 2
 
+# Axes a box face's texcoords run along, by the axis of its normal
+FACE_AXES = ((1, 2), (0, 2), (0, 1))
+
 
 class Intersect(object):
     def __init__(self, distance, point, normal, texcoords, sceneObj):
@@ -16,6 +22,47 @@ class Intersect(object):
         self.texcoords = texcoords
         self.sceneObj = sceneObj
 
+class Intersects(object):
+    # Batched Intersect, one row per ray. Rays where hit is False missed:
+    # their distance is inf and the rest of their row is meaningless.
+    def __init__(self, distance, point, normal, texcoords, sceneObj):
+        self.distance = distance
+        self.point = point
+        self.normal = normal
+        self.texcoords = texcoords
+        self.sceneObj = sceneObj
+        self.hit = distance < np.inf
+
+def rayArrays(origs, dirs):
+    # Either argument may be a single vector shared by every ray
+    origs, dirs = np.broadcast_arrays(np.asarray(origs, dtype = float),
+                                      np.asarray(dirs, dtype = float))
+    return np.atleast_2d(origs), np.atleast_2d(dirs)
+
+def asTuple(v):
+    # Numbers of a vector as a tuple of floats, to compare with a later one
+    return tuple(float(x) for x in v)
+
+def getGeometry(obj):
+    # Snapshot of what the BVH and the compiled scene take from an object.
+    # Objects without a getGeometry of their own are compared by bounds.
+    if hasattr(obj, 'getGeometry'):
+        return obj.getGeometry()
+
+    bounds = obj.getBounds() if hasattr(obj, 'getBounds') else None
+    if bounds is None:
+        return None
+    return asTuple(bounds[0]), asTuple(bounds[1])
+
+def transformMany(m, vectors, w):
+    # Rows of vectors times the 4x4 matrix m as points (w = 1) or
+    # directions (w = 0), summed in the order of transformPoint and
+    # transformDirection
+    rows = [vectors[:, 0] * m[i][0] + vectors[:, 1] * m[i][1] + vectors[:, 2] * m[i][2] for i in range(3)]
+    if w:
+        rows = [rows[i] + m[i][3] for i in range(3)]
+    return np.stack(rows, axis = 1)
+
 class Material(object):
     def __init__(self, diffuse = WHITE, spec = 1.0, ior = 1.0, texture = None, matType = OPAQUE):
         self.diffuse = diffuse
@@ -31,15 +78,30 @@ class Sphere(object):
         self.radius = radius
         self.material = material
 
+    def getBounds(self):
+        return (np.subtract(self.center, self.radius),
+                np.add(self.center, self.radius))
+
+    def getGeometry(self):
+        return asTuple(self.center), float(self.radius)
+
+    def getTexScale(self):
+        # Most texcoords one unit of surface spans; v runs pole to pole
+        return 1 / (np.pi * self.radius)
+
     def ray_intersect(self, orig, dir):
-        L = np.subtract(self.center, orig)
-        tca = np.dot(L, dir)
-        d = (np.linalg.norm(L) ** 2 - tca ** 2) ** 0.5
+        orig = vec3(orig)
+        dir = vec3(dir)
+        center = vec3(self.center)
+
+        L = center - orig
+        tca = L.dot(dir)
+        d = sqrt(max(0, L.dot(L) - tca * tca))
 
         if d > self.radius:
             return None
 
-        thc = (self.radius ** 2 - d ** 2) ** 0.5
+        thc = sqrt(self.radius * self.radius - d * d)
 
         t0 = tca - thc
         t1 = tca + thc
@@ -50,12 +112,11 @@ class Sphere(object):
             return None
         
         # P = O + t0 * D
-        P = np.add(orig, t0 * np.array(dir))
-        normal = np.subtract(P, self.center)
-        normal = normal / np.linalg.norm(normal)
+        P = orig.along(dir, t0)
+        normal = (P - center).normalized()
 
-        u = 1 - ((np.arctan2(normal[2], normal[0]) / (2 * np.pi)) + 0.5)
-        v = np.arccos(-normal[1]) / np.pi
+        u = 1 - ((atan2(normal.z, normal.x) / (2 * pi)) + 0.5)
+        v = acos(-normal.y) / pi
 
         uvs = (u,v)
 
@@ -65,6 +126,57 @@ class Sphere(object):
                          texcoords = uvs,
                          sceneObj = self)
 
+    def ray_occluded(self, orig, dir, maxDistance):
+        # Whether the sphere is hit closer than maxDistance, on plain floats
+        Lx = self.center[0] - orig[0]
+        Ly = self.center[1] - orig[1]
+        Lz = self.center[2] - orig[2]
+
+        tca = Lx * dir[0] + Ly * dir[1] + Lz * dir[2]
+        d2 = Lx * Lx + Ly * Ly + Lz * Lz - tca * tca
+        r2 = self.radius ** 2
+
+        if d2 > r2:
+            return False
+
+        thc = (r2 - max(d2, 0)) ** 0.5
+
+        t0 = tca - thc
+        if t0 < 0:
+            t0 = tca + thc
+
+        return 0 <= t0 < maxDistance
+
+    def ray_intersect_many(self, origs, dirs):
+        origs, dirs = rayArrays(origs, dirs)
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            L = np.subtract(self.center, origs)
+            tca = np.sum(L * dirs, axis = 1)
+            d = (np.sum(L * L, axis = 1) - tca ** 2) ** 0.5
+
+            thc = (self.radius ** 2 - d ** 2) ** 0.5
+
+            t0 = tca - thc
+            t1 = tca + thc
+            t0 = np.where(t0 < 0, t1, t0)
+
+            # Misses, including the NaNs of rays that pass wide of the sphere
+            t0[~(t0 >= 0) | (d > self.radius)] = np.inf
+
+            P = origs + t0[:, None] * dirs
+            normals = np.subtract(P, self.center)
+            normals = normals / np.linalg.norm(normals, axis = 1)[:, None]
+
+            u = 1 - ((np.arctan2(normals[:, 2], normals[:, 0]) / (2 * np.pi)) + 0.5)
+            v = np.arccos(-normals[:, 1]) / np.pi
+
+        return Intersects(distance = t0,
+                          point = P,
+                          normal = normals,
+                          texcoords = np.stack((u, v), axis = 1),
+                          sceneObj = self)
+
 
 class Plane(object):
     def __init__(self, position, normal,  material):
@@ -72,31 +184,87 @@ class Plane(object):
         self.normal = normal / np.linalg.norm(normal)
         self.material = material
 
+    def getBounds(self):
+        # Unbounded
+        return None
+
+    def getGeometry(self):
+        return asTuple(self.position), asTuple(self.normal)
+
     def ray_intersect(self, orig, dir):
         # Distancia = (( planePos - origRayo) o normal) / (direccionRayo o normal)
-        denom = np.dot( dir, self.normal)
+        orig = vec3(orig)
+        dir = vec3(dir)
+        normal = vec3(self.normal)
+        denom = dir.dot(normal)
 
         if abs(denom) > 0.0001:
-            num = np.dot( np.subtract(self.position, orig), self.normal)
+            num = (vec3(self.position) - orig).dot(normal)
             t = num / denom
 
             if t > 0:
                 # P = O + t*D
-                P = np.add(orig, t * np.array(dir))
+                P = orig.along(dir, t)
                 return Intersect(distance = t,
                                  point = P,
-                                 normal = self.normal,
+                                 normal = normal,
                                  texcoords = None,
                                  sceneObj = self)
 
         return None
 
+    def ray_distance(self, orig, dir):
+        # Distance to the plane on plain floats, or None
+        n = self.normal
+        denom = dir[0] * n[0] + dir[1] * n[1] + dir[2] * n[2]
+
+        if abs(denom) > 0.0001:
+            t = ((self.position[0] - orig[0]) * n[0] +
+                 (self.position[1] - orig[1]) * n[1] +
+                 (self.position[2] - orig[2]) * n[2]) / denom
+            if t > 0:
+                return t
+
+        return None
+
+    def ray_occluded(self, orig, dir, maxDistance):
+        t = self.ray_distance(orig, dir)
+        return t is not None and t < maxDistance
+
+    def ray_intersect_many(self, origs, dirs):
+        origs, dirs = rayArrays(origs, dirs)
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            denom = np.dot(dirs, self.normal)
+            num = np.dot(np.subtract(self.position, origs), self.normal)
+            t = num / denom
+
+            t[(np.abs(denom) <= 0.0001) | ~(t > 0)] = np.inf
+
+            P = origs + t[:, None] * dirs
+        normals = np.broadcast_to(self.normal, P.shape)
+
+        return Intersects(distance = t,
+                          point = P,
+                          normal = normals,
+                          texcoords = None,
+                          sceneObj = self)
+
 class Disk(object):
     def __init__(self, position, radius, normal,  material):
         self.plane = Plane(position, normal, material)
         self.material = material
         self.radius = radius
 
+    def getBounds(self):
+        # Extent of a circle of this radius around its normal, per axis
+        extent = self.radius * np.sqrt(np.maximum(0, 1 - self.plane.normal ** 2))
+        return (np.subtract(self.plane.position, extent),
+                np.add(self.plane.position, extent))
+
+    def getGeometry(self):
+        return self.plane.getGeometry(), float(self.radius)
+
     def ray_intersect(self, orig, dir):
 
         intersect = self.plane.ray_intersect(orig, dir)
@@ -104,18 +272,41 @@ class Disk(object):
         if intersect is None:
             return None
 
-        contact = np.subtract(intersect.point, self.plane.position)
-        contact = np.linalg.norm(contact)
+        contact = (intersect.point - vec3(self.plane.position)).length()
 
         if contact > self.radius:
             return None
 
         return Intersect(distance = intersect.distance,
                          point = intersect.point,
-                         normal = self.plane.normal,
+                         normal = intersect.normal,
                          texcoords = None,
                          sceneObj = self)
 
+    def ray_occluded(self, orig, dir, maxDistance):
+        t = self.plane.ray_distance(orig, dir)
+        if t is None or t >= maxDistance:
+            return False
+
+        position = self.plane.position
+        cx = orig[0] + t * dir[0] - position[0]
+        cy = orig[1] + t * dir[1] - position[1]
+        cz = orig[2] + t * dir[2] - position[2]
+
+        return (cx * cx + cy * cy + cz * cz) ** 0.5 <= self.radius
+
+    def ray_intersect_many(self, origs, dirs):
+        intersects = self.plane.ray_intersect_many(origs, dirs)
+
+        contact = np.linalg.norm(np.subtract(intersects.point, self.plane.position), axis = 1)
+        distance = np.where(contact > self.radius, np.inf, intersects.distance)
+
+        return Intersects(distance = distance,
+                          point = intersects.point,
+                          normal = intersects.normal,
+                          texcoords = None,
+                          sceneObj = self)
+
 
 
 
@@ -127,25 +318,15 @@ class AABB(object):
         self.size = size
         self.material = material
 
-        self.planes = []
-
         halfSizes = [0,0,0]
 
         halfSizes[0] = size[0] / 2
         halfSizes[1] = size[1] / 2
         halfSizes[2] = size[2] / 2
 
-        # Sides
-        self.planes.append( Plane( np.add(position, (halfSizes[0],0,0)), (1,0,0), material ))
-        self.planes.append( Plane( np.add(position, (-halfSizes[0],0,0)), (-1,0,0), material ))
-
-        # Up and Down
-        self.planes.append( Plane( np.add(position, (0,halfSizes[1],0)), (0,1,0), material ))
-        self.planes.append( Plane( np.add(position, (0,-halfSizes[1],0)), (0,-1,0), material ))
-
-        # Front and back
-        self.planes.append( Plane( np.add(position, (0,0,halfSizes[2])), (0,0,1), material ))
-        self.planes.append( Plane( np.add(position, (0,0,-halfSizes[2])), (0,0,-1), material ))
+        # Faces
+        self.faceMin = [position[i] - halfSizes[i] for i in range(3)]
+        self.faceMax = [position[i] + halfSizes[i] for i in range(3)]
 
         #Bounds
         self.boundsMin = [0,0,0]
@@ -157,51 +338,372 @@ class AABB(object):
             self.boundsMin[i] = self.position[i] - (epsilon + halfSizes[i])
             self.boundsMax[i] = self.position[i] + (epsilon + halfSizes[i])
 
+    def getBounds(self):
+        return self.boundsMin, self.boundsMax
+
+    def getGeometry(self):
+        return (asTuple(self.faceMin), asTuple(self.faceMax), asTuple(self.boundsMin),
+                asTuple(self.boundsMax), asTuple(self.size))
+
+    def getTexScale(self):
+        # Every face spans the texture once
+        return 1 / min(self.size)
 
     def ray_intersect(self, orig, dir):
-        intersect = None
-        t = float('inf')
+        orig = [float(o) for o in orig]
+        dir = [float(d) for d in dir]
+
+        slab = slabIntersect(orig, inverseDirection(dir), self.faceMin, self.faceMax)
+        if slab is None:
+            return None
+
+        tNear, tFar, nearAxis, farAxis = slab
+
+        # From outside the ray hits the face it enters through, from inside
+        # the one it leaves through
+        if tNear > 0:
+            t, axis, leaving = tNear, nearAxis, False
+        elif tFar > 0:
+            t, axis, leaving = tFar, farAxis, True
+        else:
+            return None
 
-        for plane in self.planes:
-            planeInter = plane.ray_intersect(orig, dir)
-            if planeInter is not None:
+        normal = [0.0, 0.0, 0.0]
+        normal[axis] = 1.0 if (dir[axis] > 0) == leaving else -1.0
 
-                planePoint = planeInter.point
+        # P = O + t*D
+        P = [orig[0] + t * dir[0],
+             orig[1] + t * dir[1],
+             orig[2] + t * dir[2]]
 
-                if self.boundsMin[0] <= planePoint[0] <= self.boundsMax[0]:
-                    if self.boundsMin[1] <= planePoint[1] <= self.boundsMax[1]:
-                        if self.boundsMin[2] <= planePoint[2] <= self.boundsMax[2]:
+        # Tex Coords, from the two axes along the face
+        a, b = FACE_AXES[axis]
+        u = (P[a] - self.boundsMin[a]) / self.size[a]
+        v = (P[b] - self.boundsMin[b]) / self.size[b]
 
-                            if planeInter.distance < t:
-                                t = planeInter.distance
-                                intersect = planeInter
+        return Intersect(distance = t,
+                         point = Vec3(*P),
+                         normal = Vec3(*normal),
+                         texcoords = (u,v),
+                         sceneObj = self)
 
-                                # Tex Coords
+    def ray_occluded(self, orig, dir, maxDistance):
+        slab = slabIntersect(orig, inverseDirection(dir), self.faceMin, self.faceMax)
+        if slab is None:
+            return False
 
-                                u, v = 0, 0
+        tNear, tFar, _, _ = slab
+        t = tNear if tNear > 0 else tFar
 
-                                # Las uvs de las caras de los lados
-                                if abs(plane.normal[0]) > 0:
-                                    # Mapear uvs para el eje x, usando las coordenadas de Y y Z
-                                    u = (planeInter.point[1] - self.boundsMin[1]) / self.size[1]
-                                    v = (planeInter.point[2] - self.boundsMin[2]) / self.size[2]
+        return 0 < t < maxDistance
 
-                                elif abs(plane.normal[1] > 0):
-                                    # Mapear uvs para el eje y, usando las coordenadas de X y Z
-                                    u = (planeInter.point[0] - self.boundsMin[0]) / self.size[0]
-                                    v = (planeInter.point[2] - self.boundsMin[2]) / self.size[2]
+    def ray_intersect_many(self, origs, dirs):
+        origs, dirs = rayArrays(origs, dirs)
 
-                                elif abs(plane.normal[2] > 0):
-                                    # Mapear uvs para el eje z, usando las coordenadas de X y Y
-                                    u = (planeInter.point[0] - self.boundsMin[0]) / self.size[0]
-                                    v = (planeInter.point[1] - self.boundsMin[1]) / self.size[1]
+        tNear, tFar, nearAxis, farAxis = slabIntersectMany(origs, inverseDirections(dirs),
+                                                           self.faceMin, self.faceMax)
 
+        leaving = ~(tNear > 0)
+        t = np.where(leaving, tFar, tNear)
+        axis = np.where(leaving, farAxis, nearAxis)
+        t[(tNear > tFar) | ~(t > 0)] = np.inf
 
-        if intersect is None:
+        rays = np.arange(len(dirs))
+        normals = np.zeros((len(dirs), 3))
+        normals[rays, axis] = np.where((dirs[rays, axis] > 0) == leaving, 1, -1)
+
+        with np.errstate(invalid = 'ignore'):
+            points = origs + t[:, None] * dirs
+
+        faceAxes = np.array(FACE_AXES)[axis]
+        boundsMin = np.array(self.boundsMin)
+        size = np.array(self.size, dtype = float)
+        uvs = (points[rays[:, None], faceAxes] - boundsMin[faceAxes]) / size[faceAxes]
+
+        return Intersects(distance = t,
+                          point = points,
+                          normal = normals,
+                          texcoords = uvs,
+                          sceneObj = self)
+
+
+class Mesh(object):
+    # Triangle mesh from an Obj, kept as flat arrays behind its own BVH
+
+    def __init__(self, obj, material, position = (0,0,0), scale = (1,1,1)):
+        self.material = material
+
+        self.vertices = np.asarray(obj.vertices, dtype = float) * scale + position
+        self.vertIdx = np.asarray(obj.vertIdx)
+
+        self.texcoords = None
+        self.texIdx = None
+        if len(obj.texcoords) and np.all(obj.texIdx >= 0):
+            self.texcoords = np.asarray(obj.texcoords, dtype = float)
+            self.texIdx = np.asarray(obj.texIdx)
+
+        self.normals = None
+        self.normalIdx = None
+        if len(obj.normals) and np.all(obj.normalIdx >= 0):
+            # Normals follow the inverse scale
+            normals = np.asarray(obj.normals, dtype = float) / scale
+            self.normals = normals / np.linalg.norm(normals, axis = 1)[:, None]
+            self.normalIdx = np.asarray(obj.normalIdx)
+
+        # Corner and edges of every triangle for the intersection test
+        self.v0 = self.vertices[self.vertIdx[:, 0]]
+        self.e1 = self.vertices[self.vertIdx[:, 1]] - self.v0
+        self.e2 = self.vertices[self.vertIdx[:, 2]] - self.v0
+
+        faceNormals = np.cross(self.e1, self.e2)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            self.faceNormals = faceNormals / np.linalg.norm(faceNormals, axis = 1)[:, None]
+
+        corners = self.vertices[self.vertIdx]
+        self.bvh = BVH(corners.min(axis = 1), corners.max(axis = 1))
+
+        # Texcoords per unit of surface, from the area the triangles cover
+        # in each
+        self.texScale = None
+        if self.texcoords is not None:
+            uvs = self.texcoords[self.texIdx]
+            du = uvs[:, 1] - uvs[:, 0]
+            dv = uvs[:, 2] - uvs[:, 0]
+            uvArea = np.abs(du[:, 0] * dv[:, 1] - du[:, 1] * dv[:, 0]).sum()
+            area = np.linalg.norm(np.cross(self.e1, self.e2), axis = 1).sum()
+            if area > 0:
+                self.texScale = (uvArea / area) ** 0.5
+
+    def getBounds(self):
+        return self.vertices.min(axis = 0), self.vertices.max(axis = 0)
+
+    def getGeometry(self):
+        # The triangle arrays and their BVH are built once and never
+        # edited, so they are compared by identity, not by content
+        return id(self.vertices), id(self.vertIdx)
+
+    def getTexScale(self):
+        return self.texScale
+
+    def triangle_intersect(self, tris, origs, dirs):
+        # Moller-Trumbore: distance and barycentric (u, v) of every ray
+        # against the triangle on its row, inf where it misses
+        e1 = self.e1[tris]
+        e2 = self.e2[tris]
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            pvec = np.cross(dirs, e2)
+            det = np.sum(e1 * pvec, axis = -1)
+            invDet = 1 / det
+
+            tvec = origs - self.v0[tris]
+            u = np.sum(tvec * pvec, axis = -1) * invDet
+
+            qvec = np.cross(tvec, e1)
+            v = np.sum(dirs * qvec, axis = -1) * invDet
+
+            t = np.sum(e2 * qvec, axis = -1) * invDet
+
+            miss = (np.abs(det) < 1e-12) | ~(u >= 0) | ~(v >= 0) | ~(u + v <= 1) | ~(t > 0)
+        t = np.where(miss, np.inf, t)
+
+        return t, u, v
+
+    def surface(self, tris, u, v):
+        # Normals and texcoords at barycentric (u, v), weighted like baryCoords
+        w = 1 - u - v
+
+        if self.normals is None:
+            normals = self.faceNormals[tris]
+        else:
+            corners = self.normals[self.normalIdx[tris]]
+            normals = corners[:, 0] * w[:, None] + corners[:, 1] * u[:, None] + corners[:, 2] * v[:, None]
+            normals = normals / np.linalg.norm(normals, axis = 1)[:, None]
+
+        texcoords = None
+        if self.texcoords is not None:
+            corners = self.texcoords[self.texIdx[tris]]
+            texcoords = corners[:, 0] * w[:, None] + corners[:, 1] * u[:, None] + corners[:, 2] * v[:, None]
+
+        return normals, texcoords
+
+    def ray_intersect(self, orig, dir):
+        orig = np.array(list(orig), dtype = float)
+        dir = np.array(list(dir), dtype = float)
+
+        best = [None, 0, 0]
+
+        def visitLeaf(prims, depth):
+            t, u, v = self.triangle_intersect(prims, orig, dir)
+            i = int(np.argmin(t))
+            if t[i] < depth:
+                best[:] = [prims[i], u[i], v[i]]
+                depth = t[i]
+            return depth
+
+        t = self.bvh.traverse(orig, dir, float('inf'), visitLeaf)
+
+        if best[0] is None:
             return None
 
+        tri, u, v = best
+        normals, texcoords = self.surface(np.array([tri]), np.array([u]), np.array([v]))
+
         return Intersect(distance = t,
-                         point = intersect.point,
-                         normal = intersect.normal,
-                         texcoords = (u,v),
+                         point = vec3(np.add(orig, t * dir)),
+                         normal = vec3(normals[0]),
+                         texcoords = None if texcoords is None else tuple(texcoords[0]),
+                         sceneObj = self)
+
+    def ray_occluded(self, orig, dir, maxDistance):
+        orig = np.asarray(orig, dtype = float)
+        dir = np.asarray(dir, dtype = float)
+
+        def visitLeaf(prims):
+            t, _, _ = self.triangle_intersect(prims, orig, dir)
+            return True if np.any(t < maxDistance) else None
+
+        return self.bvh.traverseAny(orig, dir, maxDistance, visitLeaf) is not None
+
+    def ray_intersect_many(self, origs, dirs):
+        origs, dirs = rayArrays(origs, dirs)
+
+        t = np.full(len(dirs), np.inf)
+        tris = np.zeros(len(dirs), dtype = int)
+        u = np.zeros(len(dirs))
+        v = np.zeros(len(dirs))
+
+        def visitLeaf(prims, rays):
+            prims = np.array(prims)
+            leafT, leafU, leafV = self.triangle_intersect(prims[None, :], origs[rays, None], dirs[rays, None])
+
+            nearest = np.argmin(leafT, axis = 1)
+            leafT = leafT[np.arange(len(rays)), nearest]
+            closer = leafT < t[rays]
+
+            closerRays = rays[closer]
+            nearest = nearest[closer]
+            t[closerRays] = leafT[closer]
+            tris[closerRays] = prims[nearest]
+            u[closerRays] = leafU[closer, nearest]
+            v[closerRays] = leafV[closer, nearest]
+
+        self.bvh.traverseMany(origs, dirs, t, visitLeaf)
+
+        with np.errstate(invalid = 'ignore'):
+            points = origs + t[:, None] * dirs
+            normals, texcoords = self.surface(tris, u, v)
+
+        return Intersects(distance = t,
+                          point = points,
+                          normal = normals,
+                          texcoords = texcoords,
+                          sceneObj = self)
+
+
+class Instance(object):
+    # Shared figure, like a Mesh, an AABB or a Sphere, placed in the scene
+    # by a 4x4 object to world matrix, such as one from createObjectMatrix.
+    # Rays are taken into object space by the inverse matrix, so any
+    # number of instances use the memory of one figure. The figure's own
+    # material is used unless the instance is given one.
+
+    def __init__(self, figure, transform, material = None):
+        self.figure = figure
+        self.transform = transform
+        self.material = material or figure.material
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, matrix):
+        # Inverse for the rays, and its transpose for the normals, made
+        # once per matrix
+        self._transform = [[float(value) for value in row] for row in matrix]
+        self.inverse = inversa(self._transform)
+        self.normalMatrix = [list(row) for row in transposeMatrix(self.inverse)]
+
+    def getBounds(self):
+        # Box around the 8 corners of the figure's box, or None if the
+        # figure is unbounded
+        bounds = self.figure.getBounds() if hasattr(self.figure, 'getBounds') else None
+        if bounds is None:
+            return None
+
+        boundsMin = vec3(bounds[0])
+        boundsMax = vec3(bounds[1])
+        corners = np.array([list(transformPoint(self._transform, Vec3(x, y, z)))
+                            for x in (boundsMin.x, boundsMax.x)
+                            for y in (boundsMin.y, boundsMax.y)
+                            for z in (boundsMin.z, boundsMax.z)])
+
+        return corners.min(axis = 0), corners.max(axis = 0)
+
+    def getGeometry(self):
+        # Setting transform is the way to move an instance, as the inverse
+        # is made there
+        return id(self.figure), getGeometry(self.figure), tuple(map(tuple, self._transform))
+
+    def getTexScale(self):
+        # The figure's, over the average scale of the matrix
+        texScale = self.figure.getTexScale() if hasattr(self.figure, 'getTexScale') else None
+        if texScale is None:
+            return None
+
+        scale = abs(np.linalg.det(np.array(self._transform)[:3, :3])) ** (1 / 3)
+        return texScale / scale
+
+    def toObject(self, orig, dir):
+        # Ray in object space, with its direction normalized, and how much
+        # longer a unit of world distance is there
+        orig = transformPoint(self.inverse, vec3(orig))
+        dir = transformDirection(self.inverse, vec3(dir))
+        length = dir.length()
+        return orig, dir / length, length
+
+    def ray_intersect(self, orig, dir):
+        orig = vec3(orig)
+        dir = vec3(dir)
+
+        objOrig, objDir, length = self.toObject(orig, dir)
+
+        hit = self.figure.ray_intersect(objOrig, objDir)
+        if hit is None:
+            return None
+
+        t = hit.distance / length
+        normal = transformDirection(self.normalMatrix, vec3(hit.normal)).normalized()
+
+        return Intersect(distance = t,
+                         point = orig.along(dir, t),
+                         normal = normal,
+                         texcoords = hit.texcoords,
                          sceneObj = self)
+
+    def ray_occluded(self, orig, dir, maxDistance):
+        objOrig, objDir, length = self.toObject(orig, dir)
+        return self.figure.ray_occluded(list(objOrig), list(objDir), maxDistance * length)
+
+    def ray_intersect_many(self, origs, dirs):
+        origs, dirs = rayArrays(origs, dirs)
+
+        objOrigs = transformMany(self.inverse, origs, 1)
+        objDirs = transformMany(self.inverse, dirs, 0)
+        lengths = np.linalg.norm(objDirs, axis = 1)
+
+        hits = self.figure.ray_intersect_many(objOrigs, objDirs / lengths[:, None])
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            t = hits.distance / lengths
+            points = origs + t[:, None] * dirs
+
+            normals = transformMany(self.normalMatrix, np.asarray(hits.normal), 0)
+            normals = normals / np.linalg.norm(normals, axis = 1)[:, None]
+
+        return Intersects(distance = t,
+                          point = points,
+                          normal = normals,
+                          texcoords = hits.texcoords,
+                          sceneObj = self)
@@ -1,18 +1,64 @@
+import os
 import struct
+import weakref
+from time import perf_counter
 from collections import namedtuple
+from multiprocessing import Pool, shared_memory, resource_tracker
 import numpy as np
 from figures import *
 from lights import *
 from math import cos, sin, tan, pi
+from matesRS import Vec3, vec3, createLookAtMatrix, transformDirection
 from obj import Obj
+from texture import CubeMap, NEAREST
+from bvh import BVH
+from compiled import CompiledScene, OBJECT
+from output import openImage, writeImage, HDRWriter
 
 
 STEPS = 1
 MAX_RECURSION_DEPTH = 4
 
-V2 = namedtuple('Point2', ['x', 'y'])
-V3 = namedtuple('Point3', ['x', 'y', 'z'])
-V4 = namedtuple('Point4', ['x', 'y', 'z', 'w'])
+# Bounce rays whose color would weigh less than this in the pixel are not
+# traced. 0 traces them all, which keeps the image exact; a small weight
+# like 0.02 saves many rays on glass at the cost of a few levels on some
+# pixels.
+MIN_RAY_WEIGHT = 0
+
+TILE_SIZE = 32
+
+# Pixel spacing of each pass of glRenderProgressive, coarse to fine
+PROGRESSIVE_STEPS = (8, 4, 2, 1)
+
+# glRenderAdaptive supersamples pixels whose color differs from a
+# neighbour's by more than this in any channel, or that see another object
+AA_THRESHOLD = 0.1
+
+# Supersampled pixels take rounds of AA_GRID by AA_GRID jittered samples,
+# one per cell, until the standard error of their mean color is below
+# AA_TOLERANCE in every channel or they have AA_MAX_SAMPLES rays in all
+AA_GRID = 2
+AA_TOLERANCE = 0.02
+AA_MAX_SAMPLES = 16
+
+# Relative cost of a pixel by the material its primary ray hits, used to
+# order the tiles of glRenderParallel. None is a miss.
+TILE_COSTS = {None: 1, OPAQUE: 2, REFLECTIVE: 8, TRANSPARENT: 32}
+
+# Kinds of rays and stages of a render that RenderStats keeps apart
+RAY_KINDS = ('primary', 'shadow', 'reflection', 'refraction')
+STAGES = ('rays', 'intersect', 'shading', 'texture', 'output')
+
+# Raytracer attributes that may change from one render of a scene to the
+# next, which glRenderParallel sends to its workers with every tile
+CAMERA_ATTRIBUTES = ('width', 'height', 'vpX', 'vpY', 'vpWidth', 'vpHeight', 'camPosition', 'camMatrix', 'fov', 'nearPlane')
+
+# Color ramp of the cost heatmap, cheapest to most expensive pixel
+HEATMAP_COLORS = ((0,0,0), (0,0,1), (1,0,0), (1,1,0), (1,1,1))
+
+V2 = namedtuple('V2', ['x', 'y'])
+V3 = namedtuple('V3', ['x', 'y', 'z'])
+V4 = namedtuple('V4', ['x', 'y', 'z', 'w'])
 
 def char(c):
     #1 byte
@@ -31,6 +77,43 @@ def color(r, g, b):
                   int(g * 255),
                   int(r * 255)] )
 
+def colors(rgb):
+    # Batched color: (N,3) RGB floats to (N,3) BGR bytes
+    return (np.asarray(rgb) * 255).astype(np.uint8)[:, ::-1]
+
+def writeBMP(filename, pixels):
+    # Writes a (height, width, 3) array of BGR bytes as a 24 bit BMP
+    height, width = pixels.shape[:2]
+
+    # Rows of a BMP are padded to a multiple of 4 bytes
+    rowSize = (width * 3 + 3) & ~3
+    data = np.zeros((height, rowSize), dtype = np.uint8)
+    data[:, :width * 3] = pixels.reshape(height, width * 3)
+
+    # Header
+    header = b''.join([char('B'),
+                       char('M'),
+                       dword(14 + 40 + data.size),
+                       dword(0),
+                       dword(14 + 40),
+
+                       #InfoHeader
+                       dword(40),
+                       dword(width),
+                       dword(height),
+                       word(1),
+                       word(24),
+                       dword(0),
+                       dword(data.size),
+                       dword(0),
+                       dword(0),
+                       dword(0),
+                       dword(0)])
+
+    with open(filename, "wb") as file:
+        #Color table
+        file.write(header + data.tobytes())
+
 def baryCoords(A, B, C, P):
 
     areaPBC = (B.y - C.y) * (P.x - C.x) + (C.x - B.x) * (P.y - C.y)
@@ -49,6 +132,193 @@ def baryCoords(A, B, C, P):
     else:
         return u, v, w
 
+def versioned(method):
+    def wrapper(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    return wrapper
+
+class VersionedList(list):
+    # List that counts the changes made to it, so the raytracer knows when
+    # to rebuild what it derives from its objects or lights. Edits to an
+    # item in place are not counted; call changed() after them, though the
+    # raytracer checks the geometry of objects and the color of lights
+    # itself at the start of every render.
+    def __init__(self, objects = ()):
+        super().__init__(objects)
+        self.version = 0
+
+    def changed(self):
+        self.version += 1
+
+    def __reduce__(self):
+        return (VersionedList, (list(self),), self.__dict__)
+
+    append = versioned(list.append)
+    extend = versioned(list.extend)
+    insert = versioned(list.insert)
+    remove = versioned(list.remove)
+    pop = versioned(list.pop)
+    clear = versioned(list.clear)
+    sort = versioned(list.sort)
+    reverse = versioned(list.reverse)
+    __setitem__ = versioned(list.__setitem__)
+    __delitem__ = versioned(list.__delitem__)
+    __iadd__ = versioned(list.__iadd__)
+    __imul__ = versioned(list.__imul__)
+
+class RenderStats(object):
+    # Counters a Raytracer fills in while it renders, when one is set as
+    # its stats attribute; with none set every hook is a single test.
+    # pixelCost holds the seconds spent on every pixel by glRender,
+    # glRenderTile and glRenderAdaptive, in the same layout as the
+    # framebuffer.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixelCost = np.zeros((height, width))
+        self.shm = None
+        self.clear()
+
+    def clear(self):
+        # Resets everything but pixelCost
+        self.rays = dict.fromkeys(RAY_KINDS, 0)
+        self.tests = {}
+        self.depths = {}
+        self.times = dict.fromkeys(STAGES, 0.0)
+
+    def countTests(self, objs, count = 1):
+        # Intersection tests, by type of primitive
+        for obj in objs:
+            name = type(obj).__name__
+            self.tests[name] = self.tests.get(name, 0) + count
+
+    def countDepth(self, depth, count = 1):
+        # Rays traced at this bounce depth
+        self.depths[depth] = self.depths.get(depth, 0) + count
+
+    def lap(self, stage, start):
+        # Adds the time since start to a stage and returns the time now
+        now = perf_counter()
+        self.times[stage] += now - start
+        return now
+
+    def counters(self):
+        return {'rays': self.rays, 'tests': self.tests, 'depths': self.depths, 'times': self.times}
+
+    def merge(self, counters):
+        # Adds the counters of another RenderStats, from counters()
+        for name, values in counters.items():
+            total = getattr(self, name)
+            for key, value in values.items():
+                total[key] = total.get(key, 0) + value
+
+    def report(self):
+        lines = ["Rays:"]
+        lines += ["  {:12} {}".format(kind, count) for kind, count in self.rays.items()]
+        lines.append("Intersection tests:")
+        lines += ["  {:12} {}".format(name, count) for name, count in sorted(self.tests.items())]
+        lines.append("Rays by depth:")
+        lines += ["  {:12} {}".format(depth, count) for depth, count in sorted(self.depths.items())]
+        lines.append("Seconds:")
+        lines += ["  {:12} {:.3f}".format(stage, seconds) for stage, seconds in self.times.items()]
+        return "\n".join(lines)
+
+    def heatmap(self):
+        # pixelCost as BGR bytes, scaled to the most expensive pixel
+        cost = self.pixelCost / max(self.pixelCost.max(), 1e-12)
+        stops = np.linspace(0, 1, len(HEATMAP_COLORS))
+
+        rgb = np.stack([np.interp(cost, stops, channel) for channel in zip(*HEATMAP_COLORS)], axis = 2)
+
+        return colors(rgb.reshape(-1, 3)).reshape(self.height, self.width, 3)
+
+    def saveHeatmap(self, filename):
+        writeBMP(filename, self.heatmap())
+
+    def share(self):
+        # Moves pixelCost into shared memory, like Texture.share, so the
+        # glRenderParallel workers add to the same array
+        if self.shm is not None:
+            return
+
+        self.shm = shared_memory.SharedMemory(create = True, size = self.pixelCost.nbytes)
+        pixelCost = np.ndarray(self.pixelCost.shape, buffer = self.shm.buf)
+        pixelCost[:] = self.pixelCost
+        self.pixelCost = pixelCost
+
+        weakref.finalize(self, self.shm.unlink)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shm is not None:
+            state['pixelCost'] = None
+            state['shm'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shm is not None:
+            self.shm = shared_memory.SharedMemory(name = self.shm)
+            self.pixelCost = np.ndarray((self.height, self.width), buffer = self.shm.buf)
+
+# Per process state of the glRenderParallel workers
+tileWorker = {}
+
+def initTileWorker(raytracer):
+    # Workers send back only what they counted themselves
+    if raytracer.stats is not None:
+        raytracer.stats.clear()
+
+    tileWorker['raytracer'] = raytracer
+    tileWorker['shmName'] = None
+
+def renderTile(task):
+    # Returns the counters of the tile, if the raytracer keeps stats. The
+    # task carries the camera, so one pool of workers can render many
+    # views of the scene it was started with.
+    xs, ys, camera, shmName, wavefront = task
+    raytracer = tileWorker['raytracer']
+
+    for name, value in zip(CAMERA_ATTRIBUTES, camera):
+        setattr(raytracer, name, value)
+
+    if tileWorker['shmName'] != shmName:
+        if tileWorker['shmName'] is not None:
+            del tileWorker['framebuffer']
+            tileWorker['shm'].close()
+
+        shm = shared_memory.SharedMemory(name = shmName)
+        tileWorker['shm'] = shm
+        tileWorker['shmName'] = shmName
+        tileWorker['framebuffer'] = np.ndarray((raytracer.height, raytracer.width, 3),
+                                               dtype = np.uint8, buffer = shm.buf)
+
+    raytracer.glRenderTile(xs, ys, tileWorker['framebuffer'], wavefront)
+
+    if raytracer.stats is not None:
+        counters = raytracer.stats.counters()
+        raytracer.stats.clear()
+        return counters
+
+def renderBand(task):
+    # Rows of the window for glRenderToFile, with the counters of the band
+    # if the raytracer keeps stats
+    ys, camera, wavefront, floats = task
+    raytracer = tileWorker['raytracer']
+
+    for name, value in zip(CAMERA_ATTRIBUTES, camera):
+        setattr(raytracer, name, value)
+
+    pixels, rgb = raytracer.renderRows(ys, wavefront, floats)
+
+    counters = None
+    if raytracer.stats is not None:
+        counters = raytracer.stats.counters()
+        raytracer.stats.clear()
+
+    return pixels, rgb, counters
+
 class Raytracer(object):
     def __init__(self, width, height):
 
@@ -59,11 +329,32 @@ class Raytracer(object):
         self.nearPlane = 0.1
         self.camPosition = V3(0,0,0)
 
+        # Camera to world rotation of the rays, as a 4x4 matrix, or None
+        # to look down -z
+        self.camMatrix = None
+
         self.scene = [ ]
         self.lights = [ ]
 
         self.envMap = None
 
+        # Environment lookups read the equirectangular map directly. With
+        # envCubeMap set they read a cube map resampled from it once, which
+        # is cheaper per ray but blurs the map a little.
+        self.envCubeMap = False
+
+        # RenderStats to fill in while rendering, or None
+        self.stats = None
+
+        # Filter for textures. NEAREST reads the full size texel; BILINEAR
+        # and TRILINEAR MIP map them by the size of a pixel where the ray
+        # hits them, which costs more but keeps distant textures from
+        # aliasing.
+        self.textureFilter = NEAREST
+
+        self.minRayWeight = MIN_RAY_WEIGHT
+        self.russianRoulette = False
+        self.rouletteRng = np.random.default_rng(0)
 
         self.clearColor = color(0,0,0)
         self.currColor = color(1,1,1)
@@ -78,6 +369,25 @@ class Raytracer(object):
         self.vpWidth = width
         self.vpHeight = height
 
+    def lookAt(self, eye, target, up = (0,1,0)):
+        # Places the camera at eye and turns it towards target
+        self.camMatrix = createLookAtMatrix(eye, target, up)
+        self.camPosition = V3(*[float(value) for value in eye])
+
+    def glResize(self, width, height):
+        # New window size for the next render, with the viewport and the
+        # stats covering all of it. Everything derived from the scene stays.
+        self.width = width
+        self.height = height
+        self.glViewport(0,0,self.width, self.height)
+        self.glClear()
+
+        if self.stats is not None:
+            self.stats = RenderStats(width, height)
+
+    def getCamera(self):
+        return tuple(getattr(self, name) for name in CAMERA_ATTRIBUTES)
+
     def glClearColor(self, r, g, b):
         self.clearColor = color(r,g,b)
 
@@ -85,163 +395,1215 @@ class Raytracer(object):
         self.currColor = color(r,g,b)
 
     def glClear(self):
-        self.pixels = [[ self.clearColor for y in range(self.height)]
-                         for x in range(self.width)]
+        # Framebuffer of BGR bytes, indexed [y, x]. A black one is left for
+        # the OS to zero as it is used, so a window only rendered with
+        # glRenderToFile takes no memory.
+        self.pixels = np.zeros((self.height, self.width, 3), dtype = np.uint8)
+        if any(self.clearColor):
+            self.pixels[:, :] = list(self.clearColor)
 
     def glClearViewport(self, clr = None):
-        for x in range(self.vpX, self.vpX + self.vpWidth):
-            for y in range(self.vpY, self.vpY + self.vpHeight):
-                self.glPoint(x,y,clr)
+        x0 = max(0, self.vpX)
+        y0 = max(0, self.vpY)
+        self.pixels[y0:self.vpY + self.vpHeight, x0:self.vpX + self.vpWidth] = list(clr or self.currColor)
 
 
     def glPoint(self, x, y, clr = None): # Window Coordinates
         if (0 <= x < self.width) and (0 <= y < self.height):
-            self.pixels[x][y] = clr or self.currColor
+            self.pixels[y, x] = list(clr or self.currColor)
+
+    @property
+    def scene(self):
+        return self._scene
+
+    @scene.setter
+    def scene(self, objects):
+        # A new list starts over at version 0, which the BVH may have been
+        # built for, so what was derived from the old one goes with it
+        self._scene = VersionedList(objects)
+        self.bvh = None
+        self.bvhVersion = None
+        self.sceneGeometry = None
+
+    @property
+    def envMap(self):
+        return self._envMap
+
+    @envMap.setter
+    def envMap(self, texture):
+        # The cube map, if asked for, is made from it on the first lookup
+        self._envMap = texture
+        self.envCube = None
+
+    def getEnvLookup(self):
+        # What rays look the environment up in, the map or its cube map
+        if not self.envCubeMap:
+            return self.envMap
+
+        if self.envCube is None:
+            self.envCube = CubeMap(self.envMap)
+        return self.envCube
+
+    @property
+    def lights(self):
+        return self._lights
+
+    @lights.setter
+    def lights(self, lights):
+        # Like the scene, a new list starts over at version 0, so the split
+        # of the old lights is dropped with them
+        self._lights = VersionedList(lights)
+        self.lightsVersion = None
+
+    def updateLights(self, resum = False):
+        # Ambient lights are the same at every point, so they are summed
+        # once per render instead of once per ray; the rest are shaded one
+        # by one. Renders pass resum, as the color or intensity of a light
+        # may have been edited in place, and there are only a few to sum.
+        if self.lightsVersion != self.lights.version:
+            self.ambientLights = []
+            self.directLights = []
+
+            for light in self.lights:
+                if light.lightType == AMBIENT_LIGHT:
+                    self.ambientLights.append(light)
+                else:
+                    self.directLights.append(light)
+
+            self.lightsVersion = self.lights.version
+            resum = True
+
+        if resum:
+            self.ambientColor = np.array([0,0,0])
+            for light in self.ambientLights:
+                self.ambientColor = np.add(self.ambientColor, np.array(light.color) * light.intensity)
+
+    def checkScene(self):
+        # Objects moved or reshaped in place, without a call to
+        # scene.changed(), count as a change of the scene, so the BVH and
+        # the compiled scene follow them. Cheap enough for once per render,
+        # not for once per ray.
+        geometry = [getGeometry(obj) for obj in self.scene]
+        if geometry != self.sceneGeometry:
+            if self.sceneGeometry is not None:
+                self.scene.changed()
+            self.sceneGeometry = geometry
+
+    def updateBVH(self):
+        # Bounded objects go in the BVH, planes and anything else without
+        # bounds are tested one by one. If only the bounds changed, as when
+        # objects move, the BVH is refitted instead of built again.
+        if self.bvhVersion == self.scene.version and self.bvh is not None:
+            return
+
+        unbounded = []
+        bounded = []
+        boundedIndex = []
+        boundsMin = []
+        boundsMax = []
+
+        for i, obj in enumerate(self.scene):
+            bounds = obj.getBounds() if hasattr(obj, 'getBounds') else None
+            if bounds is None:
+                unbounded.append((i, obj))
+            else:
+                bounded.append(obj)
+                boundedIndex.append(i)
+                boundsMin.append(bounds[0])
+                boundsMax.append(bounds[1])
+
+        sameObjects = (self.bvh is not None and len(bounded) == len(self.bounded) and
+                       all(a is b for a, b in zip(bounded, self.bounded)) and boundedIndex == self.boundedIndex)
+
+        if not (sameObjects and self.bvh.refit(boundsMin, boundsMax)):
+            self.bvh = BVH(boundsMin, boundsMax)
+
+        self.unbounded = unbounded
+        self.bounded = bounded
+        self.boundedIndex = boundedIndex
+        self.bvhVersion = self.scene.version
+        self.sceneIds = set(map(id, self.scene))
+
+        # The batched code tests the objects the compiled scene has arrays
+        # for all together, and the rest one by one
+        self.compiled = CompiledScene(self.scene)
+        self.boundedObjs = np.array(boundedIndex, dtype = int)
+
+        unboundedObjs = np.array([i for i, obj in unbounded], dtype = int)
+        self.unboundedCompiled = unboundedObjs[self.compiled.kinds[unboundedObjs] != OBJECT]
+        self.unboundedObjects = [(i, obj) for i, obj in unbounded if self.compiled.kinds[i] == OBJECT]
 
     def scene_intersect(self, orig, dir, sceneObj):
+        self.updateBVH()
+
+        orig = vec3(orig)
+        dir = vec3(dir)
+
+        stats = self.stats
         depth = float('inf')
         intersect = None
+        order = -1
 
-        for obj in self.scene:
+        if stats is not None:
+            stats.countTests([obj for i, obj in self.unbounded])
+
+        for i, obj in self.unbounded:
             hit = obj.ray_intersect(orig, dir)
             if hit != None:
                 if sceneObj != hit.sceneObj:
                     if hit.distance < depth:
                         intersect = hit
                         depth = hit.distance
+                        order = i
+
+        def visitLeaf(prims, depth):
+            nonlocal intersect, order
+
+            if stats is not None:
+                stats.countTests([self.bounded[prim] for prim in prims])
+
+            for prim in prims:
+                hit = self.bounded[prim].ray_intersect(orig, dir)
+                if hit != None:
+                    if sceneObj != hit.sceneObj:
+                        # Equal distances go to the first object in the
+                        # scene, as a linear search would pick
+                        i = self.boundedIndex[prim]
+                        if hit.distance < depth or (hit.distance == depth and i < order):
+                            intersect = hit
+                            depth = hit.distance
+                            order = i
+
+            return depth
+
+        self.bvh.traverse(orig, dir, depth, visitLeaf)
 
         return intersect
 
+    def scene_intersect_many(self, origs, dirs, sceneObjs = None):
+        # sceneObjs holds, per ray, the index in self.scene of the object
+        # to ignore, or -1. The sceneObj of the result holds the index of
+        # the object hit, or -1. Objects of the compiled scene are only
+        # tested for distance; the surface is found once, for the object
+        # each ray ends up hitting.
+        self.updateBVH()
+
+        origs, dirs = rayArrays(origs, dirs)
+
+        compiled = self.compiled
+        stats = self.stats
+
+        depth = np.full(len(dirs), np.inf)
+        objIndex = np.full(len(dirs), -1)
+        points = np.zeros((len(dirs), 3))
+        normals = np.zeros((len(dirs), 3))
+        texcoords = np.full((len(dirs), 2), np.nan)
+
+        def update(i, obj, rays):
+            if stats is not None:
+                stats.countTests((obj,), len(rays))
+
+            hit = obj.ray_intersect_many(origs[rays], dirs[rays])
+
+            closer = (hit.distance < depth[rays]) | ((hit.distance == depth[rays]) & (i < objIndex[rays]))
+            if sceneObjs is not None:
+                closer &= sceneObjs[rays] != i
+
+            closerRays = rays[closer]
+            depth[closerRays] = hit.distance[closer]
+            objIndex[closerRays] = i
+            points[closerRays] = hit.point[closer]
+            normals[closerRays] = hit.normal[closer]
+            texcoords[closerRays] = np.nan if hit.texcoords is None else hit.texcoords[closer]
+
+        def updateCompiled(objs, rays):
+            # Nearest of objs, sorted by index so ties go to the first
+            # object in the scene
+            if stats is not None:
+                stats.countTests([self.scene[i] for i in objs], len(rays))
+
+            t = compiled.distances(objs, origs[rays], dirs[rays])
+            if sceneObjs is not None:
+                t[sceneObjs[rays][:, None] == objs] = np.inf
+
+            nearest = np.argmin(t, axis = 1)
+            t = t[np.arange(len(rays)), nearest]
+            nearest = objs[nearest]
+
+            closer = (t < depth[rays]) | ((t == depth[rays]) & (nearest < objIndex[rays]))
+
+            closerRays = rays[closer]
+            depth[closerRays] = t[closer]
+            objIndex[closerRays] = nearest[closer]
+
+        allRays = np.arange(len(dirs))
+        if len(self.unboundedCompiled):
+            updateCompiled(self.unboundedCompiled, allRays)
+        for i, obj in self.unboundedObjects:
+            update(i, obj, allRays)
+
+        def visitLeaf(prims, rays):
+            objs = np.sort(self.boundedObjs[prims])
+            isObject = compiled.kinds[objs] == OBJECT
+
+            if not np.all(isObject):
+                updateCompiled(objs[~isObject], rays)
+            for i in objs[isObject]:
+                update(i, self.scene[i], rays)
+
+        self.bvh.traverseMany(origs, dirs, depth, visitLeaf)
+
+        hits = np.nonzero(objIndex >= 0)[0]
+        hits = hits[compiled.kinds[objIndex[hits]] != OBJECT]
+        points[hits], normals[hits], texcoords[hits] = compiled.surface(objIndex[hits], origs[hits], dirs[hits], depth[hits])
+
+        return Intersects(distance = depth,
+                          point = points,
+                          normal = normals,
+                          texcoords = texcoords,
+                          sceneObj = objIndex)
+
+    def scene_occluded(self, orig, dir, sceneObj = None, maxDistance = float('inf'), hint = None):
+        # Any object other than sceneObj closer than maxDistance along the
+        # ray, or None. Stops at the first one found, trying hint first.
+        self.updateBVH()
+
+        orig = [float(o) for o in orig]
+        dir = [float(d) for d in dir]
+
+        stats = self.stats
+        if stats is not None:
+            stats.rays['shadow'] += 1
+
+        if hint is not None and hint is not sceneObj and id(hint) in self.sceneIds:
+            if stats is not None:
+                stats.countTests((hint,))
+            if hint.ray_occluded(orig, dir, maxDistance):
+                return hint
+
+        for i, obj in self.unbounded:
+            if obj is not sceneObj:
+                if stats is not None:
+                    stats.countTests((obj,))
+                if obj.ray_occluded(orig, dir, maxDistance):
+                    return obj
+
+        def visitLeaf(prims):
+            for prim in prims:
+                obj = self.bounded[prim]
+                if obj is not sceneObj:
+                    if stats is not None:
+                        stats.countTests((obj,))
+                    if obj.ray_occluded(orig, dir, maxDistance):
+                        return obj
+            return None
+
+        return self.bvh.traverseAny(orig, dir, maxDistance, visitLeaf)
+
+    def scene_occluded_many(self, origs, dirs, sceneObjs = None, maxDistances = np.inf):
+        # Batched scene_occluded: whether each ray is blocked. Blocked rays
+        # drop out of the rest of the search.
+        self.updateBVH()
+
+        origs, dirs = rayArrays(origs, dirs)
+        tMax = np.array(np.broadcast_to(maxDistances, len(dirs)), dtype = float)
+        occluded = np.zeros(len(dirs), dtype = bool)
+
+        if self.stats is not None:
+            self.stats.rays['shadow'] += len(dirs)
+
+        def test(i, obj, rays):
+            rays = rays[~occluded[rays]]
+            if sceneObjs is not None:
+                rays = rays[sceneObjs[rays] != i]
+            if len(rays) == 0:
+                return
+
+            if self.stats is not None:
+                self.stats.countTests((obj,), len(rays))
+
+            hit = obj.ray_intersect_many(origs[rays], dirs[rays])
+            blocked = rays[hit.distance < tMax[rays]]
+            occluded[blocked] = True
+            # Keeps blocked rays out of every BVH node from now on
+            tMax[blocked] = -1
+
+        def testCompiled(objs, rays):
+            rays = rays[~occluded[rays]]
+            if len(rays) == 0:
+                return
+
+            if self.stats is not None:
+                self.stats.countTests([self.scene[i] for i in objs], len(rays))
+
+            t = self.compiled.distances(objs, origs[rays], dirs[rays])
+            if sceneObjs is not None:
+                t[sceneObjs[rays][:, None] == objs] = np.inf
+
+            blocked = rays[np.any(t < tMax[rays][:, None], axis = 1)]
+            occluded[blocked] = True
+            tMax[blocked] = -1
+
+        allRays = np.arange(len(dirs))
+        if len(self.unboundedCompiled):
+            testCompiled(self.unboundedCompiled, allRays)
+        for i, obj in self.unboundedObjects:
+            test(i, obj, allRays)
+
+        def visitLeaf(prims, rays):
+            objs = self.boundedObjs[prims]
+            isObject = self.compiled.kinds[objs] == OBJECT
+
+            if not np.all(isObject):
+                testCompiled(objs[~isObject], rays)
+            for i in objs[isObject]:
+                test(i, self.scene[i], rays)
+
+        self.bvh.traverseMany(origs, dirs, tMax, visitLeaf)
+
+        return occluded
+
     def cast_ray(self, orig, dir, sceneObj = None, recursion = 0):
-        intersect = self.scene_intersect(orig, dir, sceneObj)
+        # Traces the tree of bounce rays with an explicit stack, parents
+        # before children, then resolves the colors children first. Every
+        # ray carries the weight its color has in the pixel, and the ones
+        # that fall below minRayWeight are dropped, or with russianRoulette
+        # kept at random and weighted up.
 
-        if intersect == None or recursion >= MAX_RECURSION_DEPTH:
-            if self.envMap:
-                return self.envMap.getEnvColor(dir)
-            else:
-                return (self.clearColor[0] / 255,
-                        self.clearColor[1] / 255,
-                        self.clearColor[2] / 255)
+        self.updateLights()
 
-        material = intersect.sceneObj.material
+        stats = self.stats
+        if stats is not None:
+            stats.rays['primary'] += 1
 
-        finalColor = np.array([0,0,0])
-        objectColor = np.array([material.diffuse[0],
-                                material.diffuse[1],
-                                material.diffuse[2]])
+        pixelSpread = self.getPixelSpread()
 
-        if material.matType == OPAQUE:
-            for light in self.lights:
-                diffuseColor = light.getDiffuseColor(intersect, self)
-                specColor = light.getSpecColor(intersect, self)
-                shadowIntensity = light.getShadowIntensity(intersect, self)
+        # Per traced ray: parent index, share of the parent color, and then
+        # either its final color or what is needed to resolve it
+        nodes = []
+        stack = [(vec3(orig), vec3(dir), sceneObj, recursion, 1.0, -1, 1.0, 0)]
+
+        while stack:
+            orig, dir, sceneObj, recursion, weight, parent, share, travelled = stack.pop()
+
+            if stats is not None:
+                stats.countDepth(recursion)
+                start = perf_counter()
+
+            intersect = self.scene_intersect(orig, dir, sceneObj)
+
+            if stats is not None:
+                start = stats.lap('intersect', start)
 
-                lightColor = (diffuseColor + specColor) * (1 - shadowIntensity)
+            if intersect == None or recursion >= MAX_RECURSION_DEPTH:
+                if self.envMap:
+                    envColor = self.getEnvLookup().getEnvColor(dir, self.textureFilter)
+                else:
+                    envColor = (self.clearColor[0] / 255,
+                                self.clearColor[1] / 255,
+                                self.clearColor[2] / 255)
+                nodes.append((parent, share, envColor, None, None, None))
+                continue
 
-                finalColor = np.add(finalColor, lightColor)
+            node = len(nodes)
+            material = intersect.sceneObj.material
 
-        elif material.matType == REFLECTIVE:
-            reflect = reflectVector(intersect.normal, np.array(dir) * -1)
-            reflectColor = self.cast_ray(intersect.point, reflect, intersect.sceneObj, recursion + 1)
-            reflectColor = np.array(reflectColor)
+            finalColor = Vec3(0.0, 0.0, 0.0)
+            objectColor = vec3(material.diffuse)
 
-            specColor = np.array([0,0,0])
-            for light in self.lights:
-                specColor = np.add(specColor, light.getSpecColor(intersect, self))
+            # Distance from the camera, through every bounce
+            travelled += intersect.distance
 
-            finalColor = reflectColor + specColor
+            texColor = None
+            if material.texture and intersect.texcoords:
+                footprint = None
+                texScale = intersect.sceneObj.getTexScale() if hasattr(intersect.sceneObj, 'getTexScale') else None
+                if texScale is not None and self.textureFilter != NEAREST:
+                    footprint = pixelSpread * travelled * texScale
 
-        elif material.matType == TRANSPARENT:
-            outside = np.dot(dir, intersect.normal) < 0
-            bias = intersect.normal * 0.001
+                texColor = material.texture.getColor(intersect.texcoords[0], intersect.texcoords[1],
+                                                     footprint, self.textureFilter)
+                if texColor is not None:
+                    texColor = vec3(texColor)
 
-            specColor = np.array([0,0,0])
-            for light in self.lights:
-                specColor = np.add(specColor, light.getSpecColor(intersect, self))
+            if stats is not None:
+                start = stats.lap('texture', start)
 
-            reflect = reflectVector(intersect.normal, np.array(dir) * -1)
-            reflectOrig = np.add(intersect.point, bias) if outside else np.subtract(intersect.point, bias)
-            reflectColor = self.cast_ray(reflectOrig, reflect, None, recursion + 1)
-            reflectColor = np.array(reflectColor)
+            # Bounce rays, as (orig, dir, sceneObj, share, kind of ray)
+            bounces = []
 
-            kr = fresnel(intersect.normal, dir, material.ior)
+            if material.matType == OPAQUE:
+                r, g, b = self.ambientColor.tolist()
+                for light in self.directLights:
+                    lightColor = light.shade(intersect, self)
+                    if lightColor is not None:
+                        r += lightColor[0]
+                        g += lightColor[1]
+                        b += lightColor[2]
 
-            refractColor = np.array([0,0,0])
-            if kr < 1:
-                refract = refractVector(intersect.normal, dir, material.ior)
-                refractOrig = np.subtract(intersect.point, bias) if outside else np.add(intersect.point, bias)
-                refractColor = self.cast_ray(refractOrig, refract, None, recursion + 1)
-                refractColor = np.array(refractColor)
+                finalColor = Vec3(r, g, b)
 
-            finalColor = reflectColor * kr + refractColor * (1 - kr) + specColor
+            elif material.matType == REFLECTIVE:
+                reflect = (-dir).reflect(intersect.normal)
+                bounces.append((intersect.point, reflect, intersect.sceneObj, 1.0, 'reflection'))
 
+                for light in self.directLights:
+                    finalColor = finalColor + light.getSpecColor(intersect, self)
 
-        finalColor *= objectColor
+            elif material.matType == TRANSPARENT:
+                outside = dir.dot(intersect.normal) < 0
+                bias = intersect.normal * 0.001
 
-        if material.texture and intersect.texcoords:
-            texColor = material.texture.getColor(intersect.texcoords[0], intersect.texcoords[1])
-            if texColor is not None:
-                finalColor *= np.array(texColor)
+                for light in self.directLights:
+                    finalColor = finalColor + light.getSpecColor(intersect, self)
 
-        r = min(1, finalColor[0])
-        g = min(1, finalColor[1])
-        b = min(1, finalColor[2])
+                kr = fresnel(intersect.normal, dir, material.ior)
 
-        return (r,g,b)
+                reflect = (-dir).reflect(intersect.normal)
+                reflectOrig = intersect.point + bias if outside else intersect.point - bias
+                bounces.append((reflectOrig, reflect, None, kr, 'reflection'))
 
+                if kr < 1:
+                    refract = dir.refract(intersect.normal, material.ior)
+                    refractOrig = intersect.point - bias if outside else intersect.point + bias
+                    bounces.append((refractOrig, refract, None, 1 - kr, 'refraction'))
 
-    def glRender(self):
-        # Proyeccion
+            if stats is not None:
+                stats.lap('shading', start)
+
+            if bounces:
+                # Largest factor the color of a bounce ray is scaled by here
+                throughput = weight * max(objectColor * (texColor if texColor is not None else 1.0))
+
+                for bounceOrig, bounceDir, bounceObj, bounceShare, kind in reversed(bounces):
+                    bounceWeight = throughput * bounceShare
+                    if bounceWeight < self.minRayWeight:
+                        if not self.russianRoulette:
+                            continue
+                        survival = bounceWeight / self.minRayWeight
+                        if self.rouletteRng.random() >= survival:
+                            continue
+                        bounceShare /= survival
+                        bounceWeight = self.minRayWeight
+
+                    if stats is not None:
+                        stats.rays[kind] += 1
+
+                    stack.append((bounceOrig, bounceDir, bounceObj, recursion + 1, bounceWeight, node, bounceShare, travelled))
+
+            nodes.append((parent, share, None, finalColor, objectColor, texColor))
+
+        # Children always come after their parent, so going backwards every
+        # bounce color is ready before the ray that spawned it needs it
+        bounceColors = [None] * len(nodes)
+
+        for node in range(len(nodes) - 1, -1, -1):
+            parent, share, rayColor, finalColor, objectColor, texColor = nodes[node]
+
+            if rayColor is None:
+                if bounceColors[node] is not None:
+                    finalColor = finalColor + bounceColors[node]
+
+                finalColor = finalColor * objectColor
+
+                if texColor is not None:
+                    finalColor = finalColor * texColor
+
+                rayColor = (min(1, finalColor.x),
+                            min(1, finalColor.y),
+                            min(1, finalColor.z))
+
+            if parent < 0:
+                return rayColor
+
+            rayColor = vec3(rayColor) * share
+            if bounceColors[parent] is None:
+                bounceColors[parent] = rayColor
+            else:
+                bounceColors[parent] = bounceColors[parent] + rayColor
+
+    def env_colors(self, dirs):
+        if self.envMap:
+            return self.getEnvLookup().getEnvColorMany(dirs, self.textureFilter)
+        else:
+            return np.broadcast_to(np.array(list(self.clearColor)) / 255, dirs.shape)
+
+    def cast_rays(self, origs, dirs, returnObjects = False, record = None):
+        # Batched cast_ray. Every bounce depth is traced as one generation of
+        # rays, then colors are resolved from the deepest generation back up
+        # to the primary rays, so the per-bounce clamping matches cast_ray.
+        # With returnObjects it also returns the index in the scene of the
+        # object each ray hit first, or -1. A record list gets, for every
+        # generation, the primary ray each ray descends from, the rays and
+        # what they hit, as (roots, origs, dirs, Intersects).
+        dirs = np.asarray(dirs, dtype = float)
+        origs = np.broadcast_to(np.asarray(origs, dtype = float), dirs.shape)
+
+        self.checkScene()
+        self.updateLights(resum = True)
+        self.updateBVH()
+
+        compiled = self.compiled
+        compiled.updateMaterials(self.scene)
+
+        primaryObjects = np.full(len(dirs), -1)
+
+        sceneObjs = np.full(len(dirs), -1)
+        parents = np.full(len(dirs), -1)
+        weights = np.ones(len(dirs))
+        pathWeights = np.ones(len(dirs))
+        travelled = np.zeros(len(dirs))
+        roots = np.arange(len(dirs))
+
+        pixelSpread = self.getPixelSpread()
+
+        generations = []
+
+        stats = self.stats
+        if stats is not None:
+            stats.rays['primary'] += len(dirs)
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            for recursion in range(MAX_RECURSION_DEPTH + 1):
+                if stats is not None:
+                    stats.countDepth(recursion, len(dirs))
+                    start = perf_counter()
+
+                if recursion >= MAX_RECURSION_DEPTH:
+                    noHits = np.zeros((0, 3))
+                    generations.append((np.array(self.env_colors(dirs)), np.zeros(0, dtype = int),
+                                        noHits, noHits, noHits, parents, weights))
+                    break
+
+                intersects = self.scene_intersect_many(origs, dirs, sceneObjs)
+
+                if stats is not None:
+                    start = stats.lap('intersect', start)
+
+                if record is not None:
+                    record.append((roots, origs, dirs, intersects))
+
+                if recursion == 0:
+                    primaryObjects = intersects.sceneObj
+
+                hit = intersects.hit
+                colors = np.zeros((len(dirs), 3))
+                colors[~hit] = self.env_colors(dirs[~hit])
+
+                hitIdx = np.nonzero(hit)[0]
+                obj = intersects.sceneObj[hit]
+                P = intersects.point[hit]
+                N = intersects.normal[hit]
+                D = dirs[hit]
+                texcoords = intersects.texcoords
+                material = compiled.materials[obj]
+                types = compiled.matTypes[material]
+
+                finalColor = np.zeros((len(hitIdx), 3))
+
+                opaque = types == OPAQUE
+                finalColor[opaque] = self.ambientColor
+                for light in self.directLights:
+                    finalColor[opaque] += light.shadeMany(P[opaque], N[opaque], compiled.specs[material[opaque]], obj[opaque], self)
+
+                shiny = ~opaque
+                for light in self.directLights:
+                    finalColor[shiny] += light.getSpecColorMany(P[shiny], N[shiny], compiled.specs[material[shiny]], self)
+
+                if stats is not None:
+                    start = stats.lap('shading', start)
+
+                objectColor = compiled.diffuses[material]
+
+                # Distance from the camera, through every bounce
+                travelled = travelled + intersects.distance
+
+                texColor = np.ones((len(hitIdx), 3))
+                for i in compiled.textured:
+                    textured = obj == i
+                    if np.any(textured):
+                        uvs = texcoords[hitIdx[textured]]
+
+                        footprints = None
+                        texScale = compiled.texScales[i]
+                        if not np.isnan(texScale) and self.textureFilter != NEAREST:
+                            footprints = pixelSpread * travelled[hitIdx[textured]] * texScale
+
+                        texture = compiled.textures[compiled.materials[i]]
+                        objTexColor, valid = texture.getColorMany(uvs[:, 0], uvs[:, 1], footprints, self.textureFilter)
+                        texColor[np.nonzero(textured)[0][valid]] = objTexColor[valid]
+
+                if stats is not None:
+                    stats.lap('texture', start)
+
+                # Rays for the next generation
+                childOrigs = []
+                childDirs = []
+                childSceneObjs = []
+                childParents = []
+                childWeights = []
+
+                reflective = types == REFLECTIVE
+                childOrigs.append(P[reflective])
+                childDirs.append(reflectVectorMany(N[reflective], D[reflective] * -1))
+                childSceneObjs.append(obj[reflective])
+                childParents.append(hitIdx[reflective])
+                childWeights.append(np.ones(np.count_nonzero(reflective)))
+
+                transparent = types == TRANSPARENT
+                tN = N[transparent]
+                tP = P[transparent]
+                tD = D[transparent]
+                tIdx = hitIdx[transparent]
+
+                outside = (np.sum(tD * tN, axis = 1) < 0)[:, None]
+                bias = tN * 0.001
+                kr = fresnelMany(tN, tD, compiled.iors[material[transparent]])
+
+                childOrigs.append(np.where(outside, tP + bias, tP - bias))
+                childDirs.append(reflectVectorMany(tN, tD * -1))
+                childSceneObjs.append(np.full(len(tIdx), -1))
+                childParents.append(tIdx)
+                childWeights.append(kr)
+
+                refracts = kr < 1
+                childOrigs.append(np.where(outside, tP - bias, tP + bias)[refracts])
+                childDirs.append(refractVectorMany(tN[refracts], tD[refracts], compiled.iors[material[transparent]][refracts]))
+                childSceneObjs.append(np.full(np.count_nonzero(refracts), -1))
+                childParents.append(tIdx[refracts])
+                childWeights.append(1 - kr[refracts])
+
+                generations.append((colors, hitIdx, finalColor, objectColor, texColor, parents, weights))
+
+                origs = np.concatenate(childOrigs)
+                dirs = np.concatenate(childDirs)
+                sceneObjs = np.concatenate(childSceneObjs)
+                parents = np.concatenate(childParents)
+                weights = np.concatenate(childWeights)
+                travelled = travelled[parents]
+                roots = roots[parents]
+
+                # Drop the rays that weigh too little in their pixel, as
+                # cast_ray does
+                throughput = np.zeros(len(colors))
+                throughput[hitIdx] = pathWeights[hitIdx] * np.max(objectColor * texColor, axis = 1)
+                pathWeights = throughput[parents] * weights
+
+                keep = ~(pathWeights < self.minRayWeight)
+                if self.russianRoulette and self.minRayWeight > 0:
+                    survival = pathWeights / self.minRayWeight
+                    survivors = ~keep & (self.rouletteRng.random(len(pathWeights)) < survival)
+                    weights[survivors] /= survival[survivors]
+                    pathWeights[survivors] = self.minRayWeight
+                    keep |= survivors
+
+                if stats is not None:
+                    # Refracted rays are the last ones
+                    refracted = np.arange(len(keep)) >= len(keep) - len(childDirs[2])
+                    stats.rays['reflection'] += int(np.count_nonzero(keep & ~refracted))
+                    stats.rays['refraction'] += int(np.count_nonzero(keep & refracted))
+
+                if not np.all(keep):
+                    origs = origs[keep]
+                    dirs = dirs[keep]
+                    sceneObjs = sceneObjs[keep]
+                    parents = parents[keep]
+                    weights = weights[keep]
+                    pathWeights = pathWeights[keep]
+                    travelled = travelled[keep]
+                    roots = roots[keep]
+
+                if len(dirs) == 0:
+                    break
+
+        childColors = None
+        for colors, hitIdx, finalColor, objectColor, texColor, parents, weights in reversed(generations):
+            if childColors is not None:
+                bounceColor = np.zeros(colors.shape)
+                np.add.at(bounceColor, childParents, childWeights[:, None] * childColors)
+                finalColor = finalColor + bounceColor[hitIdx]
+
+            finalColor = finalColor * objectColor
+            finalColor = finalColor * texColor
+            colors[hitIdx] = np.minimum(1, finalColor)
+
+            childColors, childParents, childWeights = colors, parents, weights
+
+        if returnObjects:
+            return childColors, primaryObjects
+
+        return childColors
+
+
+    def getRayDirection(self, x, y, t, r):
+        # Pasar de coordenadas de ventana a
+        # coordenadas NDC (-1 a 1)
+        Px = ((x + 0.5 - self.vpX) / self.vpWidth) * 2 - 1
+        Py = ((y + 0.5 - self.vpY) / self.vpHeight) * 2 - 1
+
+        Px *= r
+        Py *= t
+
+        direction = Vec3(Px, Py, -self.nearPlane).normalized()
+
+        if self.camMatrix is not None:
+            direction = transformDirection(self.camMatrix, direction)
+
+        return direction
+
+    def getRayDirections(self, xs, ys, t, r):
+        # Primary rays for every (x, y) of the grid, row by row
+        x, y = np.meshgrid(xs, ys)
+        x = x.ravel()
+        y = y.ravel()
+
+        return x, y, self.getRayDirectionsAt(x, y, t, r)
+
+    def getRayDirectionsAt(self, x, y, t, r):
+        # Primary rays through the window coordinates x[i], y[i]
+        Px = ((x + 0.5 - self.vpX) / self.vpWidth) * 2 - 1
+        Py = ((y + 0.5 - self.vpY) / self.vpHeight) * 2 - 1
+
+        directions = np.stack((Px * r, Py * t, np.full(len(x), -self.nearPlane)), axis = 1)
+        directions = directions / np.linalg.norm(directions, axis = 1)[:, None]
+
+        if self.camMatrix is not None:
+            directions = transformMany(self.camMatrix, directions, 0)
+
+        return directions
+
+    def getPixelSpread(self):
+        # Width of a pixel one unit away from the camera
+        return 2 * tan((self.fov * np.pi / 180) / 2) / self.vpHeight
+
+    def getProjection(self):
         t = tan((self.fov * np.pi / 180) / 2) * self.nearPlane
         r = t * self.vpWidth / self.vpHeight
+        return t, r
+
+    def getViewportSamples(self):
+        # Window coordinates glRender shoots rays through, clipped to the window
+        xs = [x for x in range(self.vpX, self.vpX + self.vpWidth + 1, STEPS) if 0 <= x < self.width]
+        ys = [y for y in range(self.vpY, self.vpY + self.vpHeight + 1, STEPS) if 0 <= y < self.height]
+        return xs, ys
+
+    def glRender(self):
+        self.checkScene()
+        self.updateLights(resum = True)
+
+        # Proyeccion
+        t, r = self.getProjection()
+
+        stats = self.stats
 
         for y in range(self.vpY, self.vpY + self.vpHeight + 1, STEPS):
             for x in range(self.vpX, self.vpX + self.vpWidth + 1, STEPS):
-                # Pasar de coordenadas de ventana a
-                # coordenadas NDC (-1 a 1)
-                Px = ((x + 0.5 - self.vpX) / self.vpWidth) * 2 - 1
-                Py = ((y + 0.5 - self.vpY) / self.vpHeight) * 2 - 1
+                if stats is not None:
+                    pixelStart = perf_counter()
 
-                Px *= r
-                Py *= t
+                direction = self.getRayDirection(x, y, t, r)
 
-                direction = V3(Px, Py, -self.nearPlane)
-                direction = direction / np.linalg.norm(direction)
+                if stats is not None:
+                    stats.lap('rays', pixelStart)
 
                 rayColor = self.cast_ray(self.camPosition, direction)
 
+                if stats is not None:
+                    start = perf_counter()
+
                 if rayColor is not None:
                     rayColor = color(rayColor[0],rayColor[1],rayColor[2])
                     self.glPoint(x, y, rayColor)
 
-    def glFinish(self, filename):
-        with open(filename, "wb") as file:
-            # Header
-            file.write(bytes('B'.encode('ascii')))
-            file.write(bytes('M'.encode('ascii')))
-            file.write(dword(14 + 40 + (self.width * self.height * 3)))
-            file.write(dword(0))
-            file.write(dword(14 + 40))
+                if stats is not None:
+                    end = stats.lap('output', start)
+                    if 0 <= x < self.width and 0 <= y < self.height:
+                        stats.pixelCost[y, x] += end - pixelStart
+
+    def glRenderWavefront(self):
+        # Same image as glRender, with all the primary rays of the viewport
+        # traced together by cast_rays
+        xs, ys = self.getViewportSamples()
+
+        self.glRenderTile(xs, ys, self.pixels, wavefront = True)
+
+    def glRenderProgressive(self, steps = PROGRESSIVE_STEPS):
+        # Renders the viewport in passes of decreasing pixel spacing,
+        # tracing only the pixels earlier passes skipped, and yields the
+        # framebuffer after each pass with the gaps filled from the nearest
+        # traced pixel up and to the left. The last pass is the full image.
+        t, r = self.getProjection()
+
+        xs = np.arange(max(0, self.vpX), min(self.width, self.vpX + self.vpWidth + 1))
+        ys = np.arange(max(0, self.vpY), min(self.height, self.vpY + self.vpHeight + 1))
+        if len(xs) == 0 or len(ys) == 0:
+            return
+
+        region = self.pixels[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1]
+        traced = np.zeros((len(ys), len(xs)), dtype = bool)
+
+        for step in steps:
+            gridX = (xs - self.vpX) % step == 0
+            gridY = (ys - self.vpY) % step == 0
+
+            rows, cols = np.nonzero(gridY[:, None] & gridX[None, :] & ~traced)
+            if len(rows):
+                directions = self.getRayDirectionsAt(xs[cols], ys[rows], t, r)
+                region[rows, cols] = colors(self.cast_rays(self.camPosition, directions))
+                traced[rows, cols] = True
+
+            # Every pixel takes the color of the last traced grid pixel at or
+            # before it on both axes
+            gridCols = np.nonzero(gridX)[0]
+            gridRows = np.nonzero(gridY)[0]
+            if len(gridCols) and len(gridRows):
+                srcCols = gridCols[np.maximum(np.searchsorted(gridCols, np.arange(len(xs)), side = 'right') - 1, 0)]
+                srcRows = gridRows[np.maximum(np.searchsorted(gridRows, np.arange(len(ys)), side = 'right') - 1, 0)]
+
+                upscaled = region[np.ix_(srcRows, srcCols)]
+                region[~traced] = upscaled[~traced]
+
+            yield self.pixels
+
+    def glRenderAdaptive(self, threshold = AA_THRESHOLD, maxSamples = AA_MAX_SAMPLES, tolerance = AA_TOLERANCE, seed = 0):
+        # Anti-aliased render: one ray through every pixel centre, then
+        # rounds of stratified samples in the pixels on edges, while their
+        # color is uncertain and they have fewer than maxSamples rays.
+        # Returns the number of rays each pixel got.
+        t, r = self.getProjection()
+        xs, ys = self.getViewportSamples()
+        if not xs or not ys:
+            return np.zeros((0, 0), dtype = int)
+
+        stats = self.stats
+        if stats is not None:
+            passStart = perf_counter()
+
+        x, y, directions = self.getRayDirections(xs, ys, t, r)
+
+        if stats is not None:
+            stats.lap('rays', passStart)
+
+        rayColors, objects = self.cast_rays(self.camPosition, directions, returnObjects = True)
+
+        if stats is not None:
+            stats.pixelCost[y, x] += (perf_counter() - passStart) / len(x)
+
+        rayColors = rayColors.reshape(len(ys), len(xs), 3)
+        objects = objects.reshape(len(ys), len(xs))
+
+        # Largest change in color or object towards the 8 neighbours
+        paddedColors = np.pad(rayColors, ((1, 1), (1, 1), (0, 0)), mode = 'edge')
+        paddedObjects = np.pad(objects, 1, mode = 'edge')
+        contrast = np.zeros((len(ys), len(xs)))
+        edges = np.zeros((len(ys), len(xs)), dtype = bool)
+
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                neighbour = paddedColors[dy:dy + len(ys), dx:dx + len(xs)]
+                contrast = np.maximum(contrast, np.abs(neighbour - rayColors).max(axis = 2))
+                edges |= paddedObjects[dy:dy + len(ys), dx:dx + len(xs)] != objects
+
+        rows, cols = np.nonzero(edges | (contrast > threshold))
+
+        # Sums of the colors of the samples of every refined pixel and of
+        # their squares, for their mean and variance
+        sums = rayColors[rows, cols]
+        squares = sums * sums
+        counts = np.ones(len(rows), dtype = int)
+
+        rng = np.random.default_rng(seed)
+        offsetY, offsetX = np.divmod(np.arange(AA_GRID * AA_GRID), AA_GRID)
+
+        # Refined pixels still sampled; they all have the same count
+        active = np.arange(len(rows))
+        count = 1
+
+        while len(active) and count < maxSamples:
+            if stats is not None:
+                passStart = perf_counter()
+
+            # A sample in every cell, but the last round may only have room
+            # for some of them
+            cells = rng.permutation(AA_GRID * AA_GRID)[:maxSamples - count]
 
-            #InfoHeader
-            file.write(dword(40))
-            file.write(dword(self.width))
-            file.write(dword(self.height))
-            file.write(word(1))
-            file.write(word(24))
-            file.write(dword(0))
-            file.write(dword(self.width * self.height * 3))
-            file.write(dword(0))
-            file.write(dword(0))
-            file.write(dword(0))
-            file.write(dword(0))
+            # Jittered positions in the cells, relative to the pixel centre
+            jitter = rng.random((len(active), len(cells), 2))
+            sampleX = xs[0] + cols[active, None] * STEPS - 0.5 + (offsetX[cells] + jitter[:, :, 0]) / AA_GRID
+            sampleY = ys[0] + rows[active, None] * STEPS - 0.5 + (offsetY[cells] + jitter[:, :, 1]) / AA_GRID
 
-            #Color table
-            for y in range(self.height):
-                for x in range(self.width):
-                    file.write(self.pixels[x][y])
+            directions = self.getRayDirectionsAt(sampleX.ravel(), sampleY.ravel(), t, r)
 
+            if stats is not None:
+                stats.lap('rays', passStart)
 
+            samples = self.cast_rays(self.camPosition, directions).reshape(len(active), len(cells), 3)
 
+            sums[active] += samples.sum(axis = 1)
+            squares[active] += (samples * samples).sum(axis = 1)
+            count += len(cells)
+            counts[active] = count
+
+            if stats is not None:
+                sampledX = xs[0] + cols[active] * STEPS
+                sampledY = ys[0] + rows[active] * STEPS
+                stats.pixelCost[sampledY, sampledX] += (perf_counter() - passStart) / len(active)
+
+            # Pixels whose mean is within tolerance in every channel are done
+            mean = sums[active] / count
+            variance = np.maximum(squares[active] / count - mean * mean, 0) * count / (count - 1)
+            active = active[(variance / count).max(axis = 1) > tolerance * tolerance]
+
+        if stats is not None:
+            start = perf_counter()
+
+        rayColors[rows, cols] = sums / counts[:, None]
+        sampleCounts = np.ones((len(ys), len(xs)), dtype = int)
+        sampleCounts[rows, cols] = counts
+
+        self.pixels[np.ix_(ys, xs)] = colors(rayColors.reshape(-1, 3)).reshape(len(ys), len(xs), 3)
+
+        if stats is not None:
+            end = stats.lap('output', start)
+            stats.pixelCost[y, x] += (end - start) / len(x)
+
+        return sampleCounts
+
+    def glRenderTile(self, xs, ys, framebuffer, wavefront = False, firstRow = 0, colorbuffer = None):
+        # Renders the samples xs by ys into a (height, width, 3) array of
+        # BGR bytes whose first row is window row firstRow, and their RGB
+        # floats into colorbuffer if there is one
+        t, r = self.getProjection()
+
+        stats = self.stats
+
+        if wavefront:
+            if stats is not None:
+                tileStart = perf_counter()
+
+            x, y, directions = self.getRayDirections(xs, ys, t, r)
+
+            if stats is not None:
+                stats.lap('rays', tileStart)
+
+            rayColors = self.cast_rays(self.camPosition, directions)
+
+            if stats is not None:
+                start = perf_counter()
+
+            framebuffer[y - firstRow, x] = colors(rayColors)
+            if colorbuffer is not None:
+                colorbuffer[y - firstRow, x] = rayColors
+
+            if stats is not None:
+                # Rays are traced together, so every pixel gets an even
+                # share of the tile
+                end = stats.lap('output', start)
+                stats.pixelCost[y, x] += (end - tileStart) / len(x)
+            return
+
+        self.checkScene()
+        self.updateLights(resum = True)
+
+        for y in ys:
+            for x in xs:
+                if stats is not None:
+                    pixelStart = perf_counter()
+
+                direction = self.getRayDirection(x, y, t, r)
+
+                if stats is not None:
+                    stats.lap('rays', pixelStart)
+
+                rayColor = self.cast_ray(self.camPosition, direction)
+
+                if stats is not None:
+                    start = perf_counter()
+
+                if rayColor is not None:
+                    framebuffer[y - firstRow, x] = list(color(rayColor[0], rayColor[1], rayColor[2]))
+                    if colorbuffer is not None:
+                        colorbuffer[y - firstRow, x] = rayColor
+
+                if stats is not None:
+                    end = stats.lap('output', start)
+                    stats.pixelCost[y, x] += end - pixelStart
+
+    def getTextures(self):
+        textures = [obj.material.texture for obj in self.scene if obj.material.texture]
+        if self.envMap:
+            textures.append(self.envMap)
+
+        return list({id(texture): texture for texture in textures}.values())
+
+    def getTiles(self, tileSize = TILE_SIZE):
+        xs, ys = self.getViewportSamples()
+
+        tiles = []
+        for j in range(0, len(ys), tileSize):
+            for i in range(0, len(xs), tileSize):
+                tiles.append((xs[i:i + tileSize], ys[j:j + tileSize]))
+
+        return tiles
+
+    def sortTiles(self, tiles):
+        # Guess what each tile costs from the materials its corners and
+        # centre see, and hand out the expensive tiles first so the slow
+        # glass and mirror tiles do not end up last in the queue
+        t, r = self.getProjection()
+
+        probes = []
+        for xs, ys in tiles:
+            for x in (xs[0], xs[len(xs) // 2], xs[-1]):
+                for y in (ys[0], ys[len(ys) // 2], ys[-1]):
+                    probes.append(self.getRayDirection(x, y, t, r))
+
+        intersects = self.scene_intersect_many(self.camPosition, np.array(probes))
+
+        costs = np.full(len(probes), TILE_COSTS[None])
+        for i in np.nonzero(intersects.hit)[0]:
+            costs[i] = TILE_COSTS[self.scene[intersects.sceneObj[i]].material.matType]
+
+        costs = costs.reshape(len(tiles), -1).sum(axis = 1)
+
+        return [tiles[i] for i in np.argsort(-costs, kind = 'stable')]
+
+    def startTileWorkers(self, workers = None):
+        # Pool of processes for glRenderParallel, each with its own copy of
+        # the raytracer as it is now. It can be passed to any number of
+        # glRenderParallel calls that only change the camera attributes.
+        # With stats set, the window size must not change either, as the
+        # workers add pixel costs to the array shared here.
+        # Textures are moved to shared memory first, so the workers attach
+        # to them instead of each holding a copy.
+        if self.textureFilter != NEAREST:
+            # Built before sharing, so the workers share the MIP levels too
+            for obj in self.scene:
+                if obj.material.texture:
+                    obj.material.texture.getMips()
+
+        if self.envMap:
+            # Likewise, so the workers don't each make their own
+            self.getEnvLookup()
+
+        for texture in self.getTextures():
+            texture.share()
+
+        if self.stats is not None:
+            self.stats.share()
+
+        # Started before the workers, so they inherit it. A worker that
+        # attached to shared memory with no tracker would start its own,
+        # which unlinks that memory and warns of a leak when it exits.
+        resource_tracker.ensure_running()
+
+        return Pool(workers or os.cpu_count(), initializer = initTileWorker, initargs = (self,))
+
+    def glRenderParallel(self, workers = None, tileSize = TILE_SIZE, wavefront = False, pool = None):
+        # Same image as glRender, with the viewport split in tiles that a
+        # pool of processes renders into a shared memory framebuffer
+        tiles = self.sortTiles(self.getTiles(tileSize))
+
+        shm = shared_memory.SharedMemory(create = True, size = self.width * self.height * 3)
+        try:
+            framebuffer = np.ndarray((self.height, self.width, 3), dtype = np.uint8, buffer = shm.buf)
+
+            camera = self.getCamera()
+            tasks = [(xs, ys, camera, shm.name, wavefront) for xs, ys in tiles]
+
+            if pool is None:
+                with self.startTileWorkers(workers) as pool:
+                    self.renderTiles(pool, tasks)
+            else:
+                self.renderTiles(pool, tasks)
+
+            xs, ys = self.getViewportSamples()
+            samples = np.ix_(ys, xs)
+            self.pixels[samples] = framebuffer[samples]
+
+            del framebuffer
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def renderTiles(self, pool, tasks):
+        for counters in pool.imap_unordered(renderTile, tasks):
+            if counters is not None:
+                self.stats.merge(counters)
+
+    def renderRows(self, ys, wavefront = True, floats = False):
+        # Whole rows ys of the window, ascending and contiguous, as BGR
+        # bytes, plus their RGB floats or None. Rows and columns outside the
+        # viewport get the clear color.
+        pixels = np.zeros((len(ys), self.width, 3), dtype = np.uint8)
+        pixels[:, :] = list(self.clearColor)
+
+        rgb = None
+        if floats:
+            rgb = np.zeros((len(ys), self.width, 3))
+            rgb[:, :] = np.array(list(self.clearColor)[::-1]) / 255
+
+        xs, viewportYs = self.getViewportSamples()
+        samples = [y for y in viewportYs if ys[0] <= y <= ys[-1]]
+
+        if xs and samples:
+            self.glRenderTile(xs, samples, pixels, wavefront, ys[0], rgb)
+
+        return pixels, rgb
+
+    def glRenderToFile(self, filename, hdrFilename = None, bandSize = TILE_SIZE, wavefront = True,
+                       parallel = False, workers = None, pool = None):
+        # Renders the window a band of rows at a time, top down, writing
+        # each band to the file as it is done instead of keeping the image
+        # in self.pixels, so memory stays at a few bands whatever the size
+        # of the image. The file can be a BMP, PPM or PNG; hdrFilename is
+        # a Radiance HDR of the same image in floats.
+        writer = openImage(filename, self.width, self.height)
+        hdrWriter = HDRWriter(hdrFilename, self.width, self.height) if hdrFilename else None
+
+        bands = [list(range(max(0, top - bandSize), top)) for top in range(self.height, 0, -bandSize)]
+        floats = hdrWriter is not None
+
+        try:
+            if parallel:
+                camera = self.getCamera()
+                tasks = [(ys, camera, wavefront, floats) for ys in bands]
+
+                if pool is None:
+                    with self.startTileWorkers(workers) as pool:
+                        self.writeBands(pool.imap(renderBand, tasks), bands, writer, hdrWriter)
+                else:
+                    self.writeBands(pool.imap(renderBand, tasks), bands, writer, hdrWriter)
+            else:
+                results = ((self.renderRows(ys, wavefront, floats) + (None,)) for ys in bands)
+                self.writeBands(results, bands, writer, hdrWriter)
+        finally:
+            writer.close()
+            if hdrWriter is not None:
+                hdrWriter.close()
+
+    def writeBands(self, results, bands, writer, hdrWriter):
+        for (pixels, rgb, counters), ys in zip(results, bands):
+            if self.stats is not None:
+                start = perf_counter()
+
+            writer.writeRows(ys[0], pixels)
+            if hdrWriter is not None:
+                hdrWriter.writeRows(ys[0], rgb)
+
+            if self.stats is not None:
+                if counters is not None:
+                    self.stats.merge(counters)
+                self.stats.lap('output', start)
+
+    def glFinish(self, filename):
+        if self.stats is not None:
+            start = perf_counter()
 
+        if filename.lower().endswith('.bmp'):
+            writeBMP(filename, self.pixels)
+        else:
+            writeImage(filename, self.pixels)
 
+        if self.stats is not None:
+            self.stats.lap('output', start)
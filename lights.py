@@ -1,54 +1,35 @@
 import numpy as np
+from math import sqrt
+from matesRS import Vec3, vec3
 
 DIR_LIGHT = 0
 POINT_LIGHT = 1
 AMBIENT_LIGHT = 2
 
 def reflectVector(normal, direction):
-    reflect = 2 * np.dot(normal, direction)
-    reflect = np.multiply(reflect, normal)
-    reflect = np.subtract(reflect, direction)
-    reflect = reflect / np.linalg.norm(reflect)
-    return reflect
+    return vec3(direction).reflect(vec3(normal))
 
 def refractVector(normal, direction, ior):
-    # Snell's Law
-    cosi = max(-1, min(1, np.dot(direction, normal)))
-    etai = 1
-    etat = ior
-
-    if cosi < 0:
-        cosi = -cosi
-    else:
-        etai, etat = etat, etai
-        normal = np.array(normal) * -1
-
-    eta = etai / etat
-    k = 1 - (eta**2) * (1 - (cosi**2) )
-
-    if k < 0: # Total Internal Reflection
-        return None
-
-    R = eta * np.array(direction) + (eta * cosi - k**0.5) * normal
-    return R
+    # Snell's Law, or None on Total Internal Reflection
+    return vec3(direction).refract(vec3(normal), ior)
 
 
 def fresnel(normal, direction, ior):
     # Fresnel Equation
-    cosi = max(-1, min(1, np.dot(direction, normal)))
+    cosi = max(-1, min(1, vec3(direction).dot(vec3(normal))))
     etai = 1
     etat = ior
 
     if cosi > 0:
         etai, etat = etat, etai
 
-    sint = etai / etat * (max(0, 1 - cosi**2) ** 0.5)
+    sint = etai / etat * sqrt(max(0, 1 - cosi * cosi))
 
 
     if sint >= 1: # Total Internal Reflection
         return 1
 
-    cost = max(0, 1 - sint**2) ** 0.5
+    cost = sqrt(max(0, 1 - sint * sint))
     cosi = abs(cosi)
 
     Rs = ((etat * cosi) - (etai * cost)) / ((etat * cosi) + (etai * cost))
@@ -57,6 +38,51 @@ def fresnel(normal, direction, ior):
     return (Rs**2 + Rp**2) / 2
 
 
+def reflectVectorMany(normals, directions):
+    reflect = 2 * np.sum(normals * directions, axis = 1)
+    reflect = reflect[:, None] * normals
+    reflect = np.subtract(reflect, directions)
+    reflect = reflect / np.linalg.norm(reflect, axis = 1)[:, None]
+    return reflect
+
+def refractVectorMany(normals, directions, iors):
+    # Snell's Law, per ray. Rays under total internal reflection come back
+    # as NaN; callers only refract where fresnel is below 1.
+    cosi = np.clip(np.sum(directions * normals, axis = 1), -1, 1)
+    etai = np.ones(len(cosi))
+    etat = np.broadcast_to(iors, cosi.shape).astype(float)
+
+    inside = cosi >= 0
+    cosi = np.where(inside, cosi, -cosi)
+    etai, etat = np.where(inside, etat, etai), np.where(inside, etai, etat)
+    normals = np.where(inside[:, None], -normals, normals)
+
+    eta = etai / etat
+    k = 1 - (eta**2) * (1 - (cosi**2) )
+
+    R = eta[:, None] * directions + (eta * cosi - k**0.5)[:, None] * normals
+    return R
+
+def fresnelMany(normals, directions, iors):
+    cosi = np.clip(np.sum(directions * normals, axis = 1), -1, 1)
+    etai = np.ones(len(cosi))
+    etat = np.broadcast_to(iors, cosi.shape).astype(float)
+
+    inside = cosi > 0
+    etai, etat = np.where(inside, etat, etai), np.where(inside, etai, etat)
+
+    sint = etai / etat * (np.maximum(0, 1 - cosi**2) ** 0.5)
+
+    cost = np.maximum(0, 1 - sint**2) ** 0.5
+    cosi = np.abs(cosi)
+
+    Rs = ((etat * cosi) - (etai * cost)) / ((etat * cosi) + (etai * cost))
+    Rp = ((etai * cosi) - (etat * cost)) / ((etai * cosi) + (etat * cost))
+
+    # Total Internal Reflection
+    return np.where(sint >= 1, 1, (Rs**2 + Rp**2) / 2)
+
+
 class DirectionalLight(object):
     def __init__(self, direction = (0,-1,0), intensity = 1, color = (1,1,1)):
         self.direction = direction / np.linalg.norm(direction)
@@ -64,40 +90,94 @@ class DirectionalLight(object):
         self.color = color
         self.lightType = DIR_LIGHT
 
+        # Neighbouring points tend to be shadowed by the same object
+        self.lastOccluder = None
+
     def getDiffuseColor(self, intersect, raytracer):
-        light_dir = np.array(self.direction) * -1
-        intensity = np.dot(intersect.normal, light_dir) * self.intensity
-        intensity = float(max(0, intensity))            
-                                                        
-        diffuseColor = np.array([intensity * self.color[0],
-                                 intensity * self.color[1],
-                                 intensity * self.color[2]])
+        light_dir = -vec3(self.direction)
+        intensity = intersect.normal.dot(light_dir) * self.intensity
+        intensity = max(0, intensity)
 
-        return diffuseColor
+        return vec3(self.color) * intensity
 
     def getSpecColor(self, intersect, raytracer):
-        light_dir = np.array(self.direction) * -1
-        reflect = reflectVector(intersect.normal, light_dir)
+        light_dir = -vec3(self.direction)
+        reflect = light_dir.reflect(intersect.normal)
 
-        view_dir = np.subtract( raytracer.camPosition, intersect.point)
-        view_dir = view_dir / np.linalg.norm(view_dir)
+        view_dir = (vec3(raytracer.camPosition) - intersect.point).normalized()
 
-        spec_intensity = self.intensity * max(0,np.dot(view_dir, reflect)) ** intersect.sceneObj.material.spec
-        specColor = np.array([spec_intensity * self.color[0],
-                              spec_intensity * self.color[1],
-                              spec_intensity * self.color[2]])
+        spec_intensity = self.intensity * max(0, view_dir.dot(reflect)) ** intersect.sceneObj.material.spec
 
-        return specColor
+        return vec3(self.color) * spec_intensity
 
     def getShadowIntensity(self, intersect, raytracer):
+        light_dir = -vec3(self.direction)
+
+        occluder = raytracer.scene_occluded(intersect.point, light_dir, intersect.sceneObj,
+                                            hint = self.lastOccluder)
+        if occluder is None:
+            return 0
+
+        self.lastOccluder = occluder
+        return 1
+
+    def shade(self, intersect, raytracer):
+        # Diffuse plus specular color of the light at the hit, on plain
+        # floats, or None if something blocks the light
+        light_dir = -vec3(self.direction)
+
+        occluder = raytracer.scene_occluded(intersect.point, light_dir, intersect.sceneObj,
+                                            hint = self.lastOccluder)
+        if occluder is not None:
+            self.lastOccluder = occluder
+            return None
+
+        normal = intersect.normal
+
+        NdotL = normal.dot(light_dir)
+        intensity = max(0, NdotL * self.intensity)
+
+        reflect = normal * (2 * NdotL) - light_dir
+        view_dir = vec3(raytracer.camPosition) - intersect.point
+
+        VdotR = view_dir.dot(reflect) / (view_dir.length() * reflect.length())
+        spec_intensity = self.intensity * max(0, VdotR) ** intersect.sceneObj.material.spec
+
+        return vec3(self.color) * (intensity + spec_intensity)
+
+    def shadeMany(self, points, normals, specs, sceneObjs, raytracer):
+        # Batched shade, with black for the points the light does not reach
         light_dir = np.array(self.direction) * -1
 
-        shadow_intensity = 0
-        shadow_intersect = raytracer.scene_intersect(intersect.point, light_dir, intersect.sceneObj)
-        if shadow_intersect:
-            shadow_intensity = 1
+        colors = np.zeros(points.shape)
+        lit = ~raytracer.scene_occluded_many(points, light_dir, sceneObjs)
+        points = points[lit]
+        normals = normals[lit]
 
-        return shadow_intensity
+        NdotL = np.dot(normals, light_dir)
+        intensity = np.maximum(0, NdotL * self.intensity)
+
+        reflect = 2 * NdotL[:, None] * normals - light_dir
+        reflect = reflect / np.linalg.norm(reflect, axis = 1)[:, None]
+
+        view_dirs = np.subtract(raytracer.camPosition, points)
+        view_dirs = view_dirs / np.linalg.norm(view_dirs, axis = 1)[:, None]
+
+        spec_intensity = self.intensity * np.maximum(0, np.sum(view_dirs * reflect, axis = 1)) ** specs[lit]
+
+        colors[lit] = (intensity + spec_intensity)[:, None] * np.array(self.color)
+        return colors
+
+    def getSpecColorMany(self, points, normals, specs, raytracer):
+        light_dir = np.array(self.direction) * -1
+        reflect = reflectVectorMany(normals, np.broadcast_to(light_dir, normals.shape))
+
+        view_dirs = np.subtract(raytracer.camPosition, points)
+        view_dirs = view_dirs / np.linalg.norm(view_dirs, axis = 1)[:, None]
+
+        spec_intensity = self.intensity * np.maximum(0, np.sum(view_dirs * reflect, axis = 1)) ** specs
+
+        return spec_intensity[:, None] * np.array(self.color)
 
 
 class PointLight(object):
@@ -109,56 +189,116 @@ class PointLight(object):
         self.color = color
         self.lightType = POINT_LIGHT
 
+        # Neighbouring points tend to be shadowed by the same object
+        self.lastOccluder = None
+
     def getDiffuseColor(self, intersect, raytracer):
-        light_dir = np.subtract(self.point, intersect.point)
-        light_dir = light_dir / np.linalg.norm(light_dir)
+        light_dir = (vec3(self.point) - intersect.point).normalized()
 
         # att = 1 / (Kc + Kl * d + Kq * d * d)
         #lightDistance = np.linalg.norm(np.subtract(self.point, intersect.point))
         #attenuation = 1.0 / (self.constant + self.linear * lightDistance + self.quad * lightDistance ** 2)
         attenuation = 1.0
-        intensity = np.dot(intersect.normal, light_dir) * attenuation
-        intensity = float(max(0, intensity))            
-                                                        
-        diffuseColor = np.array([intensity * self.color[0],
-                                 intensity * self.color[1],
-                                 intensity * self.color[2]])
+        intensity = intersect.normal.dot(light_dir) * attenuation
+        intensity = max(0, intensity)
 
-        return diffuseColor
+        return vec3(self.color) * intensity
 
     def getSpecColor(self, intersect, raytracer):
-        light_dir = np.subtract(self.point, intersect.point)
-        light_dir = light_dir / np.linalg.norm(light_dir)
+        light_dir = (vec3(self.point) - intersect.point).normalized()
 
-        reflect = reflectVector(intersect.normal, light_dir)
+        reflect = light_dir.reflect(intersect.normal)
 
-        view_dir = np.subtract( raytracer.camPosition, intersect.point)
-        view_dir = view_dir / np.linalg.norm(view_dir)
+        view_dir = (vec3(raytracer.camPosition) - intersect.point).normalized()
 
         # att = 1 / (Kc + Kl * d + Kq * d * d)
         #lightDistance = np.linalg.norm(np.subtract(self.point, intersect.point))
         #attenuation = 1.0 / (self.constant + self.linear * lightDistance + self.quad * lightDistance ** 2)
         attenuation = 1.0
 
-        spec_intensity = attenuation * max(0,np.dot(view_dir, reflect)) ** intersect.sceneObj.material.spec
-        specColor = np.array([spec_intensity * self.color[0],
-                              spec_intensity * self.color[1],
-                              spec_intensity * self.color[2]])
+        spec_intensity = attenuation * max(0, view_dir.dot(reflect)) ** intersect.sceneObj.material.spec
 
-        return specColor
+        return vec3(self.color) * spec_intensity
 
     def getShadowIntensity(self, intersect, raytracer):
-        light_dir = np.subtract(self.point, intersect.point)
-        light_distance = np.linalg.norm(light_dir)
+        light_dir = vec3(self.point) - intersect.point
+        light_distance = light_dir.length()
+        light_dir = light_dir / light_distance
+
+        occluder = raytracer.scene_occluded(intersect.point, light_dir, intersect.sceneObj,
+                                            light_distance, self.lastOccluder)
+        if occluder is None:
+            return 0
+
+        self.lastOccluder = occluder
+        return 1
+
+    def shade(self, intersect, raytracer):
+        # Diffuse plus specular color of the light at the hit, on plain
+        # floats, or None if something blocks the light
+        light_dir = vec3(self.point) - intersect.point
+        light_distance = light_dir.length()
         light_dir = light_dir / light_distance
 
-        shadow_intensity = 0
-        shadow_intersect = raytracer.scene_intersect(intersect.point, light_dir, intersect.sceneObj)
-        if shadow_intersect:
-            if shadow_intersect.distance < light_distance:
-                shadow_intensity = 1
+        occluder = raytracer.scene_occluded(intersect.point, light_dir, intersect.sceneObj,
+                                            light_distance, self.lastOccluder)
+        if occluder is not None:
+            self.lastOccluder = occluder
+            return None
+
+        normal = intersect.normal
+
+        NdotL = normal.dot(light_dir)
+        intensity = max(0, NdotL)
+
+        reflect = normal * (2 * NdotL) - light_dir
+        view_dir = vec3(raytracer.camPosition) - intersect.point
+
+        VdotR = view_dir.dot(reflect) / (view_dir.length() * reflect.length())
+        spec_intensity = max(0, VdotR) ** intersect.sceneObj.material.spec
+
+        return vec3(self.color) * (intensity + spec_intensity)
+
+    def shadeMany(self, points, normals, specs, sceneObjs, raytracer):
+        # Batched shade, with black for the points the light does not reach
+        light_dirs = np.subtract(self.point, points)
+        light_distances = np.linalg.norm(light_dirs, axis = 1)
+        light_dirs = light_dirs / light_distances[:, None]
+
+        colors = np.zeros(points.shape)
+        lit = ~raytracer.scene_occluded_many(points, light_dirs, sceneObjs, light_distances)
+        points = points[lit]
+        normals = normals[lit]
+        light_dirs = light_dirs[lit]
+
+        NdotL = np.sum(normals * light_dirs, axis = 1)
+        intensity = np.maximum(0, NdotL)
+
+        reflect = 2 * NdotL[:, None] * normals - light_dirs
+        reflect = reflect / np.linalg.norm(reflect, axis = 1)[:, None]
+
+        view_dirs = np.subtract(raytracer.camPosition, points)
+        view_dirs = view_dirs / np.linalg.norm(view_dirs, axis = 1)[:, None]
+
+        spec_intensity = np.maximum(0, np.sum(view_dirs * reflect, axis = 1)) ** specs[lit]
+
+        colors[lit] = (intensity + spec_intensity)[:, None] * np.array(self.color)
+        return colors
+
+    def getSpecColorMany(self, points, normals, specs, raytracer):
+        light_dirs = np.subtract(self.point, points)
+        light_dirs = light_dirs / np.linalg.norm(light_dirs, axis = 1)[:, None]
+
+        reflect = reflectVectorMany(normals, light_dirs)
+
+        view_dirs = np.subtract(raytracer.camPosition, points)
+        view_dirs = view_dirs / np.linalg.norm(view_dirs, axis = 1)[:, None]
+
+        attenuation = 1.0
+
+        spec_intensity = attenuation * np.maximum(0, np.sum(view_dirs * reflect, axis = 1)) ** specs
 
-        return shadow_intensity
+        return spec_intensity[:, None] * np.array(self.color)
 
 
 class AmbientLight(object):
@@ -168,10 +308,10 @@ class AmbientLight(object):
         self.lightType = AMBIENT_LIGHT
 
     def getDiffuseColor(self, intersect, raytracer):
-        return np.array(self.color) * self.intensity
+        return vec3(self.color) * self.intensity
 
     def getSpecColor(self, intersect, raytracer):
-        return np.array([0,0,0])
+        return Vec3(0.0, 0.0, 0.0)
 
     def getShadowIntensity(self, intersect, raytracer):
-        return 0
\ No newline at end of file
+        return 0
@@ -1,9 +1,118 @@
 
 # Rebecca Smith
+from math import sqrt, sin, cos, pi
 from collections import namedtuple
 
 V3 = namedtuple('Point3', ['x', 'y', 'z'])
 
+
+class Vec3(object):
+    # 3D vector on plain floats for the code that runs once per ray, where
+    # a numpy call costs far more than the math on 3 numbers. It iterates
+    # and indexes like a tuple, so np.array(v) and x, y, z = v still work.
+    # Sums go left to right and squares are products, as numpy does them
+    # for a row, so results round the same as in the batched code.
+    __slots__ = ('x', 'y', 'z')
+
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+    def __iter__(self):
+        return iter((self.x, self.y, self.z))
+
+    def __getitem__(self, i):
+        return (self.x, self.y, self.z)[i]
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return "Vec3({}, {}, {})".format(self.x, self.y, self.z)
+
+    def __add__(self, other):
+        return Vec3(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return Vec3(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __mul__(self, k):
+        # By a number, or component by component by another vector, as
+        # colors are
+        if isinstance(k, Vec3):
+            return Vec3(self.x * k.x, self.y * k.y, self.z * k.z)
+        return Vec3(self.x * k, self.y * k, self.z * k)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, k):
+        return Vec3(self.x / k, self.y / k, self.z / k)
+
+    def __neg__(self):
+        return Vec3(-self.x, -self.y, -self.z)
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def cross(self, other):
+        return Vec3(self.y * other.z - self.z * other.y,
+                    self.z * other.x - self.x * other.z,
+                    self.x * other.y - self.y * other.x)
+
+    def length(self):
+        return sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
+    def normalized(self):
+        length = self.length()
+        return Vec3(self.x / length, self.y / length, self.z / length)
+
+    def along(self, dir, t):
+        # P = O + t*D, without the intermediate vector
+        return Vec3(self.x + t * dir.x, self.y + t * dir.y, self.z + t * dir.z)
+
+    def reflect(self, normal):
+        # This vector, pointing away from the surface, mirrored around the
+        # normal, normalized
+        NdotV = 2 * (normal.x * self.x + normal.y * self.y + normal.z * self.z)
+        return Vec3(NdotV * normal.x - self.x,
+                    NdotV * normal.y - self.y,
+                    NdotV * normal.z - self.z).normalized()
+
+    def refract(self, normal, ior):
+        # Snell's Law for this direction going into a surface of index ior,
+        # or out of it when it leaves through the back. None on total
+        # internal reflection.
+        cosi = max(-1, min(1, self.x * normal.x + self.y * normal.y + self.z * normal.z))
+        etai = 1
+        etat = ior
+
+        if cosi < 0:
+            cosi = -cosi
+        else:
+            etai, etat = etat, etai
+            normal = -normal
+
+        eta = etai / etat
+        k = 1 - (eta * eta) * (1 - (cosi * cosi))
+
+        if k < 0:
+            return None
+
+        f = eta * cosi - sqrt(k)
+        return Vec3(eta * self.x + f * normal.x,
+                    eta * self.y + f * normal.y,
+                    eta * self.z + f * normal.z)
+
+
+def vec3(v):
+    # Any sequence of 3 numbers as a Vec3 of floats. Numpy arrays are
+    # turned into a list first, which beats indexing them.
+    if isinstance(v, Vec3):
+        return v
+    x, y, z = v.tolist() if hasattr(v, 'tolist') else v
+    return Vec3(float(x), float(y), float(z))
+
 def matriz(m1, m2):
     result=[]
     for i in range(len(m1)):
@@ -109,4 +218,81 @@ def listas(l1,l2):
     Result = []
     for i1, i2 in zip(l1, l2):
         Result.append(i1*i2)
-    return Result
\ No newline at end of file
+    return Result
+
+
+def createRotationMatrix(rotate):
+    # Rotation in degrees around x, then y, then z, as a 4x4 matrix
+    pitch, yaw, roll = [angle * pi / 180 for angle in rotate]
+
+    rotationX = [[1, 0, 0, 0],
+                 [0, cos(pitch), -sin(pitch), 0],
+                 [0, sin(pitch), cos(pitch), 0],
+                 [0, 0, 0, 1]]
+
+    rotationY = [[cos(yaw), 0, sin(yaw), 0],
+                 [0, 1, 0, 0],
+                 [-sin(yaw), 0, cos(yaw), 0],
+                 [0, 0, 0, 1]]
+
+    rotationZ = [[cos(roll), -sin(roll), 0, 0],
+                 [sin(roll), cos(roll), 0, 0],
+                 [0, 0, 1, 0],
+                 [0, 0, 0, 1]]
+
+    return matriz(matriz(rotationZ, rotationY), rotationX)
+
+def createObjectMatrix(translate = (0,0,0), rotate = (0,0,0), scale = (1,1,1)):
+    # Scale, then rotate, then translate, as a 4x4 matrix
+    translation = [[1, 0, 0, translate[0]],
+                   [0, 1, 0, translate[1]],
+                   [0, 0, 1, translate[2]],
+                   [0, 0, 0, 1]]
+
+    scaleMat = [[scale[0], 0, 0, 0],
+                [0, scale[1], 0, 0],
+                [0, 0, scale[2], 0],
+                [0, 0, 0, 1]]
+
+    return matriz(matriz(translation, createRotationMatrix(rotate)), scaleMat)
+
+# Sine of the angle under which the up of createLookAtMatrix counts as
+# parallel to the view direction
+LOOK_AT_PARALLEL = 1e-6
+
+def createLookAtMatrix(eye, target, up = (0,1,0)):
+    # Camera to world matrix of a camera at eye looking at target, which
+    # like the default camera looks down its -z with up along its +y. An up
+    # parallel to the view, as when looking straight down, gives no right
+    # vector, so -z is taken as up instead, or +y when looking along z.
+    eye = vec3(eye)
+    offset = eye - vec3(target)
+    if offset.length() == 0:
+        raise ValueError("Look at target is the camera position: {}".format(eye))
+
+    forward = offset.normalized()
+    up = vec3(up)
+    right = up.cross(forward)
+    if right.length() <= LOOK_AT_PARALLEL * up.length():
+        up = Vec3(0, 0, -1) if abs(forward.z) < 0.9 else Vec3(0, 1, 0)
+        right = up.cross(forward)
+
+    right = right.normalized()
+    up = forward.cross(right)
+
+    return [[right.x, up.x, forward.x, eye.x],
+            [right.y, up.y, forward.y, eye.y],
+            [right.z, up.z, forward.z, eye.z],
+            [0, 0, 0, 1]]
+
+def transformPoint(m, v):
+    # Point v times the 4x4 matrix m, taking w = 1
+    return Vec3(m[0][0] * v.x + m[0][1] * v.y + m[0][2] * v.z + m[0][3],
+                m[1][0] * v.x + m[1][1] * v.y + m[1][2] * v.z + m[1][3],
+                m[2][0] * v.x + m[2][1] * v.y + m[2][2] * v.z + m[2][3])
+
+def transformDirection(m, v):
+    # Direction v times the 4x4 matrix m, taking w = 0
+    return Vec3(m[0][0] * v.x + m[0][1] * v.y + m[0][2] * v.z,
+                m[1][0] * v.x + m[1][1] * v.y + m[1][2] * v.z,
+                m[2][0] * v.x + m[2][1] * v.y + m[2][2] * v.z)
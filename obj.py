@@ -1,35 +1,119 @@
+import os
+from array import array
+import numpy as np
+
+# Arrays of an Obj, in the order they are stored in its cache file
+CACHE_ARRAYS = ('stamp', 'vertices', 'texcoords', 'normals', 'vertIdx', 'texIdx', 'normalIdx')
+
 
 class Obj(object):
-    def __init__(self, filename):
-        with open(filename, "r") as file:
-            self.lines = file.read().splitlines()
+    # Wavefront OBJ model as arrays: float32 vertices, texcoords and
+    # normals, and int32 (F,3) index arrays of the triangulated faces.
+    # Indices are 0-based, and -1 where a face corner has no texcoord
+    # or normal.
+
+    def __init__(self, filename, cache = False):
+        self.filename = filename
+        self.cacheFilename = filename + '.cache'
+
+        if cache and self.loadCache():
+            return
+
+        self.parse()
+
+        if cache:
+            self.saveCache()
+
+    def parse(self):
+        vertices = array('f')
+        texcoords = array('f')
+        normals = array('f')
+        vertIdx = array('i')
+        texIdx = array('i')
+        normalIdx = array('i')
+
+        def index(value, count):
+            # OBJ indices start at 1, negative ones count back from the end
+            if not value:
+                return -1
+            value = int(value)
+            return value - 1 if value > 0 else count + value
+
+        with open(self.filename, "r") as file:
+            for line in file:
+                values = line.split()
+                if not values:
+                    continue
+
+                prefix = values[0]
+
+                if prefix == 'v': # Vertices
+                    vertices.extend(map(float, values[1:4]))
+                elif prefix == 'vt':
+                    uv = list(map(float, values[1:3]))
+                    texcoords.extend(uv + [0.0] * (2 - len(uv)))
+                elif prefix == 'vn':
+                    normals.extend(map(float, values[1:4]))
+                elif prefix == 'f':
+                    corners = []
+                    for vert in values[1:]:
+                        parts = vert.split('/') + ['', '']
+                        corners.append((index(parts[0], len(vertices) // 3),
+                                        index(parts[1], len(texcoords) // 2),
+                                        index(parts[2], len(normals) // 3)))
+
+                    # Fan out polygons into triangles
+                    for i in range(1, len(corners) - 1):
+                        for corner in (corners[0], corners[i], corners[i + 1]):
+                            vertIdx.append(corner[0])
+                            texIdx.append(corner[1])
+                            normalIdx.append(corner[2])
+
+        self.vertices = np.frombuffer(vertices, dtype = np.float32).reshape(-1, 3)
+        self.texcoords = np.frombuffer(texcoords, dtype = np.float32).reshape(-1, 2)
+        self.normals = np.frombuffer(normals, dtype = np.float32).reshape(-1, 3)
+        self.vertIdx = np.frombuffer(vertIdx, dtype = np.int32).reshape(-1, 3)
+        self.texIdx = np.frombuffer(texIdx, dtype = np.int32).reshape(-1, 3)
+        self.normalIdx = np.frombuffer(normalIdx, dtype = np.int32).reshape(-1, 3)
 
-        self.vertices = []
-        self.texcoords = []
-        self.normals = []
-        self.faces = []
+    def getStamp(self):
+        stat = os.stat(self.filename)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype = np.int64)
 
-        for line in self.lines:
-            try:
-                prefix, value = line.split(' ', 1)
-            except:
-                continue
+    def saveCache(self):
+        self.stamp = self.getStamp()
 
-            if prefix == 'v': # Vertices
-                self.vertices.append( list(map(float,value.split(' '))))
-            elif prefix == 'vt':
-                self.texcoords.append( list(map(float, value.split(' '))))
-            elif prefix == 'vn':
-                self.normals.append( list(map(float, value.split(' '))))
-            elif prefix == 'f':
-                self.faces.append([  list(map(int, vert.split('/'))) for vert in value.split(' ')] )
+        with open(self.cacheFilename, "wb") as file:
+            for name in CACHE_ARRAYS:
+                np.lib.format.write_array(file, np.ascontiguousarray(getattr(self, name)))
 
-       
+    def loadCache(self):
+        # Memory maps the arrays of a cache written from this version of
+        # the model, if there is one
+        if not os.path.exists(self.cacheFilename):
+            return False
 
+        arrays = {}
+        with open(self.cacheFilename, "rb") as file:
+            for name in CACHE_ARRAYS:
+                if np.lib.format.read_magic(file) == (1, 0):
+                    shape, fortran, dtype = np.lib.format.read_array_header_1_0(file)
+                else:
+                    shape, fortran, dtype = np.lib.format.read_array_header_2_0(file)
+                offset = file.tell()
 
-            
+                if np.prod(shape) == 0:
+                    arrays[name] = np.zeros(shape, dtype = dtype)
+                else:
+                    arrays[name] = np.memmap(self.cacheFilename, dtype = dtype, mode = 'r',
+                                             offset = offset, shape = shape)
 
+                file.seek(offset + int(np.prod(shape)) * dtype.itemsize)
 
+        if not np.array_equal(arrays['stamp'], self.getStamp()):
+            return False
 
+        for name, value in arrays.items():
+            setattr(self, name, value)
 
-        
+        return True
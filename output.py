@@ -0,0 +1,169 @@
+import os
+import zlib
+import struct
+import numpy as np
+
+# Rows of a framebuffer go bottom up, indexed [y, x], with BGR bytes.
+# Writers take them a band of rows at a time, in any order, as they are
+# rendered. BMP, PPM and HDR files have a fixed size, so they are memory
+# mapped and every band goes straight to its place in the file; rows
+# already written stay there even if the render dies. PNG is compressed
+# and goes top down, so bands wait until the ones above them are written.
+
+
+def mapFile(filename, header, shape, dtype = np.uint8):
+    # Writes the header and memory maps the rest of a file of the right
+    # size, which stays sparse until rows are written to it
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    with open(filename, "wb") as file:
+        file.write(header)
+        file.truncate(len(header) + size)
+
+    if size == 0:
+        return np.zeros(shape, dtype = dtype)
+
+    return np.memmap(filename, dtype = dtype, mode = 'r+', offset = len(header), shape = shape)
+
+
+class BMPWriter(object):
+    # 24 bit BMP. Its rows go bottom up, padded to a multiple of 4 bytes.
+    def __init__(self, filename, width, height):
+        self.width = width
+        self.height = height
+
+        rowSize = (width * 3 + 3) & ~3
+        header = (struct.pack('<2sIHHI', b'BM', 14 + 40 + rowSize * height, 0, 0, 14 + 40) +
+                  struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0, rowSize * height, 0, 0, 0, 0))
+
+        self.map = mapFile(filename, header, (height, rowSize))
+        self.rows = self.map[:, :width * 3].reshape(height, width, 3)
+
+    def writeRows(self, y, pixels):
+        self.rows[y:y + len(pixels)] = pixels
+
+    def close(self):
+        if isinstance(self.map, np.memmap):
+            self.map.flush()
+        del self.rows, self.map
+
+
+class PPMWriter(object):
+    # Binary PPM, with RGB rows top down
+    def __init__(self, filename, width, height):
+        self.width = width
+        self.height = height
+
+        header = "P6\n{} {}\n255\n".format(width, height).encode('ascii')
+
+        self.map = mapFile(filename, header, (height, width, 3))
+        self.rows = self.map[::-1, :, ::-1]
+
+    def writeRows(self, y, pixels):
+        self.rows[y:y + len(pixels)] = pixels
+
+    def close(self):
+        if isinstance(self.map, np.memmap):
+            self.map.flush()
+        del self.rows, self.map
+
+
+class HDRWriter(object):
+    # Radiance HDR of float RGB colors, stored as flat RGBE scanlines top
+    # down. Unlike the others it takes (rows, width, 3) arrays of RGB floats.
+    def __init__(self, filename, width, height):
+        self.width = width
+        self.height = height
+
+        header = "#?RADIANCE\nFORMAT=32-bit_rle_rgbe\n\n-Y {} +X {}\n".format(height, width).encode('ascii')
+
+        self.map = mapFile(filename, header, (height, width, 4))
+        self.rows = self.map[::-1]
+
+    def writeRows(self, y, colors):
+        colors = np.maximum(colors, 0)
+        brightest = colors.max(axis = 2)
+
+        # Shared exponent of the brightest channel; the others keep the
+        # same scale
+        mantissa, exponent = np.frexp(brightest)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            scale = mantissa * 256 / brightest
+
+        rgbe = np.zeros(colors.shape[:2] + (4,), dtype = np.uint8)
+        lit = brightest >= 1e-32
+        rgbe[lit, :3] = colors[lit] * scale[lit, None]
+        rgbe[lit, 3] = exponent[lit] + 128
+
+        self.rows[y:y + len(colors)] = rgbe
+
+    def close(self):
+        if isinstance(self.map, np.memmap):
+            self.map.flush()
+        del self.rows, self.map
+
+
+class PNGWriter(object):
+    # 8 bit RGB PNG. Every band that completes the image down from the
+    # top is compressed and written as an IDAT chunk.
+    def __init__(self, filename, width, height, level = 6):
+        self.width = width
+        self.height = height
+
+        self.file = open(filename, "wb")
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.writeChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+        self.compressor = zlib.compressobj(level)
+
+        # Framebuffer row under the last one written, and bands still
+        # waiting for the ones above them, by their top row
+        self.nextRow = height
+        self.pending = {}
+
+    def writeChunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data +
+                        struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def writeRows(self, y, pixels):
+        self.pending[y + len(pixels)] = (y, pixels)
+
+        while self.nextRow in self.pending:
+            y, pixels = self.pending.pop(self.nextRow)
+
+            # Filter type 0 in front of every row, top down, RGB
+            data = np.zeros((len(pixels), self.width * 3 + 1), dtype = np.uint8)
+            data[:, 1:] = pixels[::-1, :, ::-1].reshape(len(pixels), -1)
+
+            # Flushed so every row written so far can be decoded
+            self.writeChunk(b'IDAT', self.compressor.compress(data.tobytes()) +
+                            self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.nextRow = y
+
+    def close(self):
+        self.writeChunk(b'IDAT', self.compressor.flush())
+        self.writeChunk(b'IEND', b'')
+        self.file.close()
+
+
+WRITERS = {'.bmp': BMPWriter,
+           '.ppm': PPMWriter,
+           '.png': PNGWriter}
+
+
+def openImage(filename, width, height):
+    # Writer of BGR byte rows for the format of the file extension
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError("Unknown image format: {}".format(filename))
+
+    return WRITERS[extension](filename, width, height)
+
+
+def writeImage(filename, pixels):
+    # Writes a whole (height, width, 3) framebuffer
+    height, width = pixels.shape[:2]
+
+    writer = openImage(filename, width, height)
+    writer.writeRows(0, pixels)
+    writer.close()
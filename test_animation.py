@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import bench
+from animation import Animation
+from gl import V3
+from figures import Sphere, AABB
+
+# Every frame an animation renders is the image a full render of the scene
+# as it is then gives, though it traces only the pixels that changed
+
+SIZE = 32
+
+
+def animatedScene(width, height):
+    rtx = bench.glassScene(width, height)
+    rtx.scene.append(Sphere((0, -1, -7), 0.8, bench.stone))
+    rtx.scene.append(AABB(position = (-3, 2, -9), size = (1,1,1), material = bench.mirror))
+    return rtx
+
+
+def moveSphere(rtx, frame):
+    rtx.scene[-2].center = (0.1 * frame, -1, -7)
+
+
+def replaceBox(rtx, frame):
+    rtx.scene[-1] = AABB(position = (-3, 2 + 0.2 * frame, -9), size = (1,1,1), material = bench.mirror)
+
+
+def addSphere(rtx, frame):
+    rtx.scene.append(Sphere((2, 2 - 0.5 * frame, -6), 0.3, bench.glass))
+
+
+def moveLight(rtx, frame):
+    rtx.lights[1].point = (0, 5, 5 - frame)
+
+
+def moveCamera(rtx, frame):
+    rtx.camPosition = V3(0.1 * frame, 0, 0)
+
+
+@pytest.mark.parametrize('edit, fullFrame', [(moveSphere, False),
+                                             (replaceBox, False),
+                                             (addSphere, False),
+                                             (moveLight, True),
+                                             (moveCamera, True)])
+def test_frames_match_full_renders(edit, fullFrame):
+    rtx = animatedScene(SIZE, SIZE)
+    animation = Animation(rtx)
+    animation.render()
+
+    for frame in range(1, 4):
+        edit(rtx, frame)
+        animation.render()
+
+        expected = animatedScene(SIZE, SIZE)
+        for i in range(1, frame + 1):
+            edit(expected, i)
+        expected.glRenderWavefront()
+
+        assert np.array_equal(rtx.pixels, expected.pixels)
+        assert animation.dirty.all() == fullFrame
+        if not fullFrame:
+            assert animation.dirty.any()
+
+
+def test_unchanged_frames_trace_nothing():
+    rtx = animatedScene(SIZE, SIZE)
+    animation = Animation(rtx)
+    animation.render()
+    expected = rtx.pixels.copy()
+
+    animation.render()
+    assert not animation.dirty.any()
+    assert np.array_equal(rtx.pixels, expected)
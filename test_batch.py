@@ -0,0 +1,77 @@
+import os
+import sys
+import subprocess
+import pytest
+
+import bench
+from batch import Job, renderJobs
+from gl import V3
+
+# Jobs rendered one after another by the same raytracer come out as they
+# would from a new raytracer each
+
+SIZE = 24
+
+JOBS = [dict(camPosition = (0,0,0)),
+        dict(camPosition = (2,1,0), target = (0,0,-15)),
+        dict(camPosition = (0,0,2), fov = 45, width = 32, height = 20)]
+
+
+def readFile(filename):
+    with open(filename, 'rb') as file:
+        return file.read()
+
+
+def renderFresh(jobs, filename):
+    # Last of the jobs, on a new raytracer set up by all of them, as fields
+    # a job leaves out keep the values of the jobs before it
+    job = jobs[-1]
+    rtx = bench.boxesScene(job.width or SIZE, job.height or SIZE)
+    for job in jobs:
+        if job.camPosition is not None:
+            rtx.camPosition = V3(*job.camPosition)
+        if job.target is not None:
+            rtx.lookAt(rtx.camPosition, job.target)
+        if job.fov is not None:
+            rtx.fov = job.fov
+
+    rtx.glRender()
+    rtx.glFinish(filename)
+    return readFile(filename)
+
+
+@pytest.mark.parametrize('mode', ('scalar', 'wavefront', 'parallel'))
+def test_jobs_match_fresh_renders(tmp_path, mode):
+    jobs = [Job(str(tmp_path / "job{}.bmp".format(i)), **job) for i, job in enumerate(JOBS)]
+    renderJobs(bench.boxesScene(SIZE, SIZE), jobs, mode, workers = 2)
+
+    for i, job in enumerate(jobs):
+        assert readFile(job.output) == renderFresh(jobs[:i + 1], str(tmp_path / "fresh{}.bmp".format(i)))
+
+
+# Two renders with one pool, in a process of their own so the warnings
+# of its resource tracker at exit can be read
+POOL_SCRIPT = """
+import numpy as np
+import bench
+
+rtx = bench.boxesScene(24, 24)
+rtx.glRender()
+expected = rtx.pixels.copy()
+
+pool = rtx.startTileWorkers(2)
+for i in range(2):
+    rtx.glClear()
+    rtx.glRenderParallel(pool = pool)
+    assert np.array_equal(rtx.pixels, expected)
+pool.close()
+pool.join()
+"""
+
+
+def test_pool_renders_twice_without_leaks():
+    result = subprocess.run([sys.executable, '-c', POOL_SCRIPT], capture_output = True, text = True,
+                            cwd = os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr
+    assert 'leaked' not in result.stderr
+    assert 'No such file' not in result.stderr
@@ -0,0 +1,49 @@
+import json
+import pytest
+
+import bench
+from gl import RenderStats
+
+# Scene benchmarks count every ray their render traces, and runs compare
+# by the time of each benchmark
+
+
+@pytest.mark.parametrize('mode', ['scalar', 'wavefront'])
+def test_scene_rays_are_every_ray_traced(mode):
+    result, = bench.sceneBenchmarks(16, (mode,), ['glass'])
+
+    rtx = bench.glassScene(16, 16)
+    rtx.stats = RenderStats(16, 16)
+    bench.RENDER_MODES[mode](rtx)
+
+    # Shadow and bounce rays too, not only the primary ones
+    assert result['rays'] == sum(rtx.stats.rays.values())
+    assert result['rays'] > rtx.stats.rays['primary']
+    assert type(result['rays']) is int
+    assert result['raysPerSecond'] == result['rays'] / result['seconds']
+    json.dumps(result)
+
+
+def test_compare_finds_regressions():
+    def results(*seconds):
+        return {'benchmarks': [{'name': name, 'seconds': s} for name, s in zip('abc', seconds)]}
+
+    baseline = results(1.0, 1.0, 1.0)
+    assert bench.compare(results(1.05, 0.5, 1.2), baseline, 0.1) == [('c', 1.0, 1.2)]
+    assert bench.compare(results(1.05, 0.5, 1.2), baseline, 0.25) == []
+
+
+def test_main_writes_and_compares_json(tmp_path):
+    filename = str(tmp_path / "results.json")
+    args = ['--no-micro', '--size', '8', '--scenes', 'boxes', '--json', filename]
+    assert bench.main(args) == 0
+
+    with open(filename) as file:
+        results = json.load(file)
+    assert [result['name'] for result in results['benchmarks']] == ['boxes.scalar.8']
+
+    # Against a baseline that took no time, every benchmark regressed
+    results['benchmarks'][0]['seconds'] = 0
+    with open(filename, "w") as file:
+        json.dump(results, file)
+    assert bench.main(['--no-micro', '--size', '8', '--scenes', 'boxes', '--compare', filename]) == 1
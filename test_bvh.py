@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+
+from gl import Raytracer
+from figures import *
+from lights import AmbientLight
+from obj import Obj
+from matesRS import createObjectMatrix
+from bench import CUBE_OBJ, stone
+
+# Scene_intersect against a loop over every object of the scene, on a mix
+# of every kind of figure the BVH holds and planes it keeps apart
+
+
+def randomScene(tmp_path, seed = 0, count = 60):
+    rng = np.random.default_rng(seed)
+    rtx = Raytracer(16, 16)
+
+    objFile = tmp_path / "cube.obj"
+    objFile.write_text(CUBE_OBJ)
+    cube = Obj(str(objFile))
+    box = AABB(position = (0,0,0), size = (1,1,1), material = stone)
+
+    rtx.scene.append(Plane(position = (0,-6,0), normal = (0,1,0), material = stone))
+
+    for i in range(count):
+        position = tuple(rng.uniform(-5, 5, 3) + (0, 0, -12))
+        kind = i % 5
+        if kind == 0:
+            obj = Sphere(position, rng.uniform(0.2, 1), stone)
+        elif kind == 1:
+            obj = AABB(position = position, size = tuple(rng.uniform(0.2, 1.5, 3)), material = stone)
+        elif kind == 2:
+            obj = Disk(position = position, radius = rng.uniform(0.2, 1), normal = tuple(rng.normal(size = 3)), material = stone)
+        elif kind == 3:
+            obj = Mesh(cube, stone, position = position, scale = tuple(rng.uniform(0.2, 0.8, 3)))
+        else:
+            obj = Instance(box, createObjectMatrix(position, tuple(rng.uniform(0, 90, 3)), tuple(rng.uniform(0.3, 1.5, 3))))
+        rtx.scene.append(obj)
+
+    return rtx
+
+
+def randomRays(seed = 0, count = 300):
+    rng = np.random.default_rng(seed)
+    origs = rng.uniform(-1, 1, (count, 3))
+    dirs = rng.normal(size = (count, 3)) * (0.4, 0.4, 1) - (0, 0, 1.5)
+    return origs, dirs / np.linalg.norm(dirs, axis = 1)[:, None]
+
+
+def bruteForce(rtx, orig, dir):
+    nearest = None
+    for obj in rtx.scene:
+        hit = obj.ray_intersect(orig, dir)
+        if hit is not None and (nearest is None or hit.distance < nearest.distance):
+            nearest = hit
+    return nearest
+
+
+def checkScalar(rtx, origs, dirs):
+    hits = 0
+    for orig, dir in zip(origs, dirs):
+        hit = rtx.scene_intersect(orig, dir, None)
+        expected = bruteForce(rtx, orig, dir)
+
+        assert (hit is None) == (expected is None)
+        if hit is not None:
+            assert hit.sceneObj is expected.sceneObj
+            assert hit.distance == pytest.approx(expected.distance)
+            hits += 1
+
+    # The rays should test something besides misses
+    assert hits > len(origs) // 4
+
+
+def checkBatched(rtx, origs, dirs):
+    hits = rtx.scene_intersect_many(origs, dirs)
+    index = {id(obj): i for i, obj in enumerate(rtx.scene)}
+
+    for k, (orig, dir) in enumerate(zip(origs, dirs)):
+        expected = bruteForce(rtx, orig, dir)
+
+        if expected is None:
+            assert not hits.hit[k]
+        else:
+            assert hits.sceneObj[k] == index[id(expected.sceneObj)]
+            assert hits.distance[k] == pytest.approx(expected.distance)
+
+
+def test_scene_intersect_matches_brute_force(tmp_path):
+    rtx = randomScene(tmp_path)
+    checkScalar(rtx, *randomRays())
+
+
+def test_scene_intersect_many_matches_brute_force(tmp_path):
+    rtx = randomScene(tmp_path)
+    checkBatched(rtx, *randomRays())
+
+
+def test_bvh_follows_scene_changes(tmp_path):
+    rtx = randomScene(tmp_path)
+    origs, dirs = randomRays(1)
+    checkScalar(rtx, origs, dirs)
+
+    # Moved in place, which refits the BVH
+    rng = np.random.default_rng(1)
+    for obj in rtx.scene:
+        if isinstance(obj, Sphere):
+            obj.center = tuple(np.add(obj.center, rng.uniform(-1, 1, 3)))
+    rtx.scene.changed()
+    checkScalar(rtx, origs, dirs)
+    checkBatched(rtx, origs, dirs)
+
+    # Added and removed, which builds it again
+    rtx.scene.append(Sphere((0, 0, -8), 1.5, stone))
+    del rtx.scene[10:20]
+    checkScalar(rtx, origs, dirs)
+    checkBatched(rtx, origs, dirs)
+
+
+@pytest.mark.parametrize('method', ['glRender', 'glRenderWavefront'])
+def test_replaced_scene_is_picked_up(method):
+    # A new list starts at the same version as the one it replaces
+    red = Material(diffuse = (1, 0, 0))
+    blue = Material(diffuse = (0, 0, 1))
+
+    rtx = Raytracer(8, 8)
+    rtx.lights = [AmbientLight(intensity = 1)]
+    rtx.scene = [Sphere((0, 0, -5), 2, red)]
+    getattr(rtx, method)()
+    # Pixels are BGR
+    assert list(rtx.pixels[4, 4]) == [0, 0, 255]
+
+    rtx.scene = [Sphere((0, 0, -5), 2, blue)]
+    getattr(rtx, method)()
+    assert list(rtx.pixels[4, 4]) == [255, 0, 0]
+
+    rtx.scene = [Sphere((3, 0, -8), 1, red)]
+    assert rtx.scene_intersect((0, 0, 0), (0, 0, -1), None) is None
+    assert rtx.scene_intersect((0, 0, 0), (0.35, 0, -0.937), None).sceneObj is rtx.scene[0]
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import bench
+from gl import Raytracer
+from figures import Sphere, AABB, Instance
+from matesRS import createObjectMatrix, createLookAtMatrix
+
+# Instances render as the figure they place would, and look-at cameras turn
+# to any target, straight up and down included
+
+SIZE = 24
+
+
+def sceneOf(*objects):
+    rtx = Raytracer(SIZE, SIZE)
+    bench.lightScene(rtx)
+    for obj in objects:
+        rtx.scene.append(obj)
+    return rtx
+
+
+@pytest.mark.parametrize('method', ['glRender', 'glRenderWavefront'])
+def test_instances_render_as_placed_figures(method):
+    sphere = Sphere((0,0,0), 1, bench.brick)
+    box = AABB(position = (0,0,0), size = (1,1,1), material = bench.stone)
+
+    instanced = sceneOf(Instance(sphere, createObjectMatrix((1,0,-6), (0,30,0), (1.5,1.5,1.5))),
+                        Instance(box, createObjectMatrix((-2,1,-8), scale = (2,1,3))))
+    placed = sceneOf(Sphere((1,0,-6), 1.5, bench.brick),
+                     AABB(position = (-2,1,-8), size = (2,1,3), material = bench.stone))
+
+    getattr(instanced, method)()
+    getattr(placed, method)()
+
+    assert np.array_equal(instanced.pixels, placed.pixels)
+
+
+@pytest.mark.parametrize('target', [(0,0,-5), (3,2,1), (0,-5,0), (0,5,0), (0,-5,-1e-9)])
+def test_look_at_basis_is_orthonormal(target):
+    eye = (0,0,0)
+    matrix = np.array(createLookAtMatrix(eye, target))
+    basis = matrix[:3, :3]
+
+    assert np.all(np.isfinite(matrix))
+    assert np.allclose(basis.T @ basis, np.eye(3))
+    assert np.isclose(np.linalg.det(basis), 1)
+
+    # The camera looks down its -z at the target
+    forward = -basis[:, 2]
+    assert np.allclose(forward, np.array(target) / np.linalg.norm(target))
+
+
+def test_look_at_keeps_up_when_it_can():
+    basis = np.array(createLookAtMatrix((0,0,0), (3,0,-4)))[:3, :3]
+    assert np.allclose(basis[:, 1], (0,1,0))
+
+
+def test_look_at_the_camera_position():
+    with pytest.raises(ValueError):
+        createLookAtMatrix((1,2,3), (1,2,3))
+
+
+@pytest.mark.parametrize('target', [(0,-10,-20), (0,10,-20)])
+def test_looking_straight_down_or_up_renders(target):
+    renders = []
+    for method in ('glRender', 'glRenderWavefront'):
+        rtx = bench.planesScene(SIZE, SIZE)
+        rtx.lookAt((0,0,-20), target)
+        getattr(rtx, method)()
+        renders.append(rtx.pixels)
+
+    # The floor or the ceiling, lit, fills the view
+    assert np.array_equal(renders[0], renders[1])
+    assert np.all(renders[0].max(axis = 2) > 0)
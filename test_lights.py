@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import bench
+from gl import Raytracer
+from figures import Material, Sphere
+from lights import *
+
+# Lights edited in place or replaced between renders light the next render
+# as they would a new raytracer
+
+SIZE = 24
+
+METHODS = ('glRender', 'glRenderWavefront')
+
+
+def render(rtx, method):
+    getattr(rtx, method)()
+    return rtx.pixels.copy()
+
+
+def editLights(rtx):
+    for light in rtx.lights:
+        if light.lightType == AMBIENT_LIGHT:
+            light.intensity = 0.4
+            light.color = (1, 0.5, 0.5)
+        elif light.lightType == POINT_LIGHT:
+            light.point = (4, 2, 0)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_edits_in_place_are_picked_up(method):
+    # No call to lights.changed(): the raytracer has to notice on its own
+    rtx = bench.boxesScene(SIZE, SIZE)
+    before = render(rtx, method)
+    editLights(rtx)
+    after = render(rtx, method)
+
+    fresh = bench.boxesScene(SIZE, SIZE)
+    editLights(fresh)
+    expected = render(fresh, method)
+
+    assert not np.array_equal(before, expected)
+    assert np.array_equal(after, expected)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_replaced_lights_are_picked_up(method):
+    # A new list starts at the same version as the one it replaces
+    rtx = Raytracer(8, 8)
+    rtx.scene = [Sphere((0, 0, -5), 2, Material())]
+    rtx.lights = [AmbientLight(intensity = 0.2)]
+    assert list(render(rtx, method)[4, 4]) == [51, 51, 51]
+
+    rtx.lights = [PointLight((0, 0, 0))]
+    pointLit = render(rtx, method)
+
+    fresh = Raytracer(8, 8)
+    fresh.scene = [Sphere((0, 0, -5), 2, Material())]
+    fresh.lights = [PointLight((0, 0, 0))]
+
+    assert np.array_equal(pointLit, render(fresh, method))
+    assert list(pointLit[4, 4]) != [51, 51, 51]
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+
+from obj import Obj, CACHE_ARRAYS
+
+# OBJ files load into triangulated index arrays, and a cache of them loads
+# back the same until the file changes
+
+MODEL = """# quad and triangle
+v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+vt 0 0
+vt 1 0
+vt 1 1
+vn 0 0 1
+
+f 1/1/1 2/2/1 3/3/1 4//1
+f -4 -3 -2
+"""
+
+
+def writeModel(tmp_path, text = MODEL):
+    filename = str(tmp_path / "model.obj")
+    with open(filename, "w") as file:
+        file.write(text)
+    return filename
+
+
+def test_parse(tmp_path):
+    model = Obj(writeModel(tmp_path))
+
+    assert model.vertices.dtype == np.float32 and model.vertices.shape == (4, 3)
+    assert model.texcoords.shape == (3, 2)
+    assert model.normals.shape == (1, 3)
+
+    # The quad fans out into two triangles; negative indices count back
+    # from the last vertex read
+    assert model.vertIdx.tolist() == [[0, 1, 2], [0, 2, 3], [0, 1, 2]]
+    assert model.texIdx.tolist() == [[0, 1, 2], [0, 2, -1], [-1, -1, -1]]
+    assert model.normalIdx.tolist() == [[0, 0, 0], [0, 0, 0], [-1, -1, -1]]
+
+
+def test_cache_loads_the_same_arrays(tmp_path):
+    filename = writeModel(tmp_path)
+    parsed = Obj(filename, cache = True)
+    assert os.path.exists(filename + '.cache')
+
+    cached = Obj(filename, cache = True)
+    for name in CACHE_ARRAYS[1:]:
+        assert isinstance(getattr(cached, name), np.memmap)
+        assert np.array_equal(getattr(cached, name), getattr(parsed, name))
+        assert getattr(cached, name).dtype == getattr(parsed, name).dtype
+
+
+def test_cache_of_a_changed_file_is_not_used(tmp_path):
+    filename = writeModel(tmp_path)
+    Obj(filename, cache = True)
+
+    writeModel(tmp_path, MODEL.replace("v 1 1 0", "v 2 2 0"))
+    model = Obj(filename, cache = True)
+    assert model.vertices[2].tolist() == [2, 2, 0]
+
+    # and the cache is written again for the new file
+    assert Obj(filename, cache = True).vertices[2].tolist() == [2, 2, 0]
@@ -0,0 +1,129 @@
+import zlib
+import struct
+import numpy as np
+import pytest
+
+import bench
+from output import openImage, writeImage, HDRWriter
+from texture import Texture
+
+# Files the writers make read back as the framebuffer they were given,
+# however its bands arrive
+
+
+def readPPM(filename):
+    data = open(filename, "rb").read()
+    magic, size, depth, pixels = data.split(b'\n', 3)
+    width, height = map(int, size.split())
+    assert (magic, depth) == (b'P6', b'255')
+    return np.frombuffer(pixels, dtype = np.uint8).reshape(height, width, 3)
+
+
+def readPNG(filename):
+    data = open(filename, "rb").read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+
+    pos = 8
+    idat = b''
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(chunk, zlib.crc32(kind))
+
+        if kind == b'IHDR':
+            width, height = struct.unpack('>II', chunk[:8])
+        elif kind == b'IDAT':
+            idat += chunk
+        pos += 12 + length
+
+    rows = np.frombuffer(zlib.decompress(idat), dtype = np.uint8).reshape(height, width * 3 + 1)
+    assert not rows[:, 0].any()
+    return rows[:, 1:].reshape(height, width, 3)
+
+
+def readHDR(filename):
+    data = open(filename, "rb").read()
+    size = data.index(b'\n-Y ') + 1
+    start = data.index(b'\n', size) + 1
+    height, width = map(int, data[size + 3:start].split(b' +X '))
+
+    rgbe = np.frombuffer(data[start:], dtype = np.uint8).reshape(height, width, 4).astype(float)
+    scale = np.where(rgbe[:, :, 3] > 0, np.ldexp(1.0, rgbe[:, :, 3].astype(int) - 136), 0)
+    return rgbe[:, :, :3] * scale[:, :, None]
+
+
+def randomPixels(width = 7, height = 13):
+    return np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype = np.uint8)
+
+
+def writeBands(writer, pixels, bandSize = 4):
+    # Bottom band first, the reverse of the order glRenderToFile writes in
+    for y in range(0, len(pixels), bandSize):
+        writer.writeRows(y, pixels[y:y + bandSize])
+    writer.close()
+
+
+def readImage(filename):
+    # Framebuffer layout: bottom up, BGR
+    if filename.endswith('.bmp'):
+        return Texture(filename).pixels[:, :, ::-1]
+    if filename.endswith('.ppm'):
+        return readPPM(filename)[::-1, :, ::-1]
+    return readPNG(filename)[::-1, :, ::-1]
+
+
+@pytest.mark.parametrize('extension', ['.bmp', '.ppm', '.png'])
+def test_writers_round_trip(tmp_path, extension):
+    pixels = randomPixels()
+    filename = str(tmp_path / ("image" + extension))
+
+    writeBands(openImage(filename, 7, 13), pixels)
+    assert np.array_equal(readImage(filename), pixels)
+
+    writeImage(filename, pixels)
+    assert np.array_equal(readImage(filename), pixels)
+
+
+def test_png_waits_for_the_bands_above(tmp_path):
+    pixels = randomPixels()
+    filename = str(tmp_path / "image.png")
+
+    writer = openImage(filename, 7, 13)
+    for y in (4, 0, 8, 12):
+        writer.writeRows(y, pixels[y:y + 4])
+    writer.close()
+
+    assert np.array_equal(readImage(filename), pixels)
+
+
+def test_hdr_round_trip(tmp_path):
+    colors = np.random.default_rng(0).uniform(0, 4, (13, 7, 3))
+    colors[0, 0] = 0
+    filename = str(tmp_path / "image.hdr")
+
+    writeBands(HDRWriter(filename, 7, 13), colors)
+    decoded = readHDR(filename)[::-1]
+
+    # Channels share the exponent of the brightest, with 8 bits under it
+    tolerance = colors.max(axis = 2, keepdims = True) / 128
+    assert np.all(np.abs(decoded - colors) <= tolerance)
+    assert not decoded[0, 0].any()
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        openImage(str(tmp_path / "image.tga"), 7, 13)
+
+
+@pytest.mark.parametrize('extension', ['.bmp', '.ppm', '.png'])
+def test_render_to_file_matches_render(tmp_path, extension):
+    rtx = bench.texturedScene(20, 15)
+    rtx.glRenderWavefront()
+
+    filename = str(tmp_path / ("image" + extension))
+    hdrFilename = str(tmp_path / "image.hdr")
+    bench.texturedScene(20, 15).glRenderToFile(filename, hdrFilename, bandSize = 4)
+
+    assert np.array_equal(readImage(filename), rtx.pixels)
+    assert readHDR(hdrFilename).shape == (15, 20, 3)
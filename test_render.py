@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+import bench
+from gl import Raytracer, RenderStats
+from figures import Material
+
+# Every way of rendering a scene gives the same image, and editing the
+# scene between renders gives the image a new raytracer would
+
+SIZE = 24
+
+METHODS = ('glRender', 'glRenderWavefront')
+
+
+def render(rtx, method):
+    getattr(rtx, method)()
+    return rtx.pixels.copy()
+
+
+@pytest.mark.parametrize('name', ['boxes', 'glass', 'textured', 'instances'])
+def test_wavefront_matches_scalar(name):
+    scalar = render(bench.SCENES[name](SIZE, SIZE), 'glRender')
+    wavefront = render(bench.SCENES[name](SIZE, SIZE), 'glRenderWavefront')
+
+    assert np.array_equal(scalar, wavefront)
+
+
+@pytest.mark.parametrize('wavefront', [False, True])
+def test_parallel_matches_scalar(wavefront):
+    scalar = render(bench.glassScene(SIZE, SIZE), 'glRender')
+
+    rtx = bench.glassScene(SIZE, SIZE)
+    rtx.glRenderParallel(workers = 2, tileSize = 8, wavefront = wavefront)
+
+    assert np.array_equal(scalar, rtx.pixels)
+
+
+def test_progressive_passes_end_in_the_full_render():
+    expected = render(bench.glassScene(SIZE, SIZE), 'glRenderWavefront')
+
+    rtx = bench.glassScene(SIZE, SIZE)
+    steps = (8, 4, 2, 1)
+    passes = 0
+    for step, pixels in zip(steps, rtx.glRenderProgressive(steps)):
+        # The pixels traced so far already have their final colors
+        assert np.array_equal(pixels[::step, ::step], expected[::step, ::step])
+        passes += 1
+
+    assert passes == len(steps)
+    assert np.array_equal(rtx.pixels, expected)
+
+
+@pytest.mark.parametrize('maxSamples', [4, 7, 16])
+def test_adaptive_samples_edges_up_to_max_samples(maxSamples):
+    rtx = bench.glassScene(SIZE, SIZE)
+    rtx.stats = RenderStats(SIZE, SIZE)
+    counts = rtx.glRenderAdaptive(maxSamples = maxSamples, tolerance = 0)
+
+    # With no tolerance, only refined pixels whose samples all came out
+    # the same stop before maxSamples
+    assert counts.shape == (SIZE, SIZE)
+    assert counts.min() == 1
+    assert counts.max() == maxSamples
+    assert rtx.stats.rays['primary'] == counts.sum()
+
+    # Pixels that were not refined keep the color of the full render
+    expected = render(bench.glassScene(SIZE, SIZE), 'glRenderWavefront')
+    single = counts == 1
+    assert np.array_equal(rtx.pixels[single], expected[single])
+
+
+def test_adaptive_leaves_flat_images_alone():
+    rtx = Raytracer(SIZE, SIZE)
+    counts = rtx.glRenderAdaptive()
+
+    assert np.all(counts == 1)
+    assert np.array_equal(rtx.pixels, render(Raytracer(SIZE, SIZE), 'glRenderWavefront'))
+
+
+def moveSphere(rtx):
+    sphere = rtx.scene[8]
+    sphere.center = (sphere.center[0] + 1, sphere.center[1], sphere.center[2])
+    sphere.radius *= 1.5
+
+
+def paintBox(rtx):
+    rtx.scene[12].material.diffuse = (0.1, 0.8, 0.2)
+
+
+def boxesScene(width, height):
+    # Boxes with a material of their own, which the edits can change
+    rtx = bench.boxesScene(width, height)
+    rtx.scene[12].material = Material(diffuse = (0.4, 0.4, 0.4), spec = 8)
+    return rtx
+
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('scene, edit', [(bench.glassScene, moveSphere),
+                                         (boxesScene, paintBox)])
+def test_edits_in_place_are_picked_up(scene, edit, method):
+    # No call to changed(): the raytracer has to notice on its own
+    rtx = scene(SIZE, SIZE)
+    before = render(rtx, method)
+    edit(rtx)
+    after = render(rtx, method)
+
+    fresh = scene(SIZE, SIZE)
+    edit(fresh)
+    expected = render(fresh, method)
+
+    assert not np.array_equal(before, expected)
+    assert np.array_equal(after, expected)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_added_and_removed_objects_are_picked_up(method):
+    rtx = bench.glassScene(SIZE, SIZE)
+    render(rtx, method)
+    rtx.scene.append(rtx.scene.pop(6))
+    del rtx.scene[3]
+    after = render(rtx, method)
+
+    fresh = bench.glassScene(SIZE, SIZE)
+    fresh.scene.append(fresh.scene.pop(6))
+    del fresh.scene[3]
+
+    assert np.array_equal(after, render(fresh, method))
@@ -0,0 +1,51 @@
+import json
+import numpy as np
+import pytest
+
+import bench
+from gl import RenderStats, RAY_KINDS
+
+# Render stats count the same rays whichever way the image is rendered,
+# as plain ints that a report or a JSON file can take
+
+SIZE = 16
+
+
+def renderStats(scene, mode):
+    rtx = bench.SCENES[scene](SIZE, SIZE)
+    rtx.stats = RenderStats(SIZE, SIZE)
+    bench.RENDER_MODES[mode](rtx)
+    return rtx.stats
+
+
+@pytest.mark.parametrize('scene', ('boxes', 'glass', 'instances'))
+def test_counts_are_ints(scene):
+    for mode in ('scalar', 'wavefront'):
+        stats = renderStats(scene, mode)
+        for counts in (stats.rays, stats.tests, stats.depths):
+            assert all(type(count) is int for count in counts.values())
+
+        json.dumps(stats.counters())
+
+
+@pytest.mark.parametrize('scene', ('boxes', 'glass', 'instances'))
+def test_parallel_counts_match_wavefront(scene):
+    wavefront = renderStats(scene, 'wavefront')
+    parallel = renderStats(scene, 'parallel')
+
+    # Tests are not compared: how many the BVH skips depends on which rays
+    # are traced together, so on the tiles
+    assert parallel.rays == wavefront.rays
+    assert parallel.depths == wavefront.depths
+    assert np.all(parallel.pixelCost > 0)
+
+
+@pytest.mark.parametrize('mode', ('scalar', 'wavefront'))
+def test_rays_add_up(mode):
+    stats = renderStats('glass', mode)
+
+    # Every pixel casts one primary ray, and every bounce is a reflection
+    # or a refraction of a ray one level up
+    assert stats.rays['primary'] == stats.depths[0]
+    assert stats.rays['reflection'] + stats.rays['refraction'] == sum(count for depth, count in stats.depths.items() if depth > 0)
+    assert set(stats.rays) == set(RAY_KINDS)
@@ -0,0 +1,257 @@
+import os
+import struct
+import pickle
+import numpy as np
+import pytest
+
+import bench
+import output
+from gl import Raytracer
+from figures import Material, Sphere, TRANSPARENT
+from texture import Texture, CubeMap, loadTexture, NEAREST, BILINEAR, TRILINEAR
+
+SIZE = 24
+
+
+# BMP files decode to RGB pixels, bottom row first, whatever their row
+# order, padding and bytes per pixel
+
+def writeBMP(filename, pixels, bytesPerPixel = 3, topDown = False):
+    # pixels: RGB, bottom row first
+    height, width = pixels.shape[:2]
+    rowSize = (width * bytesPerPixel + 3) & ~3
+
+    rows = np.zeros((height, rowSize), dtype = np.uint8)
+    data = np.zeros((height, width, bytesPerPixel), dtype = np.uint8)
+    data[:, :, :3] = pixels[:, :, ::-1]
+    rows[:, :width * bytesPerPixel] = data.reshape(height, -1)
+    if topDown:
+        rows = rows[::-1]
+
+    with open(filename, "wb") as file:
+        file.write(struct.pack('<2sIHHI', b'BM', 54 + rows.size, 0, 0, 54))
+        file.write(struct.pack('<IiiHHIIiiII', 40, width, -height if topDown else height, 1,
+                               bytesPerPixel * 8, 0, rows.size, 0, 0, 0, 0))
+        file.write(rows.tobytes())
+
+
+def randomPixels(width, height):
+    return np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype = np.uint8)
+
+
+@pytest.mark.parametrize('width', [4, 5, 6, 7])
+@pytest.mark.parametrize('bytesPerPixel', [3, 4])
+@pytest.mark.parametrize('topDown', [False, True])
+def test_bmp_decodes(tmp_path, width, bytesPerPixel, topDown):
+    pixels = randomPixels(width, 3)
+    filename = str(tmp_path / "image.bmp")
+    writeBMP(filename, pixels, bytesPerPixel, topDown)
+
+    texture = Texture(filename)
+    assert (texture.width, texture.height) == (width, 3)
+    assert np.array_equal(texture.pixels, pixels)
+
+
+def test_bmp_decodes_like_reading_every_pixel():
+    # The byte at a time reader the bulk decoding replaced, which does
+    # not skip padding, so it only reads files with no padding right
+    texture = Texture(bench.TEXTURE_FILE)
+    assert (texture.width * 3) % 4 == 0
+
+    with open(bench.TEXTURE_FILE, "rb") as image:
+        image.seek(10)
+        headerSize = struct.unpack('=l', image.read(4))[0]
+        image.seek(headerSize)
+
+        for y in range(texture.height):
+            row = np.frombuffer(image.read(texture.width * 3), dtype = np.uint8).reshape(-1, 3)
+            assert np.array_equal(texture.pixels[y], row[:, ::-1])
+
+
+# One texture per file, decoded again only when the file changes, that
+# processes it is sent to attach to instead of copying
+
+def test_load_texture_is_shared(tmp_path):
+    filename = str(tmp_path / "image.bmp")
+    writeBMP(filename, randomPixels(4, 3))
+
+    texture = loadTexture(filename)
+    assert loadTexture(os.path.join(str(tmp_path), ".", "image.bmp")) is texture
+
+    # Written again with a later mtime
+    writeBMP(filename, randomPixels(4, 3)[::-1])
+    os.utime(filename, (os.path.getmtime(filename) + 1,) * 2)
+
+    reloaded = loadTexture(filename)
+    assert reloaded is not texture
+    assert np.array_equal(reloaded.pixels, randomPixels(4, 3)[::-1])
+
+
+@pytest.mark.parametrize('mips', [False, True])
+def test_shared_texture_pickles_to_the_same_memory(mips):
+    texture = Texture(bench.TEXTURE_FILE)
+    if mips:
+        texture.getMips()
+    expected = pickle.loads(pickle.dumps(texture))
+
+    texture.share()
+    data = pickle.dumps(texture)
+    assert len(data) < texture.pixels.nbytes
+
+    copy = pickle.loads(data)
+    assert copy.shm.name == texture.shm.name
+    assert np.array_equal(copy.pixels, expected.pixels)
+    assert (copy.mips is None) == (not mips)
+    for level, expectedLevel in zip(copy.mips or [], expected.mips or []):
+        assert np.array_equal(level, expectedLevel)
+
+    # Both see writes to the one copy
+    texture.pixels[0, 0] = 255 - texture.pixels[0, 0]
+    assert np.array_equal(copy.pixels[0, 0], texture.pixels[0, 0])
+
+
+# MIP levels are box filtered halves of the texture, and filtered lookups
+# pick them by the footprint of the pixel
+
+def test_mips_are_box_filtered(tmp_path):
+    filename = str(tmp_path / "image.bmp")
+    pixels = randomPixels(8, 4)
+    writeBMP(filename, pixels)
+
+    mips = Texture(filename).getMips()
+    assert [level.shape[:2] for level in mips] == [(2, 4), (1, 2), (1, 1)]
+    assert np.allclose(mips[0], pixels.reshape(2, 2, 4, 2, 3).mean(axis = (1, 3)))
+    assert np.allclose(mips[-1], pixels.mean(axis = (0, 1)))
+
+
+def test_lod_follows_the_footprint():
+    texture = Texture(bench.TEXTURE_FILE)
+    size = max(texture.width, texture.height)
+
+    lod = texture.getLod(np.array([0, 1, 4, 2 ** 3.5, size * 4]) / size)
+    assert np.allclose(lod, [0, 0, 2, 3.5, len(texture.getMips())])
+
+
+@pytest.mark.parametrize('filtering', [NEAREST, BILINEAR, TRILINEAR])
+def test_scalar_filtering_matches_batched(filtering):
+    texture = Texture(bench.TEXTURE_FILE)
+    rng = np.random.default_rng(0)
+    u = rng.uniform(-0.1, 1.1, 200)
+    v = rng.uniform(-0.1, 1.1, 200)
+    footprints = 2 ** rng.uniform(-10, 1, 200)
+
+    colors, valid = texture.getColorMany(u, v, footprints, filtering)
+    for i in range(len(u)):
+        color = texture.getColor(u[i], v[i], footprints[i], filtering)
+        assert (color is not None) == valid[i]
+        if valid[i]:
+            assert np.allclose(color, colors[i])
+
+
+def test_wide_footprints_blur_to_the_mean():
+    texture = Texture(bench.TEXTURE_FILE)
+    u = np.array([0.1, 0.5, 0.9])
+
+    colors, valid = texture.getColorMany(u, u, 4, TRILINEAR)
+    assert np.allclose(colors, texture.pixels.mean(axis = (0, 1)) / 255, atol = 1 / 255)
+
+    # and one texel wide ones read the full size texture
+    colors, valid = texture.getColorMany(u, u, 1 / max(texture.width, texture.height), TRILINEAR)
+    assert np.allclose(colors * 255, texture.bilinearMany(0, u, u))
+
+
+@pytest.mark.parametrize('textureFilter', [NEAREST, BILINEAR, TRILINEAR])
+def test_filtered_renders_match(textureFilter):
+    assert Raytracer(SIZE, SIZE).textureFilter == NEAREST
+
+    renders = []
+    for method in ('glRender', 'glRenderWavefront'):
+        rtx = bench.texturedScene(SIZE, SIZE)
+        rtx.textureFilter = textureFilter
+        getattr(rtx, method)()
+        renders.append(rtx.pixels)
+
+    assert np.array_equal(renders[0], renders[1])
+
+
+# Environment lookups in a cube map resampled from an equirectangular map
+# agree with looking the map up directly
+
+def smoothEnvMap(tmp_path, width = 128, height = 64):
+    # Map with no sharp edges, that wraps around without a seam
+    x = np.arange(width) / width * 2 * np.pi
+    y = np.arange(height)[:, None] / height * np.pi
+
+    pixels = np.zeros((height, width, 3))
+    pixels[:, :, 0] = 0.5 + 0.5 * np.cos(x) * np.sin(y)
+    pixels[:, :, 1] = 0.5 + 0.5 * np.sin(x) * np.sin(y)
+    pixels[:, :, 2] = 0.5 + 0.5 * np.cos(y)
+
+    filename = str(tmp_path / "env.bmp")
+    output.writeImage(filename, np.rint(pixels * 255).astype(np.uint8))
+    return Texture(filename)
+
+
+def randomDirections(count = 2000):
+    dirs = np.random.default_rng(0).normal(size = (count, 3))
+    return dirs / np.linalg.norm(dirs, axis = 1)[:, None]
+
+
+def test_cube_matches_direct_lookup(tmp_path):
+    texture = smoothEnvMap(tmp_path)
+    cube = CubeMap(texture)
+    dirs = randomDirections()
+
+    bilinear = np.abs(cube.getEnvColorMany(dirs, BILINEAR) - texture.getEnvColorMany(dirs, BILINEAR))
+    assert bilinear.max() < 3 / 255
+
+    # Nearest texels of the two differ where they fall on either side of
+    # a texel boundary, by a step of the map at most
+    nearest = np.abs(cube.getEnvColorMany(dirs, NEAREST) - texture.getEnvColorMany(dirs, NEAREST))
+    assert nearest.max() < 12 / 255
+    assert nearest.mean() < 2 / 255
+
+
+@pytest.mark.parametrize('filtering', (NEAREST, BILINEAR))
+def test_scalar_lookup_matches_batched(tmp_path, filtering):
+    texture = smoothEnvMap(tmp_path)
+    cube = CubeMap(texture)
+    dirs = randomDirections(200)
+
+    for lookup in (texture, cube):
+        batched = lookup.getEnvColorMany(dirs, filtering)
+        scalar = np.array([lookup.getEnvColor(dir, filtering) for dir in dirs])
+        assert np.allclose(scalar, batched)
+
+
+def test_cube_size_follows_both_axes(tmp_path):
+    assert CubeMap(smoothEnvMap(tmp_path, 128, 64)).size == 32
+    assert CubeMap(smoothEnvMap(tmp_path, 64, 64)).size == 32
+    assert CubeMap(smoothEnvMap(tmp_path, 128, 16)).size == 32
+
+
+def envScene(texture, envCubeMap, textureFilter):
+    rtx = Raytracer(SIZE, SIZE)
+    rtx.envMap = texture
+    rtx.envCubeMap = envCubeMap
+    rtx.textureFilter = textureFilter
+    rtx.scene.append(Sphere((0,0,-5), 1.5, Material(diffuse = (0.9, 0.9, 0.9), ior = 1.5, matType = TRANSPARENT)))
+    return rtx
+
+
+@pytest.mark.parametrize('envCubeMap', (False, True))
+@pytest.mark.parametrize('textureFilter', (NEAREST, BILINEAR))
+def test_renders_use_the_lookup_asked_for(tmp_path, envCubeMap, textureFilter):
+    texture = smoothEnvMap(tmp_path)
+
+    scalar = envScene(texture, envCubeMap, textureFilter)
+    scalar.glRender()
+    wavefront = envScene(texture, envCubeMap, textureFilter)
+    wavefront.glRenderWavefront()
+    assert np.array_equal(scalar.pixels, wavefront.pixels)
+
+    # The cube map is only made when asked for
+    assert (scalar.envCube is not None) == envCubeMap
+    dirs = randomDirections(100)
+    lookup = CubeMap(texture) if envCubeMap else texture
+    assert np.array_equal(scalar.env_colors(dirs), lookup.getEnvColorMany(dirs, textureFilter))
@@ -1,8 +1,36 @@
 
+import os
 import struct
+import weakref
+from multiprocessing import shared_memory
 import numpy as np
 from numpy import arctan2, arccos, pi
 
+# Loaded textures by absolute path, with the mtime they were read at
+textures = {}
+
+# Texture filters. getColor with a footprint blends bilinear lookups in
+# the two nearest MIP levels (TRILINEAR), or takes one in the nearest level
+# (BILINEAR); NEAREST, or no footprint, reads the full size texel.
+NEAREST = 0
+BILINEAR = 1
+TRILINEAR = 2
+
+# Axes a cube map face's texcoords run along, by the axis of its normal
+CUBE_FACE_AXES = ((1, 2), (0, 2), (0, 1))
+
+def loadTexture(filename):
+    # Shared Texture for filename, decoded again only if the file changed
+    path = os.path.abspath(filename)
+    mtime = os.path.getmtime(path)
+
+    if path in textures and textures[path][0] == mtime:
+        return textures[path][1]
+
+    texture = Texture(filename)
+    textures[path] = (mtime, texture)
+    return texture
+
 class Texture(object):
     def __init__(self, filename):
 
@@ -14,38 +42,361 @@ class Texture(object):
             self.width = struct.unpack('=l', image.read(4))[0]
             self.height = struct.unpack('=l', image.read(4))[0]
 
-            image.seek(headerSize)
+            image.seek(28)
+            bytesPerPixel = struct.unpack('=h', image.read(2))[0] // 8
 
-            self.pixels = []
+        # A negative height marks a top-down BMP
+        topDown = self.height < 0
+        self.height = abs(self.height)
 
-            for y in range(self.height):
-                pixelRow = []
+        # Rows are padded to a multiple of 4 bytes
+        rowSize = (self.width * bytesPerPixel + 3) & ~3
 
-                for x in range(self.width):
-                    b = ord(image.read(1)) / 255
-                    g = ord(image.read(1)) / 255
-                    r = ord(image.read(1)) / 255
-                    pixelRow.append([r,g,b])
+        data = np.fromfile(filename, dtype = np.uint8, count = rowSize * self.height, offset = headerSize)
+        data = data.reshape(self.height, rowSize)[:, :self.width * bytesPerPixel]
+        data = data.reshape(self.height, self.width, bytesPerPixel)
 
-                self.pixels.append(pixelRow)
+        if topDown:
+            data = data[::-1]
 
-    def getColor(self, u, v):
-        if 0 <= u < 1 and 0 <= v < 1:
-            return self.pixels[int(v * self.height)][int(u * self.width)]
-        else:
+        # RGB bytes, indexed [y, x] with y = 0 the bottom row
+        self.pixels = np.ascontiguousarray(data[:, :, 2::-1])
+
+        self.shm = None
+
+        # MIP levels, built the first time a filtered lookup needs them, so
+        # environment maps and NEAREST renders never pay for them
+        self.mips = None
+
+    def buildMips(self):
+        # Float RGB levels after the full size one, each a 2x2 box filter
+        # of the one before, down to a single texel
+        self.mips = []
+        level = self.pixels.astype(np.float32)
+
+        while level.shape[0] > 1 or level.shape[1] > 1:
+            height, width = level.shape[:2]
+            if height > 1:
+                level = (level[0:height // 2 * 2:2] + level[1:height // 2 * 2:2]) / 2
+            if width > 1:
+                level = (level[:, 0:width // 2 * 2:2] + level[:, 1:width // 2 * 2:2]) / 2
+            self.mips.append(level)
+
+    def getMips(self):
+        if self.mips is None:
+            self.buildMips()
+        return self.mips
+
+    def getLevel(self, level):
+        return self.pixels if level == 0 else self.getMips()[level - 1]
+
+    def getLod(self, footprint):
+        # MIP level, with a fraction, where a texel is as big as footprint,
+        # the size of a pixel in texcoords
+        texels = np.maximum(footprint * max(self.width, self.height), 1)
+        return np.minimum(np.log2(texels), len(self.getMips()))
+
+    def share(self):
+        # Moves the pixels, and the MIP levels if they are built, into one
+        # block of shared memory, so processes that receive this texture
+        # attach to one copy instead of unpickling their own
+        if self.shm is not None:
+            return
+
+        mipShapes = None if self.mips is None else [level.shape for level in self.mips]
+
+        self.shm = shared_memory.SharedMemory(create = True, size = self.getSharedSize(mipShapes))
+        pixels, mips = self.getSharedArrays(mipShapes)
+
+        pixels[:] = self.pixels
+        for level, mip in zip(mips or [], self.mips or []):
+            level[:] = mip
+
+        self.pixels = pixels
+        self.mips = mips
+
+        weakref.finalize(self, self.shm.unlink)
+
+    def getSharedOffsets(self, mipShapes):
+        # Byte offset of every MIP level in the shared block, after the
+        # pixels, aligned for float32, and the size of the block
+        offsets = []
+        offset = self.height * self.width * 3
+        for shape in mipShapes or []:
+            offset = (offset + 15) & ~15
+            offsets.append(offset)
+            offset += int(np.prod(shape)) * 4
+        return offsets, offset
+
+    def getSharedSize(self, mipShapes):
+        return self.getSharedOffsets(mipShapes)[1]
+
+    def getSharedArrays(self, mipShapes):
+        # Pixels and MIP levels as views of the shared block
+        pixels = np.ndarray((self.height, self.width, 3), dtype = np.uint8, buffer = self.shm.buf)
+        if mipShapes is None:
+            return pixels, None
+
+        offsets = self.getSharedOffsets(mipShapes)[0]
+        mips = [np.ndarray(shape, dtype = np.float32, buffer = self.shm.buf, offset = offset)
+                for shape, offset in zip(mipShapes, offsets)]
+        return pixels, mips
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shm is not None:
+            state['pixels'] = None
+            state['mips'] = None if self.mips is None else [level.shape for level in self.mips]
+            state['shm'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shm is not None:
+            self.shm = shared_memory.SharedMemory(name = self.shm)
+            self.pixels, self.mips = self.getSharedArrays(state['mips'])
+
+    def getColor(self, u, v, footprint = None, filtering = TRILINEAR):
+        if not (0 <= u < 1 and 0 <= v < 1):
             return None
 
-    def getEnvColor(self, dir):
+        if footprint is None or filtering == NEAREST:
+            return self.pixels[int(v * self.height), int(u * self.width)] / 255
+
+        texels = max(footprint * max(self.width, self.height), 1)
+        lod = min(float(np.log2(texels)), len(self.getMips()))
+
+        if filtering == BILINEAR:
+            color = self.bilinear(int(lod + 0.5), u, v)
+        else:
+            level = int(lod)
+            color = self.bilinear(level, u, v)
+
+            fraction = lod - level
+            if fraction > 0:
+                upper = self.bilinear(level + 1, u, v)
+                color = (color[0] * (1 - fraction) + upper[0] * fraction,
+                         color[1] * (1 - fraction) + upper[1] * fraction,
+                         color[2] * (1 - fraction) + upper[2] * fraction)
+
+        return np.array(color) / 255
+
+    def bilinear(self, level, u, v):
+        # Texel values at (u, v) in a MIP level, blended from the 4 nearest
+        # texel centres, clamped at the edges. Plain floats, in the same
+        # order of operations as bilinearMany.
+        pixels = self.getLevel(level)
+        height, width = pixels.shape[:2]
+
+        x = min(max(u * width - 0.5, 0), width - 1)
+        y = min(max(v * height - 0.5, 0), height - 1)
+        x0 = int(x)
+        y0 = int(y)
+        x1 = min(x0 + 1, width - 1)
+        y1 = min(y0 + 1, height - 1)
+        fx = x - x0
+        fy = y - y0
+
+        # Slicing one 2x2 block is much cheaper than indexing 4 texels
+        block = pixels[y0:y1 + 1, x0:x1 + 1].tolist()
+        p00, p01 = block[0][0], block[0][-1]
+        p10, p11 = block[-1][0], block[-1][-1]
+
+        gx = 1 - fx
+        gy = 1 - fy
+        return ((p00[0] * gx + p01[0] * fx) * gy + (p10[0] * gx + p11[0] * fx) * fy,
+                (p00[1] * gx + p01[1] * fx) * gy + (p10[1] * gx + p11[1] * fx) * fy,
+                (p00[2] * gx + p01[2] * fx) * gy + (p10[2] * gx + p11[2] * fx) * fy)
+
+    def getEnvColor(self, dir, filtering = NEAREST):
+        if filtering != NEAREST:
+            return self.getEnvColorMany(np.array([list(dir)], dtype = float), filtering)[0]
+
+        dir = np.array(list(dir), dtype = float)
         dir = dir / np.linalg.norm(dir)
 
         x = int((arctan2(dir[2], dir[0]) / (2 * pi) + 0.5) * self.width)
         y = int(arccos(-dir[1]) / pi * self.height)
 
-        return self.pixels[y][x]
+        return self.pixels[min(y, self.height - 1), min(x, self.width - 1)] / 255
+
+    def getColorMany(self, u, v, footprints = None, filtering = TRILINEAR):
+        valid = (0 <= u) & (u < 1) & (0 <= v) & (v < 1)
+
+        colors = np.zeros((len(u), 3))
+
+        if footprints is None or filtering == NEAREST:
+            colors[valid] = self.pixels[(v[valid] * self.height).astype(int),
+                                        (u[valid] * self.width).astype(int)] / 255
+            return colors, valid
+
+        u = u[valid]
+        v = v[valid]
+        lod = self.getLod(np.broadcast_to(footprints, valid.shape)[valid])
+
+        if filtering == BILINEAR:
+            levels = (lod + 0.5).astype(int)
+            fractions = np.zeros(len(lod))
+        else:
+            levels = lod.astype(int)
+            fractions = lod - levels
+
+        texColors = np.zeros((len(u), 3))
+        for level in np.unique(levels):
+            rays = np.nonzero(levels == level)[0]
+            texColors[rays] = self.bilinearMany(level, u[rays], v[rays])
+
+            blended = rays[fractions[rays] > 0]
+            if len(blended):
+                fraction = fractions[blended][:, None]
+                texColors[blended] = (texColors[blended] * (1 - fraction) +
+                                      self.bilinearMany(level + 1, u[blended], v[blended]) * fraction)
+
+        colors[valid] = texColors / 255
+        return colors, valid
+
+    def bilinearMany(self, level, u, v):
+        pixels = self.getLevel(level)
+        height, width = pixels.shape[:2]
+
+        x = np.clip(u * width - 0.5, 0, width - 1)
+        y = np.clip(v * height - 0.5, 0, height - 1)
+        x0 = x.astype(int)
+        y0 = y.astype(int)
+        x1 = np.minimum(x0 + 1, width - 1)
+        y1 = np.minimum(y0 + 1, height - 1)
+        fx = (x - x0)[:, None]
+        fy = (y - y0)[:, None]
+
+        bottom = pixels[y0, x0] * (1 - fx) + pixels[y0, x1] * fx
+        top = pixels[y1, x0] * (1 - fx) + pixels[y1, x1] * fx
+        return bottom * (1 - fy) + top * fy
+
+    def getEnvCoords(self, dirs):
+        # Texcoords of the directions dirs in an equirectangular map
+        dirs = dirs / np.linalg.norm(dirs, axis = 1)[:, None]
+
+        u = arctan2(dirs[:, 2], dirs[:, 0]) / (2 * pi) + 0.5
+        v = arccos(-dirs[:, 1]) / pi
+        return u, v
+
+    def getEnvPixels(self, dirs):
+        # Pixels of an equirectangular environment map in the directions dirs
+        u, v = self.getEnvCoords(dirs)
+
+        x = (u * self.width).astype(int)
+        y = (v * self.height).astype(int)
+
+        return self.pixels[np.minimum(y, self.height - 1), np.minimum(x, self.width - 1)]
+
+    def getEnvColorMany(self, dirs, filtering = NEAREST):
+        # Rays carry no footprint to pick a MIP level by, so BILINEAR and
+        # TRILINEAR both blend the 4 nearest texels of the full size map.
+        # Across the seam, u wraps around; at the poles, v is clamped.
+        if filtering == NEAREST:
+            return self.getEnvPixels(dirs) / 255
+
+        u, v = self.getEnvCoords(dirs)
+
+        x = u * self.width - 0.5
+        x0 = np.floor(x).astype(int)
+        fx = (x - x0)[:, None]
+        x1 = (x0 + 1) % self.width
+        x0 = x0 % self.width
+
+        y = np.clip(v * self.height - 0.5, 0, self.height - 1)
+        y0 = y.astype(int)
+        y1 = np.minimum(y0 + 1, self.height - 1)
+        fy = (y - y0)[:, None]
+
+        pixels = self.pixels
+        bottom = pixels[y0, x0] * (1 - fx) + pixels[y0, x1] * fx
+        top = pixels[y1, x0] * (1 - fx) + pixels[y1, x1] * fx
+        return (bottom * (1 - fy) + top * fy) / 255
+
+
+class CubeMap(object):
+    # Equirectangular environment map resampled once onto the 6 faces of a
+    # cube, so a lookup takes a division and an index instead of arctan2
+    # and arccos. Faces go +x, -x, +y, -y, +z, -z. The default size keeps
+    # the resolution the texture has along its equator or from pole to
+    # pole, whichever is higher. Faces are sampled bilinearly from the
+    # texture; lookups blend texels within a face and clamp at its edges.
+
+    def __init__(self, texture, size = None):
+        self.size = size or max(1, texture.width // 4, texture.height // 2)
+
+        # Direction through the centre of every texel of every face
+        coords = (np.arange(self.size) + 0.5) / self.size * 2 - 1
+        v, u = np.meshgrid(coords, coords, indexing = 'ij')
+
+        dirs = np.zeros((6, self.size, self.size, 3))
+        for face in range(6):
+            axis = face // 2
+            uAxis, vAxis = CUBE_FACE_AXES[axis]
+            dirs[face, :, :, axis] = -1 if face % 2 else 1
+            dirs[face, :, :, uAxis] = u
+            dirs[face, :, :, vAxis] = v
+
+        # Kept as bytes and scaled on lookup; a float copy of the 6 faces
+        # would take 8 times the memory in every process
+        colors = texture.getEnvColorMany(dirs.reshape(-1, 3), BILINEAR)
+        self.pixels = np.rint(colors * 255).astype(np.uint8).reshape(6, self.size, self.size, 3)
+
+    def getEnvColor(self, dir, filtering = NEAREST):
+        if filtering != NEAREST:
+            return self.getEnvColorMany(np.array([list(dir)], dtype = float), filtering)[0]
+
+        x, y, z = [float(d) for d in dir]
+        ax, ay, az = abs(x), abs(y), abs(z)
+
+        if ax >= ay and ax >= az:
+            face, major, u, v = (0 if x > 0 else 1), ax, y, z
+        elif ay >= az:
+            face, major, u, v = (2 if y > 0 else 3), ay, x, z
+        else:
+            face, major, u, v = (4 if z > 0 else 5), az, x, y
+
+        i = min(int((u / major + 1) / 2 * self.size), self.size - 1)
+        j = min(int((v / major + 1) / 2 * self.size), self.size - 1)
+
+        return self.pixels[face, j, i] / 255
+
+    def getEnvColorMany(self, dirs, filtering = NEAREST):
+        x = dirs[:, 0]
+        y = dirs[:, 1]
+        z = dirs[:, 2]
+        ax = np.abs(x)
+        ay = np.abs(y)
+        az = np.abs(z)
 
+        # Same faces and tie breaks as getEnvColor
+        xMajor = (ax >= ay) & (ax >= az)
+        yMajor = ~xMajor & (ay >= az)
+        zMajor = ~(xMajor | yMajor)
 
+        major = np.where(xMajor, x, np.where(yMajor, y, z))
+        face = np.where(xMajor, 0, np.where(yMajor, 2, 4)) + (major < 0)
 
+        u = np.where(xMajor, y, x) / np.abs(major)
+        v = np.where(zMajor, y, z) / np.abs(major)
 
+        if filtering == NEAREST:
+            i = np.minimum(((u + 1) / 2 * self.size).astype(int), self.size - 1)
+            j = np.minimum(((v + 1) / 2 * self.size).astype(int), self.size - 1)
 
+            return self.pixels.reshape(-1, 3)[(face * self.size + j) * self.size + i] / 255
 
+        s = np.clip((u + 1) / 2 * self.size - 0.5, 0, self.size - 1)
+        t = np.clip((v + 1) / 2 * self.size - 0.5, 0, self.size - 1)
+        i0 = s.astype(int)
+        j0 = t.astype(int)
+        i1 = np.minimum(i0 + 1, self.size - 1)
+        j1 = np.minimum(j0 + 1, self.size - 1)
+        fi = (s - i0)[:, None]
+        fj = (t - j0)[:, None]
 
+        pixels = self.pixels
+        bottom = pixels[face, j0, i0] * (1 - fi) + pixels[face, j0, i1] * fi
+        top = pixels[face, j1, i0] * (1 - fi) + pixels[face, j1, i1] * fi
+        return (bottom * (1 - fj) + top * fj) / 255